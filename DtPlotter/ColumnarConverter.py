@@ -0,0 +1,180 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import multiprocessing
+import numpy as np
+from utilities import FileTools
+from utilities import RunContext
+from utilities import EventCache
+from utilities import Readers
+
+'''
+    Converts h4 ntuples (IE the compiled_roots/ from AutoHadd) into columnar exports DtPlotter reads without H4Analysis.
+    Only the columns DtPlotter uses are written, for a list of channels: n_tracks, the flattened track position
+    (fitResult[0].x() and .y() as plain columns) and fit_time, fit_ampl, b_rms, fit_chi2, amp_max, time_maximum per channel,
+    with the channel names resolved (IE fit_time[C3] -> fit_time_C3.npy). Values are stored as float32 (the branch type) by default.
+    Each file becomes <output dir>/<file name>.columns/ (see Readers.ColumnarReader), written under a .tmp name and renamed when done.
+    Files are converted in parallel (-j), and <output dir>/manifest.json lists every export with its source, sizes and columns.
+    Exports whose source hasn't changed since (same mtime, channels and format, per the manifest) are skipped unless --force.
+    --compress writes one compressed columns.npz instead of .npy files: smaller to copy around, but read into memory, not mapped.
+    Analyze the exports like the ntuples, IE DtPlotter.py -d <output dir> (the same --name/--freq/--temp select the files).
+'''
+
+## Every crystal of the DtPlotter positions, IE what a 'compiled' file needs
+DEFAULT_CHANNELS = sorted(set(sum([pair for pair in RunContext.XTAL_PAIRS.values()], [])))
+
+def input_arguments():
+    parser = argparse.ArgumentParser(description='Convert h4 ntuples to pruned columnar exports for DtPlotter')
+    parser.add_argument('-d',           type=str,   default=None,               help='Convert all the .root files in this directory (default: the DtPlotter default ntuple directory)')
+    parser.add_argument('-f',           type=str,   default=None,               help='Convert this file')
+    parser.add_argument('--freq',       type=str,   default='160MHz',           help='Sampling frequency,   IE "160MHz" or "120 MHz"')
+    parser.add_argument('--temp',       type=str,   default='18deg',            help='Sampling temperature, IE "18deg"  or "9deg"')
+    parser.add_argument('--name',       type=str,   default='ECAL_H4_Oct2018',  help='Name prefix')
+    parser.add_argument('--cache',      type=str,   default=None,               help='DtPlotter cache directory, where SyntheticH4.C is built if needed (default ~/.dtplotter_cache/)')
+    parser.add_argument('-o',           type=str,   default=None,               help='Output directory (default <input directory>/columns/)')
+    parser.add_argument('-j', '--jobs', type=int,   default=1,                  help='Files converted at once, one process each (0 = all cores)')
+    parser.add_argument('--channels',   type=str,   default=','.join(DEFAULT_CHANNELS), help='Channels to keep, IE "C3,C4"')
+    parser.add_argument('--extra',      type=str,   default='',                 help='More column expressions to keep, comma separated, IE "X[0],Y[0]"')
+    parser.add_argument('--dtype',      type=str,   default='float32',          help='Stored type of the columns, float32 or float64')
+    parser.add_argument('--chunk',      type=float, default=1e6,                help='Events read at a time')
+    parser.add_argument('--compress',   action='store_true',                    help='Write one compressed columns.npz per file instead of memory-mappable .npy files')
+    parser.add_argument('--force',      action='store_true',                    help='Convert even the files whose export is up to date')
+    args = parser.parse_args()
+
+    if   (args.freq == '160') or (args.freq == '160MHz'): args.freq = '160MHz'      # Ensures consistent formatting
+    elif (args.freq == '120') or (args.freq == '120MHz'): args.freq = '120MHz'      # IE does the user enter '120', or '120MHz'?
+    if   (args.temp == '18' ) or (args.temp == '18deg' ): args.temp = '18deg'       # Resolve it either way
+    elif (args.temp == '9'  ) or (args.temp == '9deg'  ): args.temp = '9deg'
+
+    if (args.d is None) and (args.f is None): args.d = FileTools.FileTools(args).defaultanalysispath
+    if (args.d is not None) and (args.f is not None): sys.exit("\nGive either -d or -f, aborting...")
+    if (args.d is not None) and (not args.d.endswith('/')): args.d += '/'
+    if args.dtype not in ['float32', 'float64']:    sys.exit("\nUnrecognized dtype {}, aborting...".format(args.dtype))
+    if args.jobs == 0: args.jobs = multiprocessing.cpu_count()
+    if args.o is None: args.o = os.path.join(args.d if args.d is not None else os.path.dirname(os.path.abspath(args.f)), 'columns')
+    if not args.o.endswith('/'): args.o += '/'
+    return args
+
+## Column expressions to export, in order
+def columns_for(channels, extra=[]):
+    columns = ['n_tracks', 'fitResult[0].x()', 'fitResult[0].y()']
+    for branch in ['fit_time', 'fit_ampl', 'b_rms', 'fit_chi2', 'amp_max', 'time_maximum']:
+        columns += ['{}[{}]'.format(branch, ch) for ch in channels]
+    return columns + [e for e in extra if e not in columns]
+
+def input_files(args):
+    if args.f is not None: return [args.f]
+    return sorted(args.d + f for f in os.listdir(args.d) if f.endswith('.root'))
+
+## <output dir>/<name>.columns/ for an input file
+def export_location(args, filename):
+    return args.o + os.path.basename(filename.rstrip('/')).rsplit('.', 1)[0] + Readers.COLUMNAR_SUFFIX + '/'
+
+def read_manifest(outdir):
+    if os.path.exists(outdir + 'manifest.json'):
+        with open(outdir + 'manifest.json', 'r') as f: return json.load(f)
+    return {'files': {}}
+
+def write_manifest(outdir, manifest):
+    with open(outdir + 'manifest.json.tmp', 'w') as f: json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(outdir + 'manifest.json.tmp', outdir + 'manifest.json')
+
+def directory_size(path):
+    return sum(os.path.getsize(path + f) for f in os.listdir(path))
+
+## Convert one file. Returns its manifest entry
+def convert(args, filename, exprs):
+    start   = time.time()
+    reader  = Readers.open_reader(filename, FileTools.FileTools(args).cache_location())
+    dest    = export_location(args, filename)
+    tmp     = dest.rstrip('/') + '.tmp/'
+    if os.path.exists(tmp): shutil.rmtree(tmp)                                                 # Left by a conversion that was interrupted
+    os.makedirs(tmp)
+
+    n       = reader.entries()
+    chunk   = max(int(args.chunk), 1)
+    names   = [EventCache.EventCache.column_filename(e) for e in exprs]
+    outputs = [np.lib.format.open_memmap(tmp + name, mode='w+', dtype=args.dtype, shape=(n,)) for name in names]
+    for first in range(0, n, chunk):
+        for output, values in zip(outputs, reader.read(exprs, first, min(chunk, n - first))):
+            output[first:first+len(values)] = values
+    for output in outputs: output.flush()
+    del outputs
+
+    columns = dict(zip(exprs, names))
+    if args.compress == True:                                                                   # Members named after the .npy files they replace
+        np.savez_compressed(tmp + 'columns.npz', **dict((name[:-4], np.load(tmp + name, mmap_mode='r')) for name in names))
+        for name in names: os.remove(tmp + name)
+        columns = dict((e, name[:-4]) for e, name in columns.items())
+
+    info = {'Positions': reader.position()}
+    if hasattr(reader, 'energies'): info['Energy'] = reader.energies()
+    meta = {'source': os.path.abspath(filename), 'source_mtime': os.path.getmtime(filename), 'entries': n, 'info': info,
+            'columns': columns, 'dtype': args.dtype, 'compressed': args.compress}
+    with open(tmp + 'meta.json', 'w') as f: json.dump(meta, f, indent=1, sort_keys=True)          # meta.json last, as ColumnarReader expects
+    if os.path.exists(dest): shutil.rmtree(dest)
+    os.rename(tmp, dest)
+
+    source_size = os.path.getsize(filename) if os.path.isfile(filename) else directory_size(filename.rstrip('/') + '/')
+    return {'source': meta['source'], 'source_mtime': meta['source_mtime'], 'source_bytes': source_size, 'export': dest,
+            'bytes': directory_size(dest), 'entries': n, 'columns': sorted(exprs), 'dtype': args.dtype, 'compressed': args.compress,
+            'seconds': time.time() - start}
+
+## Pool worker. Failures are returned, so one bad file doesn't stop the others
+def convert_task(task):
+    args, filename, exprs = task
+    try:
+        entry = convert(args, filename, exprs)
+        print "Converted {} ({} events, {:.1f} MB -> {:.1f} MB, {:.1f} s)".format(filename, entry['entries'], entry['source_bytes']/1e6, entry['bytes']/1e6, entry['seconds'])
+        return [filename, entry]
+    except (Exception, SystemExit) as e:
+        print "\nConversion of {} failed: {}".format(filename, e)
+        return [filename, {'source': os.path.abspath(filename), 'error': str(e)}]
+
+## An export is up to date if the manifest has it from the same source mtime, with the same columns and format
+def up_to_date(args, manifest, filename, exprs):
+    entry = manifest['files'].get(os.path.basename(export_location(args, filename).rstrip('/')))
+    if (entry is None) or ('error' in entry) or (os.path.exists(entry['export']) == False): return False
+    return (entry['source_mtime'] == os.path.getmtime(filename)) and (entry['columns'] == sorted(exprs)) and \
+           (entry['dtype'] == args.dtype) and (entry['compressed'] == args.compress)
+
+def main():
+    args     = input_arguments()
+    channels = [ch.strip() for ch in args.channels.split(',') if ch.strip() != '']
+    exprs    = columns_for(channels, [e.strip() for e in args.extra.split(',') if e.strip() != ''])
+    if os.path.exists(args.o) == False: os.makedirs(args.o)
+    manifest = read_manifest(args.o)
+
+    Files    = input_files(args)
+    todo     = [f for f in Files if (args.force == True) or (up_to_date(args, manifest, f, exprs) == False)]
+    print "{} file(s), {} to convert, {} column(s) each: {}".format(len(Files), len(todo), len(exprs), ', '.join(exprs))
+
+    if (args.jobs > 1) and (len(todo) > 1):
+        pool    = multiprocessing.Pool(min(args.jobs, len(todo)))
+        results = pool.map_async(convert_task, [(args, f, exprs) for f in todo]).get(9999999)    # A timeout lets Ctrl-C through to the parent
+        pool.close()
+        pool.join()
+    else:
+        results = [convert_task((args, f, exprs)) for f in todo]
+
+    for filename, entry in results: manifest['files'][os.path.basename(export_location(args, filename).rstrip('/'))] = entry
+    manifest['channels'] = channels
+    manifest['updated']  = time.time()
+    write_manifest(args.o, manifest)
+
+    done = [entry for filename, entry in results if 'error' not in entry]
+    if len(done) > 0:
+        print "Read {:.1f} MB, wrote {:.1f} MB ({:.1f}%)".format(sum(e['source_bytes'] for e in done)/1e6, sum(e['bytes'] for e in done)/1e6,
+                                                                100.*sum(e['bytes'] for e in done)/max(sum(e['source_bytes'] for e in done), 1))
+    print "Manifest written to {}manifest.json".format(args.o)
+    if len(done) < len(results): sys.exit("\n{} conversion(s) failed".format(len(results) - len(done)))
+
+if __name__ == "__main__":
+    main()
@@ -23,8 +23,10 @@ def input_arguments():
     parser.add_argument('freq',             action='store',         help="Sampling frequency of the data run (160 or 120 MHz)") 
     parser.add_argument('temp',             action='store',         help="Temperature of the data run (18 or 9 deg C)") 
     parser.add_argument('energy',           action='store',         help="Energy of the data, probably you want 'compiled'") 
-    parser.add_argument('-s', '--summary',  action='store_true',    help="Don't run the analysis, just read the resolutions from the log files.")
+    parser.add_argument('-s', '--summary',  action='store_true',    help="Don't run the analysis, just print the resolutions of every configuration stored in the results store (results.db in the cache).")
     parser.add_argument('-r', '--rerun'  ,  action='store_true',    help="Run/re-run only specific runs, selected from a list")
+    parser.add_argument('-i', '--inprocess',action='store_true',    help="Run every configuration in this process, loading each file (centers, chi2 bounds, columns) only once")
+    parser.add_argument('--name',           action='store',         default='ECAL_H4_Oct2018', help="Name prefix of the data run, passed to DtPlotter.py")
     args = parser.parse_args() 
         
     if   (args.freq == '160') or (args.freq == '160MHz'): args.freq = '160MHz'      # Ensures consistent formatting 
@@ -65,85 +67,80 @@ def check_directory(phpplots_path, dest, rm_flag):
 
     return
     
-## Reads resolution values from log files and prints them out
-def skim_resolutions(args, destinations):
-    
-    cutnames       = [x.split('/')[-2] for x in destinations]                       # Name of batch, IE 'baseline', 'damp_cut', 'chi2_and_aeff', etc..
-    C3down_status  = []
-    C3up_status    = []
-    C3down_res     = []
-    C3up_res       = []
-    C3down_res_err = []
-    C3up_res_err   = []
-
-    log_files = []
+## Status flag of a fit from its reduced chi2
+def fit_status(red_chi2):
+    if   red_chi2 is None: return '**'                                             # The fit failed
+    elif red_chi2 > 2    : return '**'
+    elif red_chi2 > 1    : return ' *'
+    return '  '
 
-    ## Checks that the folders exist, exit if not
-    for dest in destinations:
-        if not os.path.exists(dest): sys.exit('Error!!! Folder {} not found. Have you not run that analysis, or moved those files?'.format(dest))
+## Results store DtPlotter writes to (see utilities/ResultsStore.py). Same location as DtPlotter's default
+def results_store(args):
+    import DtPlotter                                                                # Only the option parsing and utilities, ROOT isn't loaded
+    dt_args = DtPlotter.input_arguments(['--freq', args.freq, '--temp', args.temp, '-e', args.energy, '--name', args.name])
+    return DtPlotter.ResultsStore.ResultsStore(DtPlotter.FileTools.FileTools(dt_args).results_location())
 
-    ## Get a list of all log files
-    ## We keep each destinations log files separate so we can more easilly tell if any are missing, without annoying searches by name
-    for dest in destinations:
-        logs = []                           # Keep each destinations logs in an array. IE for baseline [<down>,<up>], damp [<down>,<up>], etc...
-        for filei in os.listdir(dest):
-            if filei.endswith('log.txt'):   
-                logs.append(dest+filei)
-        log_files.append(logs)
+## Reads the resolution values of every configuration from the results store and prints them out
+## One query for the whole batch. Positions are the ones found in the store, any missing result is shown as 'N/A'
+def skim_resolutions(args, destinations):
+    
+    cutnames  = [x.split('/')[-2] for x in destinations][:-1]                       # Name of batch, IE 'baseline', 'damp_cut', etc... [-1] is chi2_and_aeff, ignore
+    rows      = results_store(args).resolutions(args.name, args.freq, args.temp, args.energy, cutnames)
+    if len(rows) == 0: sys.exit('Error!!! No results found for {} {}/{} {}. Have you not run those analyses yet?'.format(args.name, args.freq, args.temp, args.energy))
+    positions = sorted(set(row['position'] for row in rows))
+    results   = dict(((row['config'], row['position']), row) for row in rows)
 
-    ## Iterate over log files, skimming resolution values
-    for logi in log_files:
-        ## Check to see if any log files are missing and if so fill that data with 'N/A'
-        if len(logi) != 2:                      # If we don't have a C3down and a C3up file...
-            if not 'C3down' in logi[0]:         # If we're missing C3down_log.txt
-                C3down_res.append('N/A')        # Fill with 'N/A'
-                C3down_res_err.append('N/A')
-                C3down_status.append('  ')
-            if not 'C3up' in logi[0]:           # If we're missing C3up_log.txt
-                C3up_res.append('N/A')          # Fill with 'N/A'
-                C3up_res_err.append('N/A')
-                C3up_status.append('  ')
-        ## For the files we DO have, skim res and res_err from the log
-        for filei in logi:
-            filename = filei.split('/')[-1]                                                     # File name without the /path/
-            with open(filei, 'r') as f:
-                for line in f:
-                    if 'Constant term:' in line:                                                # If 'line' contains 'Constant term:'
-                        res = ''.join([d for d in line if d.isdigit() or d is '.'])             # Extract resolution from line (a bad method... )
-                        if   filename.startswith('C3up')  : C3up_res.append(res)
-                        elif filename.startswith('C3down'): C3down_res.append(res)
-                    if 'Constant term error:' in line:                                          # If 'line' contains 'Constant term error:'
-                        res_err = ''.join([d for d in line if d.isdigit() or d is '.'])         # Extract resolution uncertainty from line (a bad method... )
-                        if   filename.startswith('C3up')  : C3up_res_err.append(res_err)
-                        elif filename.startswith('C3down'): C3down_res_err.append(res_err)
-                    if 'Reduced  fit chi2:' in line:
-                        red_chi2 = ''.join([d for d in line if d.isdigit() or d is '.'])[1:]    # Extract reduced chi2 from line (a bad method... )
-                        if   red_chi2 == '':
-                            status = '**'
-                        elif (float(red_chi2) > 1) and (float(red_chi2) < 2): 
-                            status = ' *'
-                        elif float(red_chi2) > 2: 
-                            status = '**'
-                        else:            
-                            status = '  '
-                        if   filename.startswith('C3up')  : C3up_status.append(status)
-                        elif filename.startswith('C3down'): C3down_status.append(status)
-                        
     ## Print out summary
+    width = 31 + 23*len(positions)
     print('\n\t  Batch Resolution Analysis Summary for {}/{}:'.format(args.freq,args.temp))
-    print(' '+'_'*76)
-    print('|{0:^30}|{1:^22}|{2:^22}|'.format('Cut/Batch','C3down','C3up'))
-    print('|'+'_'*30+'|'+'_'*22+'|'+'_'*22+'|')
-    for cut, status1, r1, err1, status2, r2, err2 in zip(cutnames[:-1],C3down_status,C3down_res,C3down_res_err,C3up_status,C3up_res,C3up_res_err):  # cutnames[-1] is chi2_and_aeff, ignore
-        print('|'+'-'*30+'|--|'+'-'*19+'|--|'+'-'*19+'|')
-        print('|{0:^30}|{1}| {2:^5} +- {3:^5} ps |{4}| {5:^5} +- {6:^5} ps |'.format(cut,status1,r1,err1,status2,r2,err2))      # Print out with formatting for fixed width display
-    print('|'+'_'*30+'|__|'+'_'*19+'|__|'+'_'*19+'|')
+    print(' '+'_'*(width-1))
+    print('|{0:^30}|'.format('Cut/Batch')                  + ''.join('{0:^22}|'.format(pos) for pos in positions))
+    print('|'+'_'*30+'|'                                   + ''.join('_'*22+'|' for pos in positions))
+    for cut in cutnames:
+        cells = []
+        for pos in positions:
+            if (cut, pos) not in results: 
+                cells.append('  | {0:^5} +- {1:^5} ps |'.format('N/A', 'N/A'))
+                continue
+            r = results[(cut, pos)]
+            cells.append('{0}| {1:^5.2f} +- {2:^5.2f} ps |'.format(fit_status(r['red_chi2']), r['cterm'], r['cterm_err']))
+        print('|'+'-'*30+'|'                               + ''.join('--|'+'-'*19+'|' for pos in positions))
+        print('|{0:^30}|'.format(cut)                      + ''.join(cells))                                        # Print out with formatting for fixed width display
+    print('|'+'_'*30+'|'                                   + ''.join('__|'+'_'*19+'|' for pos in positions))
     print("('*'  means the fit's reduced chi2 is > 1. These fits may not be trustworthy  )")
     print("('**' means the fit's reduced chi2 is > 2. These fits are likely untrustworthy)")
     print('')
     
     return
 
+## Run each DtPlotter command and move its output to its destination folder
+## With --inprocess the commands aren't launched, their options are run by DtPlotter.analyze_file in this process.
+## Everything that doesn't depend on the options (cut engine/cached columns, target centers, chi2 bounds) is then shared across them
+def run_batch(args, phpplots_path, run_cmds, destinations):
+
+    if args.inprocess == False:
+        for runcmd, path in zip(run_cmds, destinations):
+            p = subprocess.Popen(runcmd)                            # Run the command
+            p.communicate()                                         # Wait for it to finish
+            move_files_to_folder(phpplots_path, path, args)         # Move the plots to the proper folder under .../www/...
+        return
+
+    import DtPlotter                                                # Only needed (and ROOT only loaded) in this mode
+    DtPlotter.root_setup()
+    contexts = {}                                                   # File name -> RunContext, shared by every configuration
+    for runcmd, path in zip(run_cmds, destinations):
+        dt_args  = DtPlotter.input_arguments(runcmd[2:])            # Drop 'python', 'DtPlotter.py'
+        ft       = DtPlotter.FileTools.FileTools(dt_args)
+        savepath = ft.output_location()
+        try:
+            for f in ft.analysis_path():
+                if f[0] not in contexts: contexts[f[0]] = DtPlotter.RunContext.RunContext(dt_args, savepath, f)
+                DtPlotter.analyze_file(dt_args, savepath, f, contexts[f[0]])
+        finally:
+            DtPlotter.OutputWriter.finish_active(savepath)          # Left open if a file failed, its plots are still uploaded
+            DtPlotter.OutputWriter.flush()                          # The plots must be uploaded before they're moved
+        move_files_to_folder(phpplots_path, path, args)             # Same destinations as the subprocess runs
+
 def rerun_specific_run(args, destinations, run_cmds):
 
     print "Select which run(s) to redo from the list below:"
@@ -170,10 +167,7 @@ def rerun_specific_run(args, destinations, run_cmds):
     check_directory(phpplots_path, phpplots_path+'tmp/',    True )
     
     ## Run the commands and move them to the proper destination 
-    for rerun_cmd, path in zip(rerun_cmds, rerun_dests):
-        p = subprocess.Popen(rerun_cmd)                             # Run the command
-        p.communicate()                                             # Wait for it to finish
-        move_files_to_folder(phpplots_path, path, args)             # Move the plots to the proper folder under .../www/...
+    run_batch(args, phpplots_path, rerun_cmds, rerun_dests)
     
     ## Print out resolutions from the analysis  
     skim_resolutions(args, destinations)
@@ -202,7 +196,7 @@ def main():
     shutil.copytree(Dt_path, Dt_path+'tmp/')                                                                    
     
     ## Building the commands we want to run 
-    cmd = ['python', Dt_path+'tmp/DtPlotter.py', '--freq', args.freq, '--temp', args.temp, '-e', args.energy]   # Base command, specifies which files/runs to use
+    cmd = ['python', Dt_path+'tmp/DtPlotter.py', '--freq', args.freq, '--temp', args.temp, '-e', args.energy, '--name', args.name]   # Base command, specifies which files/runs to use
     chi2andaeff     = cmd + ['-x'  , '-a'    ]                                                                  # Command to make chi2 and Aeff plots
     baseline        = cmd + ['-r'  , '--fit' ]                                                                  # Baseline dt resolution command, default cuts only
     da      =   ['--da', '500']                                                                                 # Misc extra cuts to be applied
@@ -231,7 +225,10 @@ def main():
                     save_path + 'damp_and_pos_and_lin_corr/',   \
                     save_path + 'chi2_and_aeff/'                ]
 
-    ## Skim resolutions from log files and exit instead of running analysis if '--summary' used
+    ## Each run stores its results under its destination's name, IE 'baseline'
+    run_commands = [runcmd + ['--config', dest.split('/')[-2]] for runcmd, dest in zip(run_commands, destinations)]
+
+    ## Print the resolutions from the results store and exit instead of running analysis if '--summary' used
     if args.summary == True:
         skim_resolutions(args, destinations)
         shutil.rmtree(Dt_path+'tmp/')
@@ -246,13 +243,11 @@ def main():
     ## Check to make sure all relevant directories exist/are empty if need be
     check_directory(phpplots_path, plots_path,              False)
     check_directory(phpplots_path, save_path,               True )
+    results_store(args).clear(args.name, args.freq, args.temp, args.energy, [x.split('/')[-2] for x in destinations])   # Like the folders, start the batch's results over
     check_directory(phpplots_path, phpplots_path+'tmp/',    True )
     
     ## Run the commands and move them to the proper destination 
-    for runcmd, path in zip(run_commands, destinations):
-        p = subprocess.Popen(runcmd)                                # Run the command
-        p.communicate()                                             # Wait for it to finish
-        move_files_to_folder(phpplots_path, path, args)             # Move the plots to the proper folder under .../www/...
+    run_batch(args, phpplots_path, run_commands, destinations)
     
     ## Print out resolutions from the analysis  
     skim_resolutions(args, destinations)
@@ -8,9 +8,10 @@ import signal
 import shutil
 import argparse
 import subprocess
-from ROOT import *
 from utilities import FileTools
 from utilities import RunInfoTools
+from utilities import RunContext
+from utilities.RootLoader import ROOT
 
 '''
         Code to check the efficiencies of cuts
@@ -24,11 +25,14 @@ signal.signal(signal.SIGINT, signal_handler)
 
 def input_arguments(): 
         
-    parser = argparse.ArgumentParser (descrirition = 'Submit multiple templateMaker.py batches at once') 
+    parser = argparse.ArgumentParser (description = 'Submit multiple templateMaker.py batches at once') 
     parser.add_argument('freq',             action='store',                     help='Sampling frequency of the data run (160 or 120 MHz)'          ) 
     parser.add_argument('temp',             action='store',                     help='Temperature of the data run (18 or 9 deg C)'                  ) 
     parser.add_argument('pos',              action='store',                     help='Position, probably C3up or C3down'                            ) 
     parser.add_argument('-e',               action='store', default='compiled', help='Energy of the data, probably you want "compiled"'             ) 
+    parser.add_argument('-f',               action='store', default=None,       help='Use the given file (ROOT or columnar export) instead of the default one') 
+    parser.add_argument('--name',           action='store', default='ECAL_H4_Oct2018', help='Name prefix'                                      ) 
+    parser.add_argument('--cache',          action='store', default=None,       help='Directory for the columnar event cache (default ~/.dtplotter_cache/)') 
 
     print sys.argv
 
@@ -44,15 +48,9 @@ def input_arguments():
         
     return args 
 
-def get_events(testfile, cut):
-
-    tfile  = TFile(testfile[0])
-    tree = tfile.Get("h4")
-    p   = ["Y[0]:X[0]", '', 100,-100,100,100,-100,100]      # Plot something 2d, doesn't matter what. We just need the # of events
-    hh = TH2F('hh', '', p[2], p[3], p[4], p[5], p[6], p[7]) 
-    tree.Draw(p[0]+">>hh", TCut(cut))
-    nentries  = int(hh.GetEntries())    
-    return nentries
+## Number of events passing a cut. Every cut below shares terms with the others, the engine evaluates each term only once
+def get_events(engine, cut):
+    return engine.count(cut)
 
 ## Functions that just return cuts
 
@@ -62,38 +60,39 @@ def fiber_and_position(testfile, df, y_pos_cut, rit):
     fiber_cut = "("+fiber_cut_tmp.format(0,dfibers)+' || '+fiber_cut_tmp.format(1,dfibers)+")"
     x_pos_cut = 4                                                                           # 1/2 the x-sidelength of the position cut (in mm)
     x_center, y_center = rit.find_target_center()
-    position_cut = "(fabs( X-{0} )<{1}) && (fabs( Y-{2} )<{3})".format(x_center, x_pos_cut, y_center, y_pos_cut)
-    return fiber_and_position
+    position_cut = "(fabs( X[0]-{0} )<{1}) && (fabs( Y[0]-{2} )<{3})".format(x_center, x_pos_cut, y_center, y_pos_cut)
+    return fiber_cut+" && "+position_cut
 def fiber(df):  # df is how many fibers it can differ from 2. 
     return " fabs(nFibresOnX[0]-2)<={0} && fabs(nFibresOnY[0]-2)<={0} ".format(df)
 def clock(rit):
-    xtal = rit.get_xtals()
+    xtal = rit.xtal
     return " time_maximum[{}]==time_maximum[{}] ".format(xtal[0],xtal[1])
 def position(poscut, rit):
     x_center, y_center = rit.find_target_center()
     return " (fabs(X[0]-{:.4f})<4) && (fabs(Y[0]-{:.4f})<{}) ".format(float(x_center), float(y_center), poscut)
 def amp(ampmax, rit):
-    xtal = rit.get_xtals()
-    ampbias = rit.amp_calibration_coeff()
+    xtal = rit.xtal
+    ampbias = rit.ampbias
     return " amp_max[{}]>{} && {:.4f}*amp_max[{}]>{} ".format(xtal[0],ampmax,float(ampbias),xtal[1],ampmax)
 def dampl(dampcut, rit):
-    xtal = rit.get_xtals()
-    ampbias = rit.amp_calibration_coeff()
+    xtal = rit.xtal
+    ampbias = rit.ampbias
     return " fabs(fit_ampl[{}]-{:.4f}*fit_ampl[{}] )<{} ".format(xtal[0], float(ampbias), xtal[1], dampcut)
 
 def main():
 
     print 'IM ALIVE'
-    gROOT.ProcessLine("gErrorIgnoreLevel = kError;")    # Surpress info messages below Error or Fatal levels (IE info or warning)
-    gROOT.SetBatch(kTRUE)                               # Don't actually display the canvases from .Draw(...)
+    ROOT.gROOT.ProcessLine("gErrorIgnoreLevel = kError;")   # Surpress info messages below Error or Fatal levels (IE info or warning)
+    ROOT.gROOT.SetBatch(ROOT.kTRUE)                         # Don't actually display the canvases from .Draw(...)
 
     args = input_arguments()
 
     ft       = FileTools.FileTools(args)
     savepath = ft.output_location()
-    path     = '/eos/user/m/mplesser/timing_resolution/batch_ntuples/ECAL_H4_June2018_'+args.freq+'_'+args.temp+'_EScan_edges/compiled_roots/'
-    testfile = [path+'ECAL_H4_June2018_'+args.freq+'_'+args.temp+'_'+args.e+'_'+args.pos+'.root', args.e+'_'+args.pos]
-    rit      = RunInfoTools.RunInfoTools(args, savepath, testfile)
+    if args.f is not None: testfile = [args.f, args.e+'_'+args.pos]
+    else:                  testfile = [ft.defaultanalysispath+args.name+'_'+args.freq+'_'+args.temp+'_'+args.e+'_'+args.pos+'.root', args.e+'_'+args.pos]
+    rit      = RunInfoTools(RunContext.RunContext(args, savepath, testfile))
+    engine   = rit.cut_engine()
     
     # Custom cuts used in CutBatchAnalysis.py
     # Note: no linear correction because that isn't actually a cut!
@@ -144,7 +143,7 @@ def main():
    
     nevents_by_cut = [0]*len(cuts)
     for i in range(len(cuts)):
-        nevents_by_cut[i] = get_events(testfile,cuts[i])
+        nevents_by_cut[i] = get_events(engine,cuts[i])
 
     print
     print "Cut efficiency summary for "+args.freq+'/'+args.temp+' '+args.e+' at '+args.pos
@@ -6,10 +6,17 @@ import os
 import sys
 import signal
 import argparse
-from ROOT import *
-
+import multiprocessing
 from utilities import FileTools
 from utilities import RunInfoTools
+from utilities import RunContext
+from utilities import CenterCache
+from utilities import ResultsStore
+from utilities import RootLoader
+from utilities import Profiler
+from utilities import OutputWriter
+from utilities import Readers
+from utilities.RootLoader import ROOT                   # ROOT is only imported when first used
 from utilities import PlotterTools
 from utilities import AnalysisTools
 
@@ -25,7 +32,7 @@ def print_lines(nlines=1):
     for i in range(nlines): print '#'*int(os.popen('stty size', 'r').read().split()[1]) 
     print '\n'
 
-def input_arguments():
+def input_arguments(argv=None):
     parser = argparse.ArgumentParser(description='Control plotting and cuts for inter-crystal time resolution studies')
     
     parser.add_argument('-d'  ,    type=str,                                                     help='Use all the files in the given directory for analysis ')
@@ -34,13 +41,28 @@ def input_arguments():
     parser.add_argument('--freq',  type=str,                        default='160MHz'  ,          help='Sampling frequency,   IE "160MHz" or "120 MHz"')
     parser.add_argument('--temp',  type=str,                        default='18deg'   ,          help='Sampling temperature, IE "18deg"  or "9deg"')
     parser.add_argument('--name',  type=str,                        default='ECAL_H4_Oct2018',   help='Name prefix')
+    parser.add_argument('--cache', type=str,                        default=None,                help='Directory for the columnar event cache (default ~/.dtplotter_cache/)')
+
+    parser.add_argument('--stream',type=int,                        default=0,                   help='Go through the events in chunks of this many (rounded up to 65536s), bounding memory. 0 = whole file at once')
+    parser.add_argument('--config',type=str,                        default=None,                help='Name of this configuration in the results store, IE "baseline" (default: built from the cut/fit options)')
+    parser.add_argument('--cc', '--clearcenters', action='store_true',                           help='Forget the memoized target centers of the selected files and find them again')
 
     parser.add_argument('-x'  ,             action='store_true',                                 help='Create plots for fit_chi2[C3] and fit_chi2[<2nd xtal>]')
     parser.add_argument('-a'  ,             action='store_true',                                 help='Create effective voltage (Aeff) plot')
     parser.add_argument('-r'  ,             action='store_true',                                 help='Create resolution versus  Aeff  plot')
     
     parser.add_argument('-q'   ,            action='store_true',                                 help='Use a quantile method for the resolution versus Aeff plot')
+    parser.add_argument('--qs', '--quantstrategy', type=str, default='hybrid',                   help='Aeff binning with -q: hybrid (quantiles below Aeff 400, fixed above), equal (equal statistics) or mincount')
+    parser.add_argument('--ms', '--minslice', type=int,     default=100,                         help='Minimum events per Aeff slice for --qs mincount (the dcb slice fit needs 100, gaus 50)')
     parser.add_argument('--fit',            action='store_true',                                 help='Fit using a user function the resolution versus Aeff plot')
+    parser.add_argument('--rf', '--resfit',  type=str,      default='minuit',                    help='Resolution fit method: minuit (random restarts), linear (closed form), linear_minuit (closed form + Minuit refinement) or unbinned (per-event likelihood)')
+    parser.add_argument('--um', '--unbinnedmean', type=str, default='walk',                      help='dt mean model for --rf unbinned: walk (mu0 + mu1/Aeff) or const')
+    parser.add_argument('--ut', '--unbinnedtail', action='store_true',                           help='Add a flat tail component to the --rf unbinned fit')
+    parser.add_argument('--ft', '--fittype', type=str,      default='gaus',                      help='Slice fit for the resolution plot: gaus, dcb (Minuit, per slice) or gaus_batch, dcb_batch (vectorized)')
+    parser.add_argument('--fw', '--fitworkers', type=int,   default=1,                           help='Worker processes for the slice fits in fit_y_slices (1 = serial, 0 = all cores)')
+    parser.add_argument('--output',          type=str,      default='files',                     help='Saved plots: files (one .root per plot), container (one <energy>_<position>_outputs.root per file) or both')
+    parser.add_argument('--profile',         action='store_true',                                 help='Time each stage (wall, CPU, peak memory, draws and events) and write <savepath>profile.json')
+    parser.add_argument('-j', '--jobs',      type=int,      default=1,                           help='Analyze this many files at once, one process each (1 = serial, 0 = all cores)')
 
     parser.add_argument('--xb',             action='store',         default='100,-5,1000',       help='Chi2  plot bounds, "nbins,chi2min,chi2max"')
     parser.add_argument('--rb',             action='store',         default='20,0,1400,200,-2,2',help='Res.  plot bounds, "nbins1,Aeffmin,Aeffmax,nbins2,dtmin,dtmax"')
@@ -50,115 +72,230 @@ def input_arguments():
     parser.add_argument('--da', '--dampl'  ,action='store',         default='1e9'   ,            help='dampl cut, max allowed difference in fit_ampl between xtals')
     parser.add_argument('--pc', '--poscut' ,action='store',         default='5,5',               help='Position cut, 1/2 side-length of a square around target center to accept')
     parser.add_argument('--lc', '--lincorr',action='store_true',    default=False,               help='Use a linear correction to counter the "walking mean" effect')
+    parser.add_argument('--mc', '--mapcorr',action='store_true',    default=False,               help='Correct dt with a 2D map of the mean dt vs position (x,y), saved per freq/temp/position. Replaces --lc')
+    parser.add_argument('--mr', '--mapremake',action='store_true',  default=False,               help='With --mc, build the map again from this file instead of using the saved one')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if   (args.freq == '160') or (args.freq == '160MHz'): args.freq = '160MHz'      # Ensures consistent formatting 
     elif (args.freq == '120') or (args.freq == '120MHz'): args.freq = '120MHz'      # IE does the user enter '120', or '120MHz'?
     if   (args.temp == '18' ) or (args.temp == '18deg' ): args.temp = '18deg'       # Resolve it either way 
     elif (args.temp == '9'  ) or (args.temp == '9deg'  ): args.temp = '9deg'        # blahblah licht mehr licht
 
-    if len(sys.argv[1:])==0:                                                        # Print help if no options given    
+    if args.jobs == 0: args.jobs = multiprocessing.cpu_count()                      # 0 means use every core
+
+    if len(sys.argv[1:] if argv is None else argv)==0:                              # Print help if no options given    
         parser.print_help()
         sys.exit("\n")
 
     return args
 
-def main():
+## Full analysis of one file: centers, cuts, plots and fits. Returns a summary of the results for the end-of-run table
+## The RunContext holds what doesn't depend on the cut/plot options (file handles, cut engine, target centers, chi2 bounds).
+## Passing the same context to later runs on the same file (IE CutBatchAnalysis.py --inprocess) skips that work
+@Profiler.profiled('analyze file')
+def analyze_file(args, savepath, f, context=None):
+
+    summary = {'file': f[0], 'tag': f[1], 'entries': None, 'resolution': None}
+    ft      = FileTools.FileTools(args)
+    output  = ft.open_output(savepath, f[1])               # Everything this file saves is staged locally, and uploaded once at the end
+
+    print_lines(2)
+    print "File:", f[0]
+    print_lines()        
+
+    if context is None:
+        with Profiler.stage('file open'): context = RunContext.RunContext(args, savepath, f)    # Opens the file once, all the tools share it
+    context.configure(args, savepath)
+    rit     = RunInfoTools(context)
+    engine  = context.cut_engine()                          # Reads the needed h4 branches once, cuts and plots are evaluated on the cached columns
+    rit.find_target_center()
+    print_lines()
+    rit.start_log_file()
+
+    at    = AnalysisTools(context)                          # Class with tools for analysis. Mainly adjustments
+    pt    = PlotterTools(context)                           # Class with tools for plotting
+    Cuts  = pt.define_cuts()                                # Get the cuts for the relevant plots, flagged in args
+    Plots = pt.define_plots()                               # Get what plots are desired, flagged in args
+    for i in xrange(len(Plots)):                            # For each plot of interest
+
+            cut = Cuts[i]                                   # Cuts for the current plot of interest
+            p   = Plots[i]                                  # Plotting info, what to plot, what bounds, etcetc
+
+            if len(p)==5:   # -x and -a options are for TH1F, and require 5 params 
+
+                ## Create the desired plot
+                h = ROOT.TH1F('h', f[1]+'_'+p[1], p[2], p[3], p[4])  
+                engine.draw(h, p[0])
+                nentries_precut  = int(h.GetEntries()) 
+                engine.draw(h, p[0], cut)
+                nentries_postcut = int(h.GetEntries()) 
+                
+                h.GetXaxis().SetTitle(p[1])
+                print "Number of entries pre-cuts:  {0}".format(nentries_precut)
+                print "Number of entries post-cuts: {0}".format(nentries_postcut)
+                print "Cut efficiency:              {0:.2f}%".format(100.*nentries_postcut/nentries_precut)
+
+                ## Save plots
+                ft.save_files(h, savepath, f[1], '_'+p[1])
+
+            if len(p)==8:   # -r is for a TH2F and requires 8 params
+                
+                print_lines()
+
+                ## Use a linear adjustment to account for the "walking-mean" effect resulting from largely uneven Aeff's
+                ## Or, with --mc, a correction map against both position coordinates, which also follows the gap
+                if args.mc == True:
+                    print "Applying dt correction map..."
+                    p[0] = at.dt_map_correction()
+                    print_lines()
+                elif args.lc == True: 
+                    print "Applying linear correction..."
+                    p[0] = at.dt_linear_correction(cut)
+                    print_lines()
+
+                # Create the color map
+                hh = pt.make_color_map(p,'')
+                engine.draw(hh, p[0])
+                nentries_precut   = int(hh.GetEntries())
+                hh = pt.make_color_map(p, cut)
+                engine.draw(hh, p[0], cut)
+                nentries_postcut  = int(hh.GetEntries())    
+                summary['entries'] = [nentries_precut, nentries_postcut]
+
+                print "Number of entries pre-cuts:  {0}".format(nentries_precut)
+                print "Number of entries post-cuts: {0}".format(nentries_postcut)
+                print "Cut efficiency:              {0:.2f}%".format(100.*nentries_postcut/nentries_precut)
+
+                # Create the resolution versus Aeff plot
+                hh_2 = at.fit_y_slices(hh, fit_type=args.ft, adjust_bins=True)[1]            # Supports 'dcb'(double xtal ball), 'gaus' and their '_batch' versions. [0] is mean_fit, [1] is res_fit
+                hh_2.SetTitle(f[1]+'_dt_resolution_vs_aeff')                    
+
+                # Fit the plot using a user-defined function
+                if args.fit == True: summary['resolution'] = at.fit_resolution(hh_2, p=p, cut=cut)
+
+                # Save plots
+                ft.save_files(hh,   savepath, f[1], '_dt_vs_aeff_heatmap')
+                ft.save_files(hh_2, savepath, f[1], '_resolution_vs_aeff')
+
+                # Add to the log file
+                with open(rit.logfile, 'a') as logfile:
+                    logfile.write("\nNumber of entries ( hh.GetEntries() ):\n\tpre-cuts:\n")
+                    logfile.write("\t\t" + str(nentries_precut)  + '\n')    
+                    logfile.write("\t\t" + str(nentries_postcut) + '\n')
+
+    output.finish()                                         # Uploads in the background while the next file is analyzed
+    return summary
+
+## Pool worker for --jobs. sys.exit() inside a pool worker would kill it and hang the pool, so failures are returned instead
+## With --profile the worker's stage totals for this file are sent back with the summary, see main()
+def analyze_file_task(task):
+    args, savepath, f = task
+    Profiler.reset()
+    try:
+        summary = analyze_file(args, savepath, f)
+    except (Exception, SystemExit) as e:
+        print "\nAnalysis of {} failed: {}".format(f[0], e)
+        summary = {'file': f[0], 'tag': f[1], 'entries': None, 'resolution': None, 'error': str(e)}
+        OutputWriter.finish_active(savepath)                # Plots saved before the failure, this may be the worker's last file
+    with Profiler.stage('saving'): OutputWriter.flush()   # The worker's uploads are done before it reports back
+    summary['profile'] = Profiler.snapshot()
+    return summary
+
+## --jobs: the ROOT macros the files need are compiled (by ACLiC, into the cache) once here, before the pool starts.
+## Workers inherit the loaded libraries, instead of each compiling the same macro into the same directory at once on a cold cache
+def prepare_libraries(args, Files):
+    builddir = FileTools.FileTools(args).cache_location()
+    if args.ft == 'dcb': RootLoader.load_dcb(builddir)
+    for f in Files:
+        reader = Readers.open_reader(f[0], builddir)
+        if isinstance(reader, Readers.RootReader) and reader.synthetic():
+            RootLoader.load_synthetic_h4(builddir)
+            break
+
+## --mc with --jobs: each position's dt correction map is built (or checked) once here, from the position's first file, before the pool starts.
+## Workers then load it instead of each building its own and the last save winning. A worker whose center doesn't match uses its own map, unsaved
+def prepare_correction_maps(args, savepath, Files):
+    first = {}
+    for f in sorted(Files): first.setdefault(f[1].split('_')[-1], f)
+    for position, f in sorted(first.items()):
+        print_lines()
+        print "dt correction map for {}, from {}".format(position, f[0])
+        context = RunContext.RunContext(args, savepath, f)
+        rit     = RunInfoTools(context)
+        rit.find_target_center()                            # Memoized, the worker of this file finds it again for free
+        PlotterTools(context).define_cuts()                 # The map needs the named track, clock and chi2 cuts
+        AnalysisTools(context).dt_map_correction(save=True)
+    args.mr = False                                         # Remade above if asked, the workers use these maps
+
+## One line per file: entries from the resolution plot and the resolution fit results
+def print_summary(summaries):
+    print_lines()
+    print "Summary:"
+    print "\t{:<24}{:>12}{:>12}{:>22}{:>12}".format('File', 'Pre-cuts', 'Post-cuts', 'Constant term (ps)', 'Red. chi2')
+    for s in sorted(summaries, key=lambda x: x['tag']):
+        if 'error' in s:
+            print "\t{:<24}FAILED: {}".format(s['tag'], s['error'])
+            continue
+        pre, post = s['entries'] if s['entries'] is not None else ['-', '-']
+        cterm     = '{:.2f} +- {:.2f}'.format(s['resolution'][0], s['resolution'][1]) if s['resolution'] is not None else '-'
+        red_chi2  = s['resolution'][4] if s['resolution'] is not None else '-'
+        if isinstance(red_chi2, float): red_chi2 = '{:.3f}'.format(red_chi2)
+        print "\t{:<24}{:>12}{:>12}{:>22}{:>12}".format(s['tag'], pre, post, cterm, red_chi2)
+
+## Global ROOT settings, batch mode and quiet
+def root_setup():
     ## Stats box parameters
-    #gStyle.SetOptStat(0)                               # No stat box 
-    gStyle.SetStatY(0.9)                                # Y-position (fraction of pad size)                
-    gStyle.SetStatX(0.9)                                # X-position         
-    gStyle.SetStatW(0.2)                                # Width           
-    gStyle.SetStatH(0.1)                                # Height
-    gROOT.SetBatch(kTRUE)                               # Don't show graphics 
-    gROOT.ProcessLine("gErrorIgnoreLevel = kError;")    # Surpress info messages below Error or Fatal levels (IE info or warning)
-
-    args = input_arguments()
+    #ROOT.gStyle.SetOptStat(0)                              # No stat box 
+    ROOT.gStyle.SetStatY(0.9)                               # Y-position (fraction of pad size)                
+    ROOT.gStyle.SetStatX(0.9)                               # X-position         
+    ROOT.gStyle.SetStatW(0.2)                               # Width           
+    ROOT.gStyle.SetStatH(0.1)                               # Height
+    ROOT.gROOT.SetBatch(ROOT.kTRUE)                         # Don't show graphics 
+    ROOT.gROOT.ProcessLine("gErrorIgnoreLevel = kError;")   # Surpress info messages below Error or Fatal levels (IE info or warning)
+
+def main():
+    args = input_arguments()                            # Before ROOT is imported, so --help etc. are instant
+    if args.profile == True: Profiler.enable()
+    root_setup()
     print_lines(2)
 
     ## Class for defining save path and finding analysis files. Also has "save_files" fn   
     ft        = FileTools.FileTools(args)                        
     savepath  = ft.output_location()
     Files     = ft.analysis_path()
-    for f in Files:
-
-        print_lines(2)
-        print "File:", f[0]
-        print_lines()        
-
-        rit     = RunInfoTools(args, savepath, f)
-        centers = rit.find_target_center()
-        print_lines()
-        rit.start_log_file()
-
-        at    = AnalysisTools(args, savepath, f, centers)       # Class with tools for analysis. Mainly adjustments
-        pt    = PlotterTools(args, savepath, f, centers)        # Class with tools for plotting
-        Cuts  = pt.define_cuts()                                # Get the cuts for the relevant plots, flagged in args
-        Plots = pt.define_plots()                               # Get what plots are desired, flagged in args
-        for i in xrange(len(Plots)):                            # For each plot of interest
-
-                cut = Cuts[i]                                   # Cuts for the current plot of interest
-                p   = Plots[i]                                  # Plotting info, what to plot, what bounds, etcetc
-
-                tfile = TFile(f[0])
-                tree  = tfile.Get("h4")
-
-                if len(p)==5:   # -x and -a options are for TH1F, and require 5 params 
-
-                    ## Create the desired plot
-                    h = TH1F('h', f[1]+'_'+p[1], p[2], p[3], p[4])  
-                    tree.Draw(p[0]+'>>h')
-                    nentries_precut  = int(h.GetEntries()) 
-                    tree.Draw(p[0]+'>>h', TCut(cut))
-                    nentries_postcut = int(h.GetEntries()) 
-                    
-                    h.GetXaxis().SetTitle(p[1])
-                    print "Number of entries pre-cuts:  {0}".format(nentries_precut)
-                    print "Number of entries post-cuts: {0}".format(nentries_postcut)
-                    print "Cut efficiency:              {0:.2f}%".format(100.*nentries_postcut/nentries_precut)
-
-                    ## Save plots
-                    ft.save_files(h, savepath, f[1], '_'+p[1])
-
-                if len(p)==8:   # -r is for a TH2F and requires 8 params
-                    
-                    print_lines()
 
-                    ## Use a linear adjustment to account for the "walking-mean" effect resulting from largely uneven Aeff's
-                    if args.lc == True: 
-                        print "Applying linear correction..."
-                        p[0] = at.dt_linear_correction(tree,cut)
-                        print_lines()
-
-                    # Create the color map
-                    hh = pt.make_color_map(p,'',tree)
-                    tree.Draw(p[0]+">>hh", "", "COLZ")
-                    nentries_precut   = int(hh.GetEntries())
-                    hh = pt.make_color_map(p, cut, tree)
-                    tree.Draw(p[0]+">>hh", TCut(cut), "COLZ")
-                    nentries_postcut  = int(hh.GetEntries())    
-
-                    print "Number of entries pre-cuts:  {0}".format(nentries_precut)
-                    print "Number of entries post-cuts: {0}".format(nentries_postcut)
-                    print "Cut efficiency:              {0:.2f}%".format(100.*nentries_postcut/nentries_precut)
-
-                    # Create the resolution versus Aeff plot
-                    hh_2 = at.fit_y_slices(hh, fit_type="gaus", adjust_bins=True)[1]             # Supports 'dcb'(double xtal ball) and 'gaus'. [0] is mean_fit, [1] is res_fit
-                    hh_2.SetTitle(f[1]+'_dt_resolution_vs_aeff')                    
-
-                    # Fit the plot using a user-defined function
-                    if args.fit == True: at.fit_resolution(hh_2)
-
-                    # Save plots
-                    ft.save_files(hh,   savepath, f[1], '_dt_vs_aeff_heatmap')
-                    ft.save_files(hh_2, savepath, f[1], '_resolution_vs_aeff')
-
-                    # Add to the log file
-                    with open(savepath+f[1].split('_')[-1]+'_log.txt', 'a') as logfile:
-                        logfile.write("\nNumber of entries ( hh.GetEntries() ):\n\tpre-cuts:\n")
-                        logfile.write("\t\t" + str(nentries_precut)  + '\n')    
-                        logfile.write("\t\t" + str(nentries_postcut) + '\n')
+    if args.cc == True:                                 # Invalidate the center memo, centers are then found (and memoized) again below
+        memo = CenterCache.CenterCache(ft.cache_location())
+        for f in Files: print "Cleared {} memoized center(s) for {}".format(memo.invalidate(f[0]), f[0])
+
+    if (args.jobs > 1) and (len(Files) > 1):
+        ## Each file in its own process. Files are independent, and each writes its own log (see FileTools.log_location)
+        if args.fw != 1:
+            print "--fw ignored with --jobs, pool workers can't start their own pools"
+            args.fw = 1
+        prepare_libraries(args, Files)
+        if args.mc == True: prepare_correction_maps(args, savepath, Files)
+        pool      = multiprocessing.Pool(min(args.jobs, len(Files)))
+        summaries = pool.map_async(analyze_file_task, [(args, savepath, f) for f in Files]).get(9999999)   # A timeout lets Ctrl-C through to the parent
+        pool.close()
+        pool.join()
+        ft.merge_logs(savepath, Files)
+        for s in summaries: Profiler.merge(s.pop('profile'))   # Stage totals over every worker
+    else:
+        args.jobs = 1                                   # Logs go straight to <position>_log.txt
+        summaries = []
+        try:
+            for f in Files: summaries.append(analyze_file(args, savepath, f))
+        finally:
+            OutputWriter.finish_active(savepath)        # A failed file's plots are uploaded before the error stops the run
+            with Profiler.stage('saving'): OutputWriter.flush()
+
+    print_summary(summaries)
+    RootLoader.report()
+    if args.profile == True:
+        Profiler.print_report()
+        Profiler.write_report(savepath + 'profile.json', {'argv': sys.argv[1:], 'files': [f[0] for f in Files], 'jobs': args.jobs, 'root_timings': RootLoader.timings})
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import json
+import math
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))     # Run from anywhere, like DtPlotter.py
+import DtPlotter
+from utilities import CutEngine
+
+'''
+    Micro-benchmarks of the hot paths of AnalysisTools, PlotterTools and RunInfoTools, on a synthetic file (see synthetic_h4.py).
+    Every benchmark is run -n times after a warm-up. Each run starts from a fresh cut engine (no cached masks or values, the columns
+    themselves stay memory-mapped), so every sample does the same work.
+    The samples are saved per commit in <cache>/benchmarks/<commit>.json and compared with a baseline (--set-baseline, or any saved commit):
+    a benchmark is flagged when its median changed by more than --threshold and a Mann-Whitney U test on the samples gives p < --alpha.
+    IE: python benchmarks/hotpaths.py --set-baseline            (on the reference commit)
+        python benchmarks/hotpaths.py                           (later, compares with the baseline)
+        python benchmarks/hotpaths.py -b 1b8860a --only fit_y_slices
+'''
+
+## Events in the synthetic file made when -f isn't given
+DEFAULT_EVENTS = 200000
+
+def input_arguments():
+    parser = argparse.ArgumentParser(description='Time the hot paths of DtPlotter and compare with a baseline')
+    parser.add_argument('-f',               type=str,   default=None,           help='Synthetic (or real) file to use (default: made with synthetic_h4.py in the cache)')
+    parser.add_argument('-n',               type=int,   default=7,              help='Timed runs per benchmark')
+    parser.add_argument('-w', '--warmup',   type=int,   default=1,              help='Untimed runs per benchmark first')
+    parser.add_argument('-b', '--baseline', type=str,   default='baseline',     help='Compare with this saved commit (or "baseline", the one saved with --set-baseline)')
+    parser.add_argument('--only',           type=str,   default=None,           help='Only the benchmarks whose name contains one of these, comma separated')
+    parser.add_argument('--set-baseline',   action='store_true',                help='Also save the results as the baseline')
+    parser.add_argument('--nosave',         action='store_true',                help="Don't save the results")
+    parser.add_argument('--threshold',      type=float, default=0.05,           help='Relative change of the median to flag')
+    parser.add_argument('--alpha',          type=float, default=0.05,           help='Significance level of the Mann-Whitney U test')
+    parser.add_argument('--events',         type=int,   default=DEFAULT_EVENTS, help='Events in the synthetic file, if it has to be made')
+    parser.add_argument('--freq',           type=str,   default='160MHz',       help='Sampling frequency,   IE "160MHz" or "120 MHz"')
+    parser.add_argument('--temp',           type=str,   default='18deg',        help='Sampling temperature, IE "18deg"  or "9deg"')
+    parser.add_argument('--cache',          type=str,   default=None,           help='Directory for the columnar event cache (default ~/.dtplotter_cache/)')
+    return parser.parse_args()
+
+## Commit of the working tree, with '-dirty' if it has uncommitted changes
+def current_commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here).strip()
+        dirty  = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty != '' else '')
+
+## Two-sided Mann-Whitney U test, normal approximation with the tie correction. Returns the p-value
+## Makes no assumption on the shape of the timing distributions, which are usually skewed (a few slow runs)
+def mann_whitney(a, b):
+    n1, n2 = len(a), len(b)
+    values = np.concatenate([a, b])
+    order  = np.argsort(values, kind='mergesort')
+    ranks  = np.empty(len(values))
+    ranks[order] = np.arange(1, len(values)+1)
+    for v in np.unique(values):                                                     # Average ranks of ties
+        tied = values == v
+        if np.count_nonzero(tied) > 1: ranks[tied] = ranks[tied].mean()
+    u      = ranks[:n1].sum() - n1*(n1+1)/2.
+    counts = np.unique(values, return_counts=True)[1]
+    n      = n1 + n2
+    var    = n1*n2/12. * ((n+1) - (counts**3 - counts).sum()/float(n*(n-1)))
+    if var <= 0: return 1.
+    z      = (abs(u - n1*n2/2.) - 0.5) / math.sqrt(var)                              # With continuity correction
+    return math.erfc(max(z, 0.)/math.sqrt(2))
+
+def summarize(samples):
+    s = np.asarray(samples)
+    return {'median': float(np.median(s)), 'mean': float(s.mean()), 'std': float(s.std()), 'min': float(s.min()),
+            'iqr': float(np.percentile(s, 75) - np.percentile(s, 25))}
+
+## The synthetic file to benchmark on, made the first time
+def benchmark_file(bench_args, ft):
+    if bench_args.f is not None: return bench_args.f
+    outdir   = ft.synthetic_location()
+    filename = outdir + 'BENCH_{}_{}_compiled_C3up.root'.format(bench_args.freq, bench_args.temp)
+    if os.path.exists(filename) == False:
+        synthetic = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'synthetic_h4.py')
+        subprocess.check_call([sys.executable, synthetic, '-n', str(bench_args.events), '-o', outdir, '--name', 'BENCH', '--seed', '1',
+                               '--freq', bench_args.freq, '--temp', bench_args.temp] + (['--cache', bench_args.cache] if bench_args.cache is not None else []))
+    return filename
+
+## Everything the benchmarks need, built once: the context (file, cached columns, centers), cuts, the color map and the resolution graph
+class Setup:
+
+    def __init__(self, args, savepath, f):
+        self.context   = DtPlotter.RunContext.RunContext(args, savepath, f)
+        self.context.cut_engine()
+        DtPlotter.RunInfoTools(self.context).find_target_center()
+        DtPlotter.RunInfoTools(self.context).start_log_file()
+        pt             = DtPlotter.PlotterTools(self.context)
+        self.cut       = pt.define_cuts()[-1]
+        self.plot      = pt.define_plots()[-1]
+        self.hh        = self.color_map(False)
+        self.graphs    = DtPlotter.AnalysisTools(self.context).fit_y_slices(self.hh, 'gaus', adjust_bins=False, n_workers=1)
+
+    ## Drop everything the cut engine cached (masks, values, derived columns) and the chi2 bounds. The columns stay mapped
+    def fresh(self):
+        engine                   = self.context.engine
+        self.context.engine      = CutEngine.CutEngine(engine.cache, engine.chunk_size)
+        self.context.chi2_bounds = None
+
+    def color_map(self, quantiles):
+        self.context.args.q = quantiles
+        pt = DtPlotter.PlotterTools(self.context)
+        hh = pt.make_color_map(self.plot, self.cut)
+        self.context.engine.draw(hh, self.plot[0], self.cut)
+        return hh
+
+## name -> function of the Setup, returning the call to time. Anything done before returning isn't timed
+def benchmarks():
+    def fit_y_slices(fit_type):
+        def prepare(s):
+            s.fresh()
+            at = DtPlotter.AnalysisTools(s.context)
+            return lambda: at.fit_y_slices(s.hh, fit_type, adjust_bins=False, n_workers=1)
+        return prepare
+
+    def adjust_bin_centers(s):
+        s.fresh()
+        at = DtPlotter.AnalysisTools(s.context)
+        return lambda: at.adjust_bin_centers(*s.graphs)
+
+    def dt_linear_correction(s):
+        s.fresh()
+        at = DtPlotter.AnalysisTools(s.context)
+        return lambda: at.dt_linear_correction(s.cut)
+
+    def dt_map_correction(s):                                                       # Building the map, not loading a saved one
+        s.fresh()
+        s.context.args.mr = True
+        DtPlotter.PlotterTools(s.context).define_cuts()                             # The map's named cuts, on the fresh engine
+        at = DtPlotter.AnalysisTools(s.context)
+        return at.dt_map_correction
+
+    def fit_resolution(method):
+        def prepare(s):
+            at = DtPlotter.AnalysisTools(s.context)
+            gr = s.graphs[1].Clone()                                                # Fit attaches the function to the graph, use a new one each time
+            return lambda: at.fit_resolution(gr, method, s.plot, s.cut)
+        return prepare
+
+    def chi2_range_sweep(s):                                                        # define_cuts() with no saved chi2 bounds: the sweep, plus building the cuts
+        s.fresh()
+        pt = DtPlotter.PlotterTools(s.context)
+        return pt.define_cuts
+
+    def make_color_map(quantiles):
+        def prepare(s):
+            s.fresh()
+            return lambda: s.color_map(quantiles)
+        return prepare
+
+    def find_target_center(s):                                                      # The center finding itself, not the memo lookup
+        s.fresh()
+        rit = DtPlotter.RunInfoTools(s.context)
+        return rit.compute_target_center
+
+    return [ ['fit_y_slices[gaus]',         fit_y_slices('gaus')       ],
+             ['fit_y_slices[dcb]',          fit_y_slices('dcb')        ],
+             ['fit_y_slices[gaus_batch]',   fit_y_slices('gaus_batch') ],
+             ['fit_y_slices[dcb_batch]',    fit_y_slices('dcb_batch')  ],
+             ['adjust_bin_centers',         adjust_bin_centers         ],
+             ['dt_linear_correction',       dt_linear_correction       ],
+             ['dt_map_correction',          dt_map_correction          ],
+             ['fit_resolution[minuit]',     fit_resolution('minuit')   ],
+             ['fit_resolution[linear]',     fit_resolution('linear')   ],
+             ['fit_resolution[unbinned]',   fit_resolution('unbinned') ],
+             ['chi2_range_sweep',           chi2_range_sweep           ],
+             ['make_color_map[fixed]',      make_color_map(False)      ],
+             ['make_color_map[quantile]',   make_color_map(True)       ],
+             ['find_target_center',         find_target_center         ] ]
+
+## Samples (seconds) of one benchmark. Output of the benchmarked code is hidden, it would swamp the table
+def run_benchmark(setup, prepare, n, warmup):
+    samples = []
+    devnull = open(os.devnull, 'w')
+    for i in range(warmup + n):
+        call       = prepare(setup)
+        sys.stdout = devnull
+        try:
+            start   = time.time()
+            call()
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = sys.__stdout__
+        if i >= warmup: samples.append(elapsed)
+    devnull.close()
+    return samples
+
+def load_results(benchdir, ref):
+    filename = benchdir + ref + '.json'
+    if os.path.exists(filename) == False:
+        matches = [x for x in os.listdir(benchdir) if x.startswith(ref) and x.endswith('.json')] if os.path.exists(benchdir) else []
+        if len(matches) != 1: return None
+        filename = benchdir + matches[0]
+    with open(filename, 'r') as f: return json.load(f)
+
+def save_results(benchdir, name, results):
+    if os.path.exists(benchdir) == False: os.makedirs(benchdir)
+    with open(benchdir + name + '.json.tmp', 'w') as f: json.dump(results, f, indent=1, sort_keys=True)
+    os.rename(benchdir + name + '.json.tmp', benchdir + name + '.json')
+    print "Results saved to {}".format(benchdir + name + '.json')
+
+def print_table(results, baseline, bench_args):
+    print
+    print "Hot path timings for {} ({} runs each), compared with {}:".format(results['commit'], bench_args.n, baseline['commit'] if baseline is not None else 'nothing')
+    print "\t{:<28}{:>12}{:>12}{:>14}{:>9}{:>10}  {}".format('Benchmark', 'Median (s)', 'IQR (s)', 'Base med. (s)', 'Ratio', 'p', 'Status')
+    flagged = 0
+    for name, bench in results['benchmarks'].items():
+        stats = bench['stats']
+        line  = "\t{:<28}{:>12.4f}{:>12.4f}".format(name, stats['median'], stats['iqr'])
+        if (baseline is None) or (name not in baseline['benchmarks']):
+            print line + "{:>14}{:>9}{:>10}  {}".format('-', '-', '-', 'new')
+            continue
+        base   = baseline['benchmarks'][name]
+        ratio  = stats['median'] / base['stats']['median'] if base['stats']['median'] > 0 else float('inf')
+        p      = mann_whitney(bench['samples'], base['samples'])
+        status = '~'
+        if (p < bench_args.alpha) and (ratio > 1 + bench_args.threshold): status = 'SLOWER'
+        if (p < bench_args.alpha) and (ratio < 1 - bench_args.threshold): status = 'faster'
+        if status == 'SLOWER': flagged += 1
+        print line + "{:>14.4f}{:>9.3f}{:>10.3g}  {}".format(base['stats']['median'], ratio, p, status)
+    print "('SLOWER'/'faster': median changed by more than {:.0f}% and p < {})".format(100*bench_args.threshold, bench_args.alpha)
+    return flagged
+
+def main():
+    bench_args = input_arguments()
+
+    args     = DtPlotter.input_arguments(['--freq', bench_args.freq, '--temp', bench_args.temp, '-r', '--fit', '--config', 'benchmark'] + (['--cache', bench_args.cache] if bench_args.cache is not None else []))
+    ft       = DtPlotter.FileTools.FileTools(args)
+    args.f   = benchmark_file(bench_args, ft)
+    f        = ft.analysis_path()[0]
+    savepath = tempfile.mkdtemp(prefix='dtplotter_bench_') + '/'                  # Logs and saved plots of the benchmarked code, not kept
+    DtPlotter.root_setup()
+
+    print "Setting up on {}...".format(f[0])
+    sys.stdout = open(os.devnull, 'w')
+    try:     setup = Setup(args, savepath, f)
+    finally: sys.stdout = sys.__stdout__
+
+    results = {'commit': current_commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': socket.gethostname(), 'python': sys.version.split()[0],
+               'input': {'file': f[0], 'entries': setup.context.engine.cache.entries()}, 'n': bench_args.n, 'warmup': bench_args.warmup, 'benchmarks': OrderedDict()}
+    only    = bench_args.only.split(',') if bench_args.only is not None else None
+    for name, prepare in benchmarks():
+        if (only is not None) and not any(o in name for o in only): continue
+        print "Running {}...".format(name)
+        samples = run_benchmark(setup, prepare, bench_args.n, bench_args.warmup)
+        results['benchmarks'][name] = {'samples': samples, 'stats': summarize(samples)}
+
+    benchdir = ft.benchmark_location()
+    baseline = load_results(benchdir, bench_args.baseline)
+    flagged  = print_table(results, baseline, bench_args)
+    if bench_args.nosave == False: save_results(benchdir, results['commit'], results)
+    if bench_args.set_baseline:    save_results(benchdir, 'baseline', results)
+    if flagged > 0: sys.exit("\n{} benchmark(s) slower than {}".format(flagged, baseline['commit']))
+
+if __name__ == "__main__":
+    main()
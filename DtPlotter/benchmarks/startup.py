@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))     # Run from anywhere, like DtPlotter.py
+
+'''
+    Startup benchmark: per-file setup cost of a DtPlotter run, before any plotting.
+    Times the DtPlotter import, building the RunContext (ROOT import, file open, info tree), the column cache (libraries, if fitResult is read),
+    and then the tool classes built on it, which should cost next to nothing.
+    IE: python benchmarks/startup.py -f /path/to/ECAL_H4_Oct2018_160MHz_18deg_compiled_C3up.root
+'''
+
+def input_arguments():
+    parser = argparse.ArgumentParser(description='Time the per-file setup of DtPlotter')
+    parser.add_argument('-f',       type=str,   required=True,          help='File to set up (use the absolute path)')
+    parser.add_argument('-n',       type=int,   default=5,              help='Number of times to build the tool classes on one context')
+    parser.add_argument('--freq',   type=str,   default='160MHz',       help='Sampling frequency,   IE "160MHz" or "120 MHz"')
+    parser.add_argument('--temp',   type=str,   default='18deg',        help='Sampling temperature, IE "18deg"  or "9deg"')
+    parser.add_argument('--cache',  type=str,   default=None,           help='Directory for the columnar event cache (default ~/.dtplotter_cache/)')
+    return parser.parse_args()
+
+def timed(fn, *fn_args):
+    start  = time.time()
+    result = fn(*fn_args)
+    return result, time.time() - start
+
+def main():
+    bench_args = input_arguments()
+
+    start = time.time()
+    import DtPlotter
+    t_import = time.time() - start
+
+    args     = DtPlotter.input_arguments(['-f', bench_args.f, '--freq', bench_args.freq, '--temp', bench_args.temp, '-r'] + (['--cache', bench_args.cache] if bench_args.cache is not None else []))
+    ft       = DtPlotter.FileTools.FileTools(args)
+    savepath = ft.output_location()
+    f        = ft.analysis_path()[0]
+
+    context, t_context = timed(DtPlotter.RunContext.RunContext, args, savepath, f)
+    engine,  t_engine  = timed(context.cut_engine)
+    rit     = DtPlotter.RunInfoTools(context)
+    centers, t_centers = timed(rit.find_target_center)
+
+    t_tools = []
+    for i in range(bench_args.n):
+        start = time.time()
+        DtPlotter.RunInfoTools(context)
+        DtPlotter.AnalysisTools(context)
+        DtPlotter.PlotterTools(context)
+        t_tools.append(time.time() - start)
+
+    print
+    print "Startup timings for {}:".format(f[0])
+    print "\t{:<40}{:>10.3f} s".format('import DtPlotter (no ROOT)',        t_import)
+    print "\t{:<40}{:>10.3f} s".format('RunContext (ROOT, file, info tree)',  t_context)
+    print "\t{:<40}{:>10.3f} s".format('Cut engine (column cache)',           t_engine)
+    print "\t{:<40}{:>10.3f} s".format('Target centers',                      t_centers)
+    print "\t{:<40}{:>10.3f} s".format('Tool classes, mean of {}'.format(bench_args.n), sum(t_tools)/len(t_tools))
+    DtPlotter.RootLoader.report()                                                                   # ROOT import and library loading, included in the steps above
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from utilities import FileTools
+from utilities import RunContext
+from utilities import RootLoader
+from utilities import EventCache
+from utilities.RootLoader import ROOT
+
+'''
+    Synthetic h4 ntuples, a local stand-in for the test-beam data on EOS.
+    Writes a ROOT file with the h4 and info trees (the branches DtPlotter uses), and/or the same events as columns
+    (<file>.columns/, one .npy per branch expression plus meta.json, read by DtPlotter through Readers.ColumnarReader).
+    Events follow a simple model with known parameters, so running DtPlotter on them should give those parameters back:
+        - dt resolution:  sigma(Aeff) = noise/Aeff (+) sqrt(2)*constant     (the same function fit_resolution fits)
+        - walking mean:   dt shifts by walk_slope * (position - center) along the axis the two crystals share
+        - gap dip:        dt dips by dip_depth (gaussian, dip_width wide) at the center, where the crystals meet
+    Events are made chunk by chunk, so anything from 1e4 to 1e8 events runs in bounded memory. The ROOT output's per-event loop
+    runs in C++ (SyntheticH4.C). The columnar output needs no ROOT at all.
+    IE: python synthetic_h4.py -n 1e6 -p C3up --constant 0.03
+        python DtPlotter.py -d ~/.dtplotter_cache/synthetic/ -r --fit
+'''
+
+## Channels in the fit_* arrays, name -> index. The index branches (IE C3) let fit_time[C3] work as in the real ntuples
+CHANNELS = ['B3', 'C2', 'C3', 'C4', 'D3']
+
+## Model defaults, see the options in input_arguments()
+MODEL = { 'noise'       : 30.,                                              # ns, noise term (Aeff is in units of b_rms)
+          'constant'    : 0.030,                                            # ns, constant term
+          'walk_slope'  : 0.02,                                             # ns/mm
+          'dip_depth'   : 0.05,                                             # ns
+          'dip_width'   : 0.7,                                              # mm
+          'center'      : [2.0, 3.0],                                       # mm, [x, y] where the two crystals meet
+          'beam_sigma'  : 4.0,                                              # mm, gaussian beam spot around the center
+          'share_width' : 6.0,                                              # mm, width of the amplitude sharing across the gap
+          'energies'    : [25, 50, 100, 150, 200, 250],                     # GeV, the energies of a 'compiled' file
+          'adc_per_gev' : 40.,                                              # Total amplitude of the pair per GeV
+          'b_rms'       : 4.0,                                              # ADC, baseline rms
+          't0'          : [20.0, 1.0],                                      # ns, mean and spread of the event time
+          'track_eff'   : 0.9 }                                             # Fraction of events with exactly one track
+
+def input_arguments():
+    parser = argparse.ArgumentParser(description='Generate synthetic h4 ntuples with a known time resolution')
+    parser.add_argument('-n',           type=float, default=1e5,                help='Number of events, IE 1e6')
+    parser.add_argument('-e',           type=str,   default='compiled',         help='Energy, IE "100GeV", or "compiled" for a mix of MODEL energies')
+    parser.add_argument('-p',           type=str,   default='C3up',             help='Position: C3up, C3down, C3left or C3right')
+    parser.add_argument('-o',           type=str,   default=None,               help='Output directory (default <cache>/synthetic/)')
+    parser.add_argument('--format',     type=str,   default='root',             help='root, columnar or both')
+    parser.add_argument('--freq',       type=str,   default='160MHz',           help='Sampling frequency,   IE "160MHz" or "120 MHz"')
+    parser.add_argument('--temp',       type=str,   default='18deg',            help='Sampling temperature, IE "18deg"  or "9deg"')
+    parser.add_argument('--name',       type=str,   default='SYNTHETIC_H4',     help='Name prefix of the output files')
+    parser.add_argument('--cache',      type=str,   default=None,               help='Directory for the columnar event cache (default ~/.dtplotter_cache/)')
+    parser.add_argument('--chunk',      type=float, default=1e6,                help='Events generated at a time')
+    parser.add_argument('--seed',       type=int,   default=1,                  help='Random seed')
+
+    parser.add_argument('--noise',      type=float, default=MODEL['noise'],      help='Noise term, ns')
+    parser.add_argument('--constant',   type=float, default=MODEL['constant'],   help='Constant term, ns')
+    parser.add_argument('--slope',      type=float, default=MODEL['walk_slope'], help='Walking-mean slope of dt against position, ns/mm')
+    parser.add_argument('--dip',        type=float, default=MODEL['dip_depth'],  help='Depth of the dt dip at the gap, ns')
+    parser.add_argument('--dipwidth',   type=float, default=MODEL['dip_width'],  help='Width of the dt dip at the gap, mm')
+    parser.add_argument('--center',     type=str,   default='{},{}'.format(*MODEL['center']), help='Target center, "x,y" in mm')
+    args = parser.parse_args()
+
+    if   (args.freq == '160') or (args.freq == '160MHz'): args.freq = '160MHz'      # Ensures consistent formatting
+    elif (args.freq == '120') or (args.freq == '120MHz'): args.freq = '120MHz'      # IE does the user enter '120', or '120MHz'?
+    if   (args.temp == '18' ) or (args.temp == '18deg' ): args.temp = '18deg'       # Resolve it either way
+    elif (args.temp == '9'  ) or (args.temp == '9deg'  ): args.temp = '9deg'        # blahblah licht mehr licht
+
+    if args.p not in RunContext.XTAL_PAIRS:             sys.exit("\nUnrecognized crystal position {}, aborting...".format(args.p))
+    if args.format not in ['root', 'columnar', 'both']: sys.exit("\nUnrecognized format {}, aborting...".format(args.format))
+    return args
+
+## The model for this run: MODEL with the command line values
+def run_model(args):
+    model = dict(MODEL)
+    model.update({'noise': args.noise, 'constant': args.constant, 'walk_slope': args.slope, 'dip_depth': args.dip, 'dip_width': args.dipwidth,
+                  'center': [float(c) for c in args.center.split(',')], 'seed': args.seed, 'position': args.p, 'freq': args.freq, 'temp': args.temp,
+                  'ampbias': RunContext.AMP_CALIBRATION[args.temp][args.p]})
+    if args.e != 'compiled': model['energies'] = [float(args.e.replace('GeV', ''))]
+    return model
+
+## n events of the model. Per-channel branches are (n, n_channels) float32 arrays, hodoscope ones (n, 2), like the ntuple branches
+def generate(rng, n, model):
+    xtal, neighbour = RunContext.XTAL_PAIRS[model['position']]
+    i_xtal, i_neigh = CHANNELS.index(xtal), CHANNELS.index(neighbour)
+    shared_axis     = 1 if model['position'] in ['C3up', 'C3down'] else 0      # Same axis choice as RunInfoTools/AnalysisTools
+    side            = 1 if model['position'] in ['C3down', 'C3left'] else -1    # Which side of the gap the neighbour is on
+    nch             = len(CHANNELS)
+
+    ## Beam and hodoscope
+    pos       = rng.normal(model['center'], model['beam_sigma'], size=(n, 2))
+    n_tracks  = np.where(rng.rand(n) < model['track_eff'], 1, rng.choice([0, 2], size=n)).astype(np.int32)
+    X         = pos[:,0,None] + rng.normal(0, 0.1, size=(n, 2))                 # Two hodoscope planes
+    Y         = pos[:,1,None] + rng.normal(0, 0.1, size=(n, 2))
+    fibres_x  = rng.choice([1, 2, 2, 2, 3], size=(n, 2))
+    fibres_y  = rng.choice([1, 2, 2, 2, 3], size=(n, 2))
+
+    ## Amplitudes: the pair's total, shared across the gap. The neighbour's is divided by the amplitude calibration DtPlotter multiplies back
+    d         = pos[:,shared_axis] - model['center'][shared_axis]
+    energy    = rng.choice(model['energies'], size=n)
+    total     = energy * model['adc_per_gev']
+    f_xtal    = 0.5*(1 + side*np.tanh(d/model['share_width']))
+    b_rms     = np.abs(rng.normal(model['b_rms'], 0.1*model['b_rms'], size=(n, nch)))
+    fit_ampl  = np.abs(rng.normal(0, 1, size=(n, nch)))*b_rms                   # Channels away from the shower only see noise
+    fit_ampl[:,i_xtal]  = total*f_xtal     + rng.normal(0, 1, size=n)*b_rms[:,i_xtal]
+    fit_ampl[:,i_neigh] = (total*(1-f_xtal) + rng.normal(0, 1, size=n)*b_rms[:,i_neigh]) / model['ampbias']
+    amp_max   = fit_ampl * (1 + rng.normal(0, 0.02, size=(n, nch)))
+
+    ## Times: dt = fit_time[xtal] - fit_time[neighbour], with the injected resolution, walking mean and dip
+    with np.errstate(divide='ignore', invalid='ignore'):
+        aeff  = np.sqrt(2. / ((b_rms[:,i_xtal]/fit_ampl[:,i_xtal])**2 + (b_rms[:,i_neigh]/(model['ampbias']*fit_ampl[:,i_neigh]))**2))
+        sigma = np.sqrt((model['noise']/aeff)**2 + 2*model['constant']**2)
+    sigma     = np.where(np.isfinite(sigma), np.minimum(sigma, 10.), 10.)
+    dt        = model['walk_slope']*d - model['dip_depth']*np.exp(-0.5*(d/model['dip_width'])**2) + rng.normal(0, 1, size=n)*sigma
+    t0        = rng.normal(model['t0'][0], model['t0'][1], size=n)
+    fit_time  = t0[:,None] + rng.normal(0, 1., size=(n, nch))
+    fit_time[:,i_xtal]  = t0 + 0.5*dt
+    fit_time[:,i_neigh] = t0 - 0.5*dt
+    period    = 1000. / float(model['freq'].replace('MHz', ''))                 # ns per sample
+    time_max  = np.floor(fit_time / period)
+    fit_chi2  = rng.lognormal(0, 0.4, size=(n, nch))
+
+    f32 = lambda a: np.ascontiguousarray(a, dtype=np.float32)
+    return { 'n_tracks': n_tracks, 'X': f32(X), 'Y': f32(Y), 'nFibresOnX': f32(fibres_x), 'nFibresOnY': f32(fibres_y),
+             'fit_time': f32(fit_time), 'fit_ampl': f32(fit_ampl), 'b_rms': f32(b_rms), 'fit_chi2': f32(fit_chi2), 'amp_max': f32(amp_max), 'time_maximum': f32(time_max) }
+
+## Column expression -> values, as DtPlotter names them (IE 'fit_time[C3]', 'fitResult[0].x()')
+def columns_of(events):
+    columns = {'n_tracks': events['n_tracks'], 'fitResult[0].x()': events['X'][:,0], 'fitResult[0].y()': events['Y'][:,0]}
+    for branch in ['X', 'Y', 'nFibresOnX', 'nFibresOnY']:
+        for i in range(2): columns['{}[{}]'.format(branch, i)] = events[branch][:,i]
+    for branch in ['fit_time', 'fit_ampl', 'b_rms', 'fit_chi2', 'amp_max', 'time_maximum']:
+        for i, ch in enumerate(CHANNELS): columns['{}[{}]'.format(branch, ch)] = events[branch][:,i]
+    return columns
+
+## Writes the h4 and info trees. The events are filled by SyntheticH4Writer (SyntheticH4.C), so the per-event loop is in C++
+class RootOutput:
+
+    def __init__(self, filename, model, builddir):
+        RootLoader.load_synthetic_h4(builddir)
+        self.path     = filename
+        self.tfile    = ROOT.TFile(filename + '.tmp', 'recreate')
+        self.tree     = ROOT.TTree('h4', 'synthetic h4')
+        self.writer   = ROOT.SyntheticH4Writer(self.tree, len(CHANNELS))
+        for i, ch in enumerate(CHANNELS): self.writer.AddChannel(ch, i)
+        self.model    = model
+
+    def add(self, events):
+        flat = lambda branch: events[branch].ravel()                         # Event-major, as SyntheticH4Writer.Fill reads them
+        self.writer.Fill(len(events['n_tracks']), flat('n_tracks'), flat('X'), flat('Y'), flat('nFibresOnX'), flat('nFibresOnY'),
+                         flat('fit_time'), flat('fit_ampl'), flat('b_rms'), flat('fit_chi2'), flat('amp_max'), flat('time_maximum'))
+
+    ## One info entry per energy (as in a hadd of runs), at least 2 since RunContext.get_xtals reads entry 1
+    def close(self):
+        self.tfile.cd()
+        self.tree.Write()
+        info      = ROOT.TTree('info', 'synthetic run info')
+        energy    = np.zeros(1, dtype=np.float32)
+        positions = np.zeros(16, dtype=np.int8)
+        positions[:len(self.model['position'])] = [ord(c) for c in self.model['position']]
+        info.Branch('Energy',    energy,    'Energy/F')
+        info.Branch('Positions', positions, 'Positions/C')
+        for e in (self.model['energies'] * 2)[:max(2, len(self.model['energies']))]:
+            energy[0] = e
+            info.Fill()
+        info.Write()
+        ROOT.TNamed('synthetic_model', json.dumps(self.model, sort_keys=True)).Write()
+        self.tfile.Close()
+        os.rename(self.path + '.tmp', self.path)                        # Only complete files get the .root name DtPlotter looks for
+
+## Writes every column into a memory-mapped .npy, chunk by chunk, and meta.json last
+class ColumnarOutput:
+
+    def __init__(self, dirname, model, n):
+        self.path    = dirname + '/'
+        self.model   = model
+        self.n       = n
+        self.start   = 0
+        self.outputs = {}
+        if os.path.exists(self.path) == False: os.makedirs(self.path)
+
+    def add(self, events):
+        columns = columns_of(events)
+        for expr, values in columns.items():
+            if expr not in self.outputs:
+                self.outputs[expr] = np.lib.format.open_memmap(self.path + EventCache.EventCache.column_filename(expr), mode='w+', dtype=np.float64, shape=(self.n,))
+            self.outputs[expr][self.start:self.start+len(values)] = values
+        self.start += len(events['n_tracks'])
+
+    def close(self):
+        for output in self.outputs.values(): output.flush()
+        info = {'Energy': self.model['energies'], 'Positions': self.model['position']}
+        meta = {'source': os.path.abspath(self.path), 'entries': self.n, 'info': info, 'model': self.model,
+                'columns': dict((expr, EventCache.EventCache.column_filename(expr)) for expr in self.outputs)}
+        with open(self.path + 'meta.json.tmp', 'w') as f: json.dump(meta, f, indent=1, sort_keys=True)
+        os.rename(self.path + 'meta.json.tmp', self.path + 'meta.json')
+
+def main():
+    args     = input_arguments()
+    ft       = FileTools.FileTools(args)
+    outdir   = args.o if args.o is not None else ft.synthetic_location()
+    if not outdir.endswith('/'): outdir += '/'
+    if os.path.exists(outdir) == False: os.makedirs(outdir)
+    model    = run_model(args)
+    n, chunk = int(args.n), int(args.chunk)
+    base     = outdir + '{}_{}_{}_{}_{}'.format(args.name, args.freq, args.temp, args.e, args.p)         # <energy>_<position> last, as FileTools.analysis_path expects
+
+    outputs  = []
+    if args.format in ['root', 'both']:     outputs.append(RootOutput(base + '.root', model, ft.cache_location()))
+    if args.format in ['columnar', 'both']: outputs.append(ColumnarOutput(base + '.columns', model, n))
+
+    rng   = np.random.RandomState(args.seed)
+    start = time.time()
+    for first in range(0, n, chunk):
+        events = generate(rng, min(chunk, n - first), model)
+        for output in outputs: output.add(events)
+        print "\r{:>12} / {} events".format(first + len(events['n_tracks']), n),
+        sys.stdout.flush()
+    for output in outputs: output.close()
+    elapsed = time.time() - start
+
+    print
+    print "Generated {} events in {:.1f} s ({:.0f} events/s)".format(n, elapsed, n/max(elapsed, 1e-9))
+    for output in outputs: print "\tWritten: {}".format(output.path)
+    print "Injected: constant term {:.2f} ps, noise term {:.1f} ns, walking-mean slope {} ns/mm, dip {} ns, center {}".format(
+          1000*model['constant'], model['noise'], model['walk_slope'], model['dip_depth'], model['center'])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))     # Run from anywhere, like DtPlotter.py
+from utilities import Binning
+
+'''
+    Checks of the -q Aeff bin edges (Binning.py) on Aeff-like values: exact and sketched quantiles against np.percentile,
+    the hybrid split, tied values, and the mincount merging against the bin counts of np.histogram.
+    IE: python -m pytest tests/        or        python tests/test_binning.py
+'''
+
+LB, UB  = 0., 2000.
+NBINS   = 20
+SKETCH  = (UB - LB)/Binning.SKETCH_BINS                                                  # Resolution of the sketched edges
+
+## Aeff-like: steeply falling, a few values outside [LB, UB)
+def aeff_values(n=50000, seed=4):
+    rng = np.random.RandomState(seed)
+    return 20. + rng.exponential(250., size=n)
+
+def in_range(values):
+    return values[(values >= LB) & (values < UB)]
+
+## The sketch only sees chunks, as with --stream
+def chunked(values, size=7000):
+    return lambda: (values[i:i+size] for i in range(0, len(values), size))
+
+## Edges within tol of the percentiles of the in-range values
+def check_percentiles(edges, values, tol):
+    expected = np.percentile(in_range(values), np.linspace(0., 100., len(edges)))
+    assert len(edges) == NBINS+1, len(edges)
+    assert (edges[0], edges[-1]) == (LB, UB)
+    assert np.all(np.abs(np.array(edges[1:-1]) - expected[1:-1]) <= tol), np.abs(np.array(edges[1:-1]) - expected[1:-1]).max()
+
+## Exact edges fall between two neighbouring values, so every bin holds the same number of them (to rounding)
+def test_equal_exact():
+    values = aeff_values()
+    edges  = Binning.bin_edges(values, 'equal', NBINS, LB, UB)
+    check_percentiles(edges, values, 1.)
+    counts = np.histogram(in_range(values), edges)[0]
+    assert counts.max() - counts.min() <= 1, counts
+
+def test_equal_sketch():
+    values = aeff_values()
+    exact  = Binning.bin_edges(values, 'equal', NBINS, LB, UB)
+    sketch = Binning.bin_edges(chunked(values), 'equal', NBINS, LB, UB)
+    check_percentiles(sketch, values, 1.)
+    assert np.all(np.abs(np.array(sketch) - np.array(exact)) <= 2*SKETCH), np.abs(np.array(sketch) - np.array(exact)).max()
+
+## Equal-statistics bins below the split (percentiles of the values under it), fixed-width bins above
+def test_hybrid():
+    values = aeff_values()
+    split  = 400.
+    for source in [values, chunked(values)]:
+        edges = Binning.bin_edges(source, 'hybrid', NBINS, LB, UB, split=split)
+        lower = [e for e in edges if e <= split]
+        below = values[(values >= LB) & (values < split)]
+        assert len(edges) == NBINS+1
+        assert np.all(np.abs(np.array(lower[1:-1]) - np.percentile(below, np.linspace(0., 100., len(lower))[1:-1])) <= 1.)
+        assert np.allclose(edges[len(lower)-1:], np.linspace(split, UB, NBINS - NBINS//2 + 1))
+
+## Many identical values: exact edges that would coincide are merged. The sketch spreads them over the sketch bin holding the tie
+def test_ties():
+    values = np.concatenate([np.full(30000, 100.), aeff_values(20000)])
+    exact  = Binning.bin_edges(values, 'equal', NBINS, LB, UB)
+    sketch = Binning.bin_edges(chunked(values), 'equal', NBINS, LB, UB)
+    assert len(exact) < NBINS+1
+    assert 100. in exact
+    for edges in [exact, sketch]:
+        assert np.all(np.diff(edges) > 0), edges
+        assert (edges[0], edges[-1]) == (LB, UB)
+    assert np.count_nonzero(np.abs(np.array(sketch) - 100.) <= SKETCH) == NBINS+1 - len(exact) + 1
+
+## Every bin holds min_count values, and each bin closes at the first fixed edge where it has them (none could be split further)
+def test_mincount():
+    values    = aeff_values()
+    min_count = 200
+    fixed     = np.linspace(LB, UB, NBINS*4+1)
+    edges     = Binning.bin_edges(values, 'mincount', NBINS*4, LB, UB, min_count=min_count)
+    counts    = np.histogram(in_range(values), edges)[0]
+    assert len(edges) < len(fixed)                                                      # The falling tail has to be merged
+    assert np.all(counts >= min_count), counts
+    assert all(np.any(np.isclose(e, fixed)) for e in edges)
+    for lo, hi in zip(edges[:-2], edges[1:-1]):                                         # Not the last bin, it may have taken in a short one
+        previous = fixed[np.searchsorted(fixed, hi) - 1]
+        if previous > lo: assert np.count_nonzero((values >= lo) & (values < previous)) < min_count
+
+def test_unknown_strategy():
+    try:
+        Binning.bin_edges(aeff_values(), 'quantile', NBINS, LB, UB)
+    except ValueError:
+        return
+    assert False
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print name, 'passed'
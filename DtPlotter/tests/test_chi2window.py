@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))     # Run from anywhere, like DtPlotter.py
+from utilities.PlotterTools import chi2_window, chi2_window_streamed
+
+'''
+    Checks of the exact chi2 acceptance window (PlotterTools.chi2_window) against a brute-force scan of every window,
+    and against the step search it replaced, and of chi2_window_streamed against chi2_window.
+    IE: python -m pytest tests/        or        python tests/test_chi2window.py
+'''
+
+ACCEPTANCE = 0.95
+np.seterr(invalid='ignore', divide='ignore')                                            # NaN and 0 chi2 values are part of the test data
+
+## h4-like chi2 values: lognormal, rounded so many tie, with some 0, negative, NaN and inf
+def chi2_values(n=20000, seed=3):
+    rng  = np.random.RandomState(seed)
+    chi2 = np.round(rng.lognormal(0., 0.6, size=n), 2)
+    chi2[rng.randint(0, n, size=n//50)] = rng.choice([0., -1., np.nan, np.inf], size=n//50)
+    return chi2
+
+def accepted(chi2, chi_val):
+    if chi_val <= 0: return 0                                                           # The step search can land on 0, a window nothing passes
+    return np.count_nonzero((chi2 > 1./chi_val) & (chi2 < chi_val))
+
+## The chi2_range_sweep step search of the original PlotterTools, on an array instead of tree.Draw calls
+def step_search(chi2, acceptance=ACCEPTANCE, window=0.005):
+    def check_range(percentage):
+        if (percentage <= acceptance+window) and (percentage >= acceptance-window): return  0
+        elif percentage > acceptance+window:                                        return -1
+        return 1
+    stepsize, chi_val, direction = 64, 0, 1
+    while direction != 0:
+        chi_val       += direction*stepsize
+        percent_accept = 1.*accepted(chi2, chi_val)/len(chi2)
+        lastdirection  = direction
+        direction      = check_range(percent_accept)
+        if direction != lastdirection: stepsize /= 2.
+    return chi_val, percent_accept
+
+## Smallest window keeping the acceptance: every max(chi2, 1/chi2) value is a candidate edge, passed by the values strictly below it
+def brute_force(chi2, acceptance=ACCEPTANCE):
+    positive = chi2[chi2 > 0]
+    t        = np.maximum(positive, 1./positive)
+    needed   = int(np.ceil(acceptance*len(chi2) - 1e-9))
+    for edge in np.unique(t):
+        if np.count_nonzero(t <= edge) >= needed: return edge
+
+def test_brute_force():
+    chi2             = chi2_values()
+    chi_val, percent = chi2_window(chi2, ACCEPTANCE)
+    edge             = brute_force(chi2)
+    assert percent >= ACCEPTANCE
+    positive         = chi2[chi2 > 0]
+    assert accepted(chi2, chi_val) == np.count_nonzero(np.maximum(positive, 1./positive) <= edge)      # Same events pass
+    assert accepted(chi2, edge) < np.ceil(ACCEPTANCE*len(chi2))                                         # Any narrower window loses events
+    assert abs(percent - 1.*accepted(chi2, chi_val)/len(chi2)) < 1e-12
+
+## The step search stops anywhere within 0.5% of the acceptance, the exact window is the narrowest one reaching it
+def test_step_search():
+    for seed in [3, 4, 5]:
+        chi2                   = chi2_values(seed=seed)
+        chi_val, percent       = chi2_window(chi2, ACCEPTANCE)
+        step_val, step_percent = step_search(chi2)
+        assert abs(step_percent - ACCEPTANCE) <= 0.005
+        assert ACCEPTANCE <= percent <= ACCEPTANCE + 0.005, percent
+        if step_percent >= ACCEPTANCE: assert chi_val <= step_val, (chi_val, step_val)
+
+def test_no_positive_values():
+    assert chi2_window(np.array([0., -1., np.nan]), ACCEPTANCE) == (1., 0.)
+
+## Chunked (--stream) gives the same window and acceptance, whatever the chunk size
+def test_streamed():
+    chi2 = chi2_values()
+    for size in [1000, 777, len(chi2)]:
+        chunks = lambda: (chi2[i:i+size] for i in range(0, len(chi2), size))
+        assert chi2_window_streamed(chunks, ACCEPTANCE) == chi2_window(chi2, ACCEPTANCE), size
+
+## All the values past the window edge tie: the edge comes from the next value up, as in chi2_window
+def test_streamed_ties():
+    chi2   = np.concatenate([np.ones(90), 3.*np.ones(10), [50.]])
+    chunks = lambda: iter([chi2[:40], chi2[40:]])
+    assert chi2_window_streamed(chunks, ACCEPTANCE) == chi2_window(chi2, ACCEPTANCE)
+    assert chi2_window(chi2, ACCEPTANCE)[0] == 0.5*(3. + 50.)
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print name, 'passed'
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))     # Run from anywhere, like DtPlotter.py
+from utilities import CorrectionMap
+
+'''
+    Checks of the dt correction map (CorrectionMap.py): bilinear interpolation of a known plane, the count-weighted smoothing
+    against a brute-force loop, the filling of empty bins, and a map built from events whose mean dt is a known plane.
+    IE: python -m pytest tests/        or        python tests/test_correctionmap.py
+'''
+
+CENTER = [1.8, 3.2]                                                                     # mm, target center
+
+## dt offset of the test events: a plane in x and y (ns)
+def plane(x, y):
+    return 0.2 + 0.010*(x - CENTER[0]) - 0.006*(y - CENTER[1])
+
+## Interpolating a plane is exact inside the nodes, and clamped to the edge values outside
+def test_bilinear():
+    x_nodes = np.linspace(-4., 8., 13)
+    y_nodes = np.linspace(-2., 9., 12)
+    table   = plane(x_nodes[:,None], y_nodes[None,:])
+    rng     = np.random.RandomState(6)
+    x, y    = rng.uniform(-4., 8., 1000), rng.uniform(-2., 9., 1000)
+    assert np.allclose(CorrectionMap.bilinear(x_nodes, y_nodes, table, x, y), plane(x, y), atol=1e-12)
+    assert np.allclose(CorrectionMap.bilinear(x_nodes, y_nodes, table, np.array([-10., 20.]), np.array([-10., 20.])), [table[0,0], table[-1,-1]])
+
+## Normalized convolution written out bin by bin
+def brute_force_smooth(means, counts, sigma, min_count):
+    radius = max(int(np.ceil(3*sigma)), 1)
+    out    = np.full(means.shape, np.nan)
+    for i in range(means.shape[0]):
+        for j in range(means.shape[1]):
+            num, den = 0., 0.
+            for k in range(max(i-radius, 0), min(i+radius+1, means.shape[0])):
+                for l in range(max(j-radius, 0), min(j+radius+1, means.shape[1])):
+                    if counts[k,l] < min_count: continue
+                    w    = counts[k,l]*np.exp(-0.5*((k-i)**2 + (l-j)**2)/sigma**2)
+                    num += w*means[k,l]
+                    den += w
+            if den > 0: out[i,j] = num/den
+    return out
+
+def test_smooth():
+    rng    = np.random.RandomState(7)
+    means  = rng.normal(0.2, 0.01, size=(12, 10))
+    counts = rng.poisson(40., size=(12, 10)).astype(np.float64)
+    counts[3:5, 2:4] = 0.                                                               # Holes, and a corner below min_count
+    counts[-2:, -2:] = 5.
+    means[counts == 0] = np.nan
+    for sigma in [0.5, 1.5]:
+        smoothed = CorrectionMap.smooth(means, counts, sigma, min_count=20)
+        expected = brute_force_smooth(means, counts, sigma, 20)
+        assert np.array_equal(np.isnan(smoothed), np.isnan(expected))
+        assert np.allclose(smoothed[np.isfinite(expected)], expected[np.isfinite(expected)], atol=1e-12)
+
+## A constant stays constant, whatever the counts
+def test_smooth_constant():
+    counts = np.random.RandomState(8).poisson(40., size=(8, 8)).astype(np.float64)
+    assert np.allclose(CorrectionMap.smooth(np.full((8, 8), 0.3), counts, 1., min_count=20), 0.3)
+
+def test_fill_empty():
+    table        = np.full((5, 5), np.nan)
+    table[0,0]   = 1.
+    table[0,2]   = 3.
+    filled       = CorrectionMap.fill_empty(table)
+    assert np.all(np.isfinite(filled))
+    assert filled[0,1] == 2.                                                            # Mean of its two filled neighbours
+    assert filled[0,0] == 1. and filled[0,2] == 3.                                      # Filled bins are kept
+    assert np.all((filled >= 1.) & (filled <= 3.))
+    assert np.all(np.isnan(CorrectionMap.fill_empty(np.full((3, 3), np.nan))))
+
+## Events whose mean dt is the plane: the map gives it back (minus its reference), and the corrected dt no longer depends on position
+def test_build_on_plane():
+    rng    = np.random.RandomState(9)
+    n      = 400000
+    x, y   = rng.normal(CENTER[0], 3., n), rng.normal(CENTER[1], 3., n)
+    dt     = plane(x, y) + rng.normal(0., 0.05, n)
+    cmap   = CorrectionMap.CorrectionMap.build([[x[:n//2], y[:n//2], dt[:n//2]], [x[n//2:], y[n//2:], dt[n//2:]]], CENTER, info={'center': CENTER})
+    inside = (np.abs(x - CENTER[0]) < 4.) & (np.abs(y - CENTER[1]) < 4.)
+    assert np.abs(cmap.offset(x[inside], y[inside]) - (plane(x[inside], y[inside]) - cmap.reference)).max() < 0.01
+    corrected = cmap.correct(dt, x, y)[inside]
+    slope     = np.polyfit(x[inside], corrected, 1)[0]
+    assert abs(slope) < 5e-4, slope
+    assert abs(np.mean(cmap.correct(dt, x, y)) - np.mean(dt)) < 0.002                   # The reference keeps the mean dt
+    assert cmap.offset(np.array([np.nan]), np.array([1.]))[0] == 0.                     # No track, no correction
+
+## A saved map is only reused around its own center
+def test_matches():
+    cmap = CorrectionMap.CorrectionMap([0., 1.], [0., 1.], np.zeros((2, 2)), np.ones((2, 2)), 0., info={'center': CENTER})
+    assert cmap.matches([CENTER[0] + 0.3, CENTER[1] - 0.3])
+    assert not cmap.matches([CENTER[0] + 1., CENTER[1]])
+    assert not CorrectionMap.CorrectionMap([0., 1.], [0., 1.], np.zeros((2, 2)), np.ones((2, 2)), 0.).matches(CENTER)
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print name, 'passed'
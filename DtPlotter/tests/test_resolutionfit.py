@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))     # Run from anywhere, like DtPlotter.py
+from utilities.AnalysisTools import linear_resolution_fit
+
+'''
+    Checks of the closed-form resolution fit (AnalysisTools.linear_resolution_fit) on resolution vs Aeff points with known
+    N and c terms, on points that would give a negative N^2 or c^2, and on points it can't fit.
+    IE: python -m pytest tests/        or        python tests/test_resolutionfit.py
+'''
+
+N_TRUE, C_TRUE = 8., 0.030
+AEFF           = np.linspace(80., 1500., 25)
+N_SIGMA        = 3.
+
+def resolution(aeff, N, c):
+    return np.sqrt((N/aeff)**2 + 2.*c**2)
+
+## Resolution points with 2% errors, scattered by them
+def points(N=N_TRUE, c=C_TRUE, seed=10):
+    sigma     = resolution(AEFF, N, c)
+    sigma_err = 0.02*sigma
+    return AEFF, sigma + np.random.RandomState(seed).normal(0., sigma_err), sigma_err
+
+## Noiseless points give the terms back exactly
+def test_exact_points():
+    N, c, N_err, c_err, red_chi2 = linear_resolution_fit(AEFF, resolution(AEFF, N_TRUE, C_TRUE), 0.02*resolution(AEFF, N_TRUE, C_TRUE))
+    assert abs(N - N_TRUE) < 1e-9 and abs(c - C_TRUE) < 1e-12, (N, c)
+    assert red_chi2 < 1e-12
+
+def test_injected_terms():
+    for seed in range(10, 15):
+        N, c, N_err, c_err, red_chi2 = linear_resolution_fit(*points(seed=seed))
+        assert abs(N - N_TRUE) <= N_SIGMA*N_err, (N, N_err)
+        assert abs(c - C_TRUE) <= N_SIGMA*c_err, (c, c_err)
+
+## Single-term fit by brute force: the scale minimizing the chi2 of sigma^2, as the closed-form fit weights it
+def brute_force_single(x, aeff, sigma, sigma_err):
+    w      = 1./(2.*sigma*sigma_err)**2
+    scales = np.linspace(0., 2.*np.max(sigma**2/x), 20001)
+    chi2   = [np.sum(w*(sigma**2 - u*x)**2) for u in scales]
+    return np.sqrt(scales[np.argmin(chi2)])
+
+## Points below a pure-noise curve would give c^2 < 0: c is set to 0 (infinite error) and N refit alone
+def test_negative_c2_clamped():
+    aeff  = AEFF
+    sigma = resolution(aeff, N_TRUE, 0.)*(1. - 0.3*aeff/aeff.max())                     # Falls faster than 1/Aeff
+    err   = 0.02*sigma
+    N, c, N_err, c_err, red_chi2 = linear_resolution_fit(aeff, sigma, err)
+    assert c == 0. and c_err == np.inf
+    assert abs(N - brute_force_single(1./aeff**2, aeff, sigma, err)) < 1e-3*N, N
+    assert np.isfinite(N_err)
+
+## A flat resolution that rises a little at high Aeff would give N^2 < 0: N is set to 0 and c refit alone
+def test_negative_n2_clamped():
+    aeff  = AEFF
+    sigma = np.sqrt(2.)*C_TRUE*(1. + 0.1*aeff/aeff.max())
+    err   = 0.02*sigma
+    N, c, N_err, c_err, red_chi2 = linear_resolution_fit(aeff, sigma, err)
+    assert N == 0. and N_err == np.inf
+    assert abs(c - brute_force_single(2.*np.ones(len(aeff)), aeff, sigma, err)) < 1e-3*c, c
+
+## Every point at one Aeff: N and c can't be told apart
+def test_singular():
+    aeff = np.full(5, 300.)
+    assert linear_resolution_fit(aeff, resolution(aeff, N_TRUE, C_TRUE), 0.001*np.ones(5)) is None
+
+## Zero and non-finite errors are left out, and fewer than 2 points left can't be fit
+def test_dropped_points():
+    aeff, sigma, err = points()
+    full             = linear_resolution_fit(aeff, sigma, err)
+    err, sigma       = err.copy(), sigma.copy()
+    err[3], sigma[7] = 0., np.nan
+    keep             = np.ones(len(aeff), dtype=bool)
+    keep[[3, 7]]     = False
+    assert np.allclose(linear_resolution_fit(aeff, sigma, err), linear_resolution_fit(aeff[keep], sigma[keep], err[keep]))
+    assert not np.allclose(full[:2], linear_resolution_fit(aeff, sigma, err)[:2], rtol=1e-12, atol=0.)
+    assert linear_resolution_fit(aeff[:1], sigma[:1], err[:1]) is None
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print name, 'passed'
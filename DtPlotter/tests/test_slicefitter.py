@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))     # Run from anywhere, like DtPlotter.py
+from utilities import SliceFitter
+
+'''
+    Checks of the batched slice fitter on slices with a known shape: the fits have to converge (ok),
+    and give back the true mean and sigma within their errors.
+    IE: python -m pytest tests/        or        python tests/test_slicefitter.py
+'''
+
+EDGES   = np.linspace(-1., 1., 101)
+CENTERS = 0.5*(EDGES[1:] + EDGES[:-1])
+N_SIGMA = 3.                                                                            # Allowed pull on mean and sigma
+
+## Slices drawn from a Gaussian, 5000 events each
+def gaussian_slices(mean=0.1, sigma=0.15, n_slices=3, seed=1):
+    rng = np.random.RandomState(seed)
+    return np.array([np.histogram(rng.normal(mean, sigma, 5000), EDGES)[0] for k in range(n_slices)], dtype=np.float64)
+
+## Slices with Poisson counts around a double crystal ball, params c, mu, sig, A, n
+def dcb_slices(params, n_slices=3, seed=2):
+    rng      = np.random.RandomState(seed)
+    expected = SliceFitter.dcb(CENTERS, np.array([params]*n_slices, dtype=np.float64))
+    return rng.poisson(expected).astype(np.float64)
+
+def check(fit, mean, sigma):
+    assert fit['ok'].all(), fit['status']
+    assert (fit['status'] == SliceFitter.CONVERGED).all(), fit['status']
+    assert (np.abs(fit['mean']  - mean ) <= N_SIGMA*fit['mean_err'] ).all(), (fit['mean'],  fit['mean_err'])
+    assert (np.abs(fit['sigma'] - sigma) <= N_SIGMA*fit['sigma_err']).all(), (fit['sigma'], fit['sigma_err'])
+
+def test_gaus_on_gaussian():
+    check(SliceFitter.fit_slices(gaussian_slices(), EDGES, 'gaus'), 0.1, 0.15)
+
+## With no tails in the data n runs into its lower limit, the fit has to stop there and still count as converged
+def test_dcb_on_gaussian_with_n_at_limit():
+    fit = SliceFitter.fit_slices(gaussian_slices(), EDGES, 'dcb')
+    assert (fit['params'][:,4] == SliceFitter.DCB_LIMITS[4][0]).any()
+    check(fit, 0.1, 0.15)
+
+def test_dcb_on_dcb():
+    check(SliceFitter.fit_slices(dcb_slices([400., 0.05, 0.1, 1.5, 3.]), EDGES, 'dcb'), 0.05, 0.1)
+
+## Wider than the sigma limit, sigma ends at 0.2, with an error (not 0, the point still has a weight in the resolution fit)
+def test_dcb_with_sigma_at_limit():
+    fit = SliceFitter.fit_slices(dcb_slices([200., 0., 0.3, 1.5, 3.]), EDGES, 'dcb')
+    assert fit['ok'].all(), fit['status']
+    assert (fit['sigma'] == SliceFitter.DCB_LIMITS[2][1]).all()
+    assert (fit['sigma_err'] > 0).all(), fit['sigma_err']
+
+## Stopped early: kept as MAX_ITER (finite chi2 and mean/sigma errors), not failed
+def test_max_iter_status():
+    counts = gaussian_slices()
+    active = np.ones(len(counts), dtype=bool)
+    seeds  = SliceFitter.moments(counts, CENTERS)
+    params, cov, chi2, status = SliceFitter.minimize_chi2(SliceFitter.gaus, SliceFitter.gaus_jacobian, SliceFitter.GAUS_LIMITS,
+                                                          CENTERS, counts, np.sqrt(counts), seeds, active, max_iter=1)
+    assert (status == SliceFitter.MAX_ITER).all(), status
+    assert np.isfinite(chi2).all() and np.isfinite(np.diagonal(cov, axis1=1, axis2=2)[:,1:3]).all()
+
+## Every slice keeps the lowest chi2 over the DCB_SEEDS, never worse than any one seed alone.
+## On these slices A = n = 1 alone ends in a worse minimum for slice 2
+def test_dcb_seeds():
+    counts = dcb_slices([400., 0.05, 0.1, 2.5, 6.], n_slices=5, seed=2)
+    seeds  = SliceFitter.DCB_SEEDS
+    fit    = SliceFitter.fit_slices(counts, EDGES, 'dcb')
+    single = []
+    try:
+        for seed in seeds:
+            SliceFitter.DCB_SEEDS = [seed]
+            single.append(SliceFitter.fit_slices(counts, EDGES, 'dcb')['chi2ndf'])
+    finally:
+        SliceFitter.DCB_SEEDS = seeds
+    assert fit['ok'].all(), fit['status']
+    assert (fit['chi2ndf'] <= np.min(single, axis=0) + 1e-9).all(), (fit['chi2ndf'], single)
+    assert fit['chi2ndf'][2] < single[0][2] - 1e-3, (fit['chi2ndf'], single[0])
+
+## Too few entries: not fit
+def test_empty_slice():
+    counts = gaussian_slices()
+    counts[1] = 0.
+    fit = SliceFitter.fit_slices(counts, EDGES, 'dcb')
+    assert list(fit['ok']) == [True, False, True]
+    assert fit['status'][1] == SliceFitter.FAILED
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print name, 'passed'
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import math
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))     # Run from anywhere, like DtPlotter.py
+from utilities import UnbinnedFit
+
+'''
+    Checks of the unbinned resolution fit (UnbinnedFit.py): the analytic gradient of the likelihood against finite differences,
+    the fit on events drawn with known N and c terms, which it has to give back within its errors, and the errors at a point
+    that isn't a minimum.
+    IE: python -m pytest tests/        or        python tests/test_unbinnedfit.py
+'''
+
+N_TRUE, C_TRUE      = 8., 0.030                                                         # ns*Aeff and ns, IE a 30 ps constant term
+MU0_TRUE, MU1_TRUE  = 0.25, 5.
+N_SIGMA             = 3.                                                                # Allowed pull on N and c
+
+## (dt, Aeff) events of the resolution model: sigma = sqrt((N/Aeff)^2 + 2c^2) around the walking mean mu0 + mu1/Aeff
+## A fraction 'tail' of the events is flat over dt_range instead
+def events(n=40000, tail=0., dt_range=(-1., 1.5), seed=5):
+    rng   = np.random.RandomState(seed)
+    aeff  = 60. + rng.exponential(300., size=n)
+    sigma = np.sqrt((N_TRUE/aeff)**2 + 2.*C_TRUE**2)
+    dt    = rng.normal(MU0_TRUE + MU1_TRUE/aeff, sigma)
+    flat  = rng.uniform(size=n) < tail
+    dt[flat] = rng.uniform(dt_range[0], dt_range[1], size=np.count_nonzero(flat))
+    return dt, aeff
+
+def test_norm_cdf():
+    z = np.linspace(-6., 6., 241)
+    assert np.allclose(UnbinnedFit.norm_cdf(z), [0.5*(1. + math.erf(v/math.sqrt(2.))) for v in z], atol=2e-7)
+
+## Analytic gradient against central differences of the likelihood, for every mean model, with and without the tail and the truncation
+def test_gradient():
+    dt, aeff = events(2000)
+    for mean_model in UnbinnedFit.MEAN_MODELS:
+        for tail in [False, True]:
+            for dt_range in [None, [-1., 1.5]]:
+                model = UnbinnedFit.ResolutionModel(dt, aeff, mean_model, tail, dt_range)
+                theta = model.seeds()*1.1                                               # Away from the minimum, the gradient isn't ~0
+                grad  = model.nll(theta)[1]
+                for i in range(len(theta)):
+                    step       = 1e-6*max(abs(theta[i]), 1e-3)
+                    up, down   = theta.copy(), theta.copy()
+                    up[i]     += step
+                    down[i]   -= step
+                    numerical  = (model.nll(up)[0] - model.nll(down)[0]) / (2.*step)
+                    assert abs(grad[i] - numerical) <= 1e-4*max(abs(numerical), 1.), (mean_model, tail, dt_range, model.names()[i], grad[i], numerical)
+
+def check(result):
+    assert result is not None and result['converged']
+    assert abs(result['N'] - N_TRUE) <= N_SIGMA*result['N_err'], (result['N'], result['N_err'])
+    assert abs(result['c'] - C_TRUE) <= N_SIGMA*result['c_err'], (result['c'], result['c_err'])
+
+def test_fit_injected_terms():
+    dt, aeff = events()
+    result   = UnbinnedFit.fit(dt, aeff, 'walk')
+    check(result)
+    assert abs(result['mu1'] - MU1_TRUE) <= N_SIGMA*result['mu1_err'], (result['mu1'], result['mu1_err'])
+
+## Events cut at the dt range edges: the truncated gaussian still gives the true terms
+def test_fit_truncated():
+    dt, aeff = events()
+    check(UnbinnedFit.fit(dt, aeff, 'walk', dt_range=[0.05, 0.45]))
+
+def test_fit_with_tail():
+    dt, aeff = events(tail=0.05)
+    result   = UnbinnedFit.fit(dt, aeff, 'walk', tail=True, dt_range=[-1., 1.5])
+    check(result)
+    assert abs(result['tail_fraction'] - 0.05) < 0.01, result['tail_fraction']
+
+## A bowl gives the errors of its quadratic form, a saddle point NaN errors and no minimum
+def test_hessian_errors():
+    bowl   = lambda x: (x[0]**2 + 4.*x[1]**2, np.array([2.*x[0], 8.*x[1]]))
+    saddle = lambda x: (x[0]**2 - x[1]**2,    np.array([2.*x[0], -2.*x[1]]))
+    errors, minimum = UnbinnedFit.hessian_errors(bowl, np.array([0.5, 0.5]))
+    assert minimum and np.allclose(errors, [np.sqrt(0.5), np.sqrt(0.125)]), errors
+    errors, minimum = UnbinnedFit.hessian_errors(saddle, np.array([0.5, 0.5]))
+    assert (minimum == False) and np.all(np.isnan(errors)), errors
+
+def test_too_few_events():
+    dt, aeff = events(50)
+    assert UnbinnedFit.fit(dt, aeff) is None
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print name, 'passed'
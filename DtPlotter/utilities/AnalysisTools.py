@@ -2,65 +2,317 @@
 
 ## By Michael Plesser
 
+import os
 import sys
+import time
 import numpy as np
+import multiprocessing
 import FileTools
-import RunInfoTools
+import CutEngine
+import Profiler
+import SliceFitter
+import UnbinnedFit
+import CorrectionMap
+import RootLoader
 from array import array
-from ROOT import * 
+from RootLoader import ROOT
+
+## Mean of the values in each [lbound, ubound) bin, for any set of non-overlapping bins (digitize + weighted bincount)
+## Values can be added in chunks (IE from CutEngine.iter_values). Sums are accumulated per CutEngine.BLOCK_SIZE block of events,
+## so as long as chunks are whole blocks (as CutEngine makes them) the means are the same however the values were chunked
+class BinnedMeans:
+
+    def __init__(self, lbounds, ubounds):
+        self.lbounds = np.asarray(lbounds, dtype=np.float64)
+        self.ubounds = np.asarray(ubounds, dtype=np.float64)
+        self.edges   = np.unique(np.concatenate([self.lbounds, self.ubounds]))
+        self.sums    = np.zeros(len(self.edges)+1)
+        self.counts  = np.zeros(len(self.edges)+1, dtype=np.int64)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        for start in range(0, len(values), CutEngine.BLOCK_SIZE):
+            block        = values[start:start+CutEngine.BLOCK_SIZE]
+            block        = block[np.isfinite(block)]
+            idx          = np.digitize(block, self.edges)                                   # idx = k  <==>  edges[k-1] <= value < edges[k]
+            self.sums   += np.bincount(idx, weights=block, minlength=len(self.edges)+1)
+            self.counts += np.bincount(idx,                minlength=len(self.edges)+1)
+        return self
+
+    ## Empty bins keep their mid-point
+    def means(self):
+        sums    = np.cumsum(self.sums)
+        counts  = np.cumsum(self.counts)
+        first   = np.searchsorted(self.edges, self.lbounds)                                 # Sum the (cumulative) bins from lbound up to ubound
+        last    = np.searchsorted(self.edges, self.ubounds)
+        n       = counts[last] - counts[first]
+        total   = sums[last]   - sums[first]
+        mids    = 0.5*(self.lbounds + self.ubounds)
+        return [total[i]/n[i] if n[i] > 0 else mids[i] for i in range(len(mids))]
+
+## Closed-form fit of sigma = sqrt((N/Aeff)^2 + 2c^2). Written for sigma^2 it is linear in N^2 and c^2:
+##     sigma^2 = N^2 * (1/Aeff^2) + c^2 * 2
+## so it is solved directly by weighted least squares, with var(sigma^2) = (2*sigma*sigma_err)^2
+## A negative N^2 or c^2 is unphysical (IE points just below a pure-noise curve give c^2 < 0): that term is set to 0 and the other is refit alone,
+## so the result is the best physical one rather than the square root of a negative number's magnitude. A term at 0 has an infinite error
+## Points with a zero (or non-finite) error would get an infinite weight, they are left out
+## Returns [N, c, N_err, c_err, reduced chi2 (of sigma, not sigma^2)], or None if fewer than 2 points are left or the system is singular
+def linear_resolution_fit(aeff, sigma, sigma_err):
+    aeff, sigma, sigma_err = [np.asarray(v, dtype=np.float64) for v in [aeff, sigma, sigma_err]]
+    keep    = np.isfinite(aeff) & np.isfinite(sigma) & np.isfinite(sigma_err) & (aeff > 0) & (sigma > 0) & (sigma_err > 0)
+    aeff, sigma, sigma_err = aeff[keep], sigma[keep], sigma_err[keep]
+    if len(aeff) < 2: return None                                                           # 2 parameters
+    X       = np.column_stack([1./aeff**2, 2.*np.ones(len(aeff))])
+    y       = sigma**2
+    w       = 1./(2.*sigma*sigma_err)**2
+    if np.linalg.matrix_rank(X*np.sqrt(w)[:,None]) < 2: return None                         # IE every point at the same Aeff. Only singular to rounding, inv() wouldn't raise
+    XtWX    = np.dot(X.T*w, X)
+    try:    cov = np.linalg.inv(XtWX)
+    except np.linalg.LinAlgError: return None
+    u       = np.dot(cov, np.dot(X.T*w, y))                                                 # [N^2, c^2]
+    var     = np.diagonal(cov)
+    if np.any(u < 0):
+        ## Refit with only one term free, the other at 0. y > 0 and X > 0, so the free term comes out >= 0
+        ## If both came out negative, keep whichever single-term fit is better
+        best = None
+        for free in [j for j in [0, 1] if u[1-j] < 0]:
+            var_j = 1./np.sum(w*X[:,free]**2)
+            u_j   = var_j*np.sum(w*X[:,free]*y)
+            chi2  = np.sum(w*(y - u_j*X[:,free])**2)
+            if (best is None) or (chi2 < best[0]): best = [chi2, free, u_j, var_j]
+        chi2, free, u_j, var_j = best
+        u, var  = np.zeros(2), np.zeros(2)
+        u[free], var[free] = u_j, var_j
+    N, c    = np.sqrt(u[0]), np.sqrt(u[1])
+    N_err   = np.sqrt(var[0])/(2.*N) if N > 0 else np.inf                                   # d(sqrt(u)) = du/(2 sqrt(u))
+    c_err   = np.sqrt(var[1])/(2.*c) if c > 0 else np.inf
+    return [N, c, N_err, c_err, resolution_red_chi2(aeff, sigma, sigma_err, N, c)]
+
+## Reduced chi2 of resolution points against sqrt((N/Aeff)^2 + 2c^2), 2 fitted parameters
+def resolution_red_chi2(aeff, sigma, sigma_err, N, c):
+    aeff, sigma, sigma_err = [np.asarray(v, dtype=np.float64) for v in [aeff, sigma, sigma_err]]
+    model   = np.sqrt((N/aeff)**2 + 2.*c**2)
+    ndf     = len(aeff) - 2
+    return np.sum(((sigma - model)/sigma_err)**2)/ndf if ndf > 0 else 'N/A'
+
+## Points to keep: those within max_residual of the median (IE drop slices whose fit failed)
+def outlier_mask(y, max_residual):
+    y = np.asarray(y, dtype=np.float64)
+    if len(y) == 0: return np.ones(0, dtype=bool)
+    return np.abs(y - np.median(y)) < max_residual
+
+## Weighted least-squares straight line y = p0 + p1*x, with weights 1/yerr^2 (uniform if any error is 0)
+## Returns [p0, p1, reduced chi2]
+def weighted_line_fit(x, y, yerr):
+    x, y, yerr = [np.asarray(v, dtype=np.float64) for v in [x, y, yerr]]
+    w          = 1./yerr**2 if np.all(yerr > 0) else np.ones(len(x))
+    X          = np.column_stack([np.ones(len(x)), x])
+    p0, p1     = np.linalg.solve(np.dot(X.T*w, X), np.dot(X.T*w, y))
+    ndf        = len(x) - 2
+    red_chi2   = np.sum(w*(y - p0 - p1*x)**2)/ndf if ndf > 0 else 'N/A'
+    return [p0, p1, red_chi2]
+
+## Everything fit_slice needs about slice 'bini' of h, as plain python types so it can be sent to a worker process
+## builddir is where the dcb model is compiled (the cache location)
+def slice_task(h, h_p, bini, fit_type, builddir=None):
+    n_ybins  = h_p.GetNbinsX()
+    y_edges  = [h_p.GetXaxis().GetBinLowEdge(j) for j in range(1, n_ybins+2)]
+    contents = [h_p.GetBinContent(j) for j in range(0, n_ybins+2)]                 # Includes under/overflow
+    errors   = [h_p.GetBinError(j)   for j in range(0, n_ybins+2)]
+    lowedge  = h.GetXaxis().GetBinLowEdge(bini)
+    highedge = h.GetXaxis().GetBinLowEdge(bini+1)
+    return [bini, h.GetXaxis().GetNbins(), fit_type, lowedge, highedge, y_edges, contents, errors, h_p.GetEntries(), builddir]
+
+## Fit a single y-slice (see AnalysisTools.fit_y_slices). Module level so multiprocessing can pickle it
+## Returns [bini, [lowedge, highedge, center], [mean, mean_err], [res, res_err]], or None if the slice is skipped or its fit fails
+def fit_slice(task):
+
+    bini, n_bins, fit_type, lowedge, highedge, y_edges, contents, errors, n_entries, builddir = task
+
+    ## Rebuild the projection from its bin contents
+    h_p = ROOT.TH1D('h_p_{}'.format(bini), '', len(y_edges)-1, array('d', y_edges))
+    h_p.SetDirectory(0)
+    for j in range(len(contents)):
+        h_p.SetBinContent(j, contents[j])
+        h_p.SetBinError(j, errors[j])
+    h_p.SetEntries(n_entries)
+    n_entries     = int(n_entries)
+    refit_counter = 0
+    center        = (lowedge + highedge) / 2.
+
+    ## Two fit methods, Double crystal ball or gausian
+    if fit_type == "dcb":
+
+        ## Use a compiled c version of the double crystal ball function (built in the cache, loaded once per process). Faster...
+        RootLoader.load_dcb(builddir)                               # Already loaded by fit_y_slices, unless called on its own
+        dcb = ROOT.TF1("dcb", ROOT.double_xtal_ball, -2, 2, 5)      # -2 to 2 is my fit range
+        dcb.SetParNames("c","mu","sig","A","n")              
+        
+        ## Set par. limits to help the minimizer converge
+        dcb.SetParLimits(0 , 0 ,99999)                              # c >= 0
+        dcb.SetParLimits(1 ,-2   ,2  )                              # mu between -1 and 1
+        dcb.SetParLimits(2 , 0.01,0.2)                              # sigma between 10 and 200ps
+        dcb.SetParLimits(3 , 0.01,9  )                              # A1 > 0  (as SliceFitter.DCB_LIMITS, the tail is undefined at 0)
+        dcb.SetParLimits(4 , 0.01,9 )                               # n  > 0
+        dcb.SetParameters(100, 0.3, 0.05, 1, 1)                     # Some guesses to help things along 
+
+        max_n_refits   = 5
+        min_n_events   = 100
+        if (n_entries < min_n_events): 
+            print "Slice {}/{} skipped, too few events ({}<{})".format(bini, n_bins, n_entries, min_n_events)
+            return None
+
+        h_p.Fit("gaus","QRM")                                       # Use a gaussian to quickly get a good init value for peak, mean, and sigma
+        p_gaus = h_p.GetFunction("gaus").GetParameters()
+        dcb.SetParameters(p_gaus[0], p_gaus[1], p_gaus[2], 1, 1)    # Use the gaussian parameters to help the dcb
+        fit    = h_p.Fit("dcb", "QBRM")                             # Try the fit again
+
+        tr = ROOT.TRandom()
+        tr.SetSeed(1000 + bini)                                     # Fixed seed per slice, so refits are reproducible (and the same serial or parallel)
+        status = ROOT.gMinuit.fCstatu                               # Get the fit status, IE 'OK', 'CONVERGED', 'FAILED'
+        while (not 'OK' in status) and (not 'CONVERGED' in status) and (not 'LIMIT_REACHED' in status):
+
+            print 'Fit failed for slice number {} with {} entries. Attempting refit {}/{}'.format(bini, n_entries, refit_counter+1, max_n_refits)
+            dcb.SetParameter(0, tr.Uniform(  0, 9999))              # Reset the parameters 
+            dcb.SetParameter(1, tr.Uniform( -1, 1   ))
+            dcb.SetParameter(2, tr.Uniform(  0, 0.2 ))
+            dcb.SetParameter(3, tr.Uniform(  0, 5   ))
+
+            fit = h_p.Fit("dcb", "QBRMWE")                          # Try the fit again
+            status = ROOT.gMinuit.fCstatu                           # Get the fit status
+            refit_counter += 1
+
+            if ('OK' in status) or ('CONVERGED' in status):
+                print 'Refit successful!'
+            if refit_counter == max_n_refits:
+                print 'Refit limit reached, ommiting slice {}'.format(bini)
+                status = 'LIMIT_REACHED'
+
+        if refit_counter == max_n_refits: return None
+
+        print "Slice {}/{} fit successfully".format(bini, n_bins)
+
+        chi2 = dcb.GetChisquare()/dcb.GetNDF()
+
+        mean = dcb.GetParameter(1)
+        res  = dcb.GetParameter(2)
+        mean_err = chi2*dcb.GetParError(1)
+        res_err  = chi2*dcb.GetParError(2)
+
+        return [bini, [lowedge, highedge, center], [mean, mean_err], [res, res_err]]
+           
+    if fit_type == "gaus":
+
+        max_n_refits  = 50
+        min_n_events  = 50
+        if (n_entries < min_n_events): 
+            print "Slice {}/{} skipped, too few events ({}<{})".format(bini, n_bins, n_entries, min_n_events)
+            return None
+
+        fit = h_p.Fit("gaus", "QM")
+
+        status = ROOT.gMinuit.fCstatu                               # Get the fit status, IE 'OK', 'CONVERGED', 'FAILED'
+        while (not 'OK' in status) and (not 'CONVERGED' in status) and (not 'LIMIT_REACHED' in status):
+
+            print 'Fit failed for slice number {} with {} entries. Attempting refit {}/{}'.format(bini, n_entries, refit_counter+1, max_n_refits)
+            fit = h_p.Fit("gaus", "QM")                              # Try the fit again
+
+            status = ROOT.gMinuit.fCstatu                           # Get the fit status
+            refit_counter += 1
+
+            if ('OK' in status) or ('CONVERGED' in status):
+                print 'Refit successful!'
+            if refit_counter == max_n_refits:
+                print 'Refit limit reached, ommiting slice {}'.format(bini)
+                status = 'LIMIT_REACHED'
+
+        if refit_counter == max_n_refits: return None
+
+        print "Slice {}/{} fit successfully".format(bini, n_bins)
+
+        gaus = h_p.GetFunction("gaus")                              # The fitted copy attached to the slice
+        chi2 = gaus.GetChisquare()/gaus.GetNDF()
+        mean = gaus.GetParameter(1)
+        res  = gaus.GetParameter(2)
+        mean_err = chi2*gaus.GetParError(1)
+        res_err  = chi2*gaus.GetParError(2)
+
+        return [bini, [lowedge, highedge, center], [mean, mean_err], [res, res_err]]
+
+## Batched alternative to fit_slice: fits every slice of h at once with SliceFitter (fit_type 'gaus' or 'dcb')
+## Returns the same [bini, [lowedge, highedge, center], [mean, mean_err], [res, res_err]] entries, for the slices that were fit
+def fit_slices_batched(h, fit_type):
+    n_bins       = h.GetXaxis().GetNbins()
+    n_ybins      = h.GetYaxis().GetNbins()
+    counts       = np.array([[h.GetBinContent(i, j) for j in range(1, n_ybins+1)] for i in range(1, n_bins+1)])
+    y_edges      = [h.GetYaxis().GetBinLowEdge(j) for j in range(1, n_ybins+2)]
+    min_n_events = {'gaus': 50, 'dcb': 100}[fit_type]                                      # Same thresholds as fit_slice
+    fit          = SliceFitter.fit_slices(counts, y_edges, fit_type, min_n_events)
+
+    results = []
+    for k in range(n_bins):
+        bini = k+1
+        if fit['entries'][k] < min_n_events:
+            print "Slice {}/{} skipped, too few events ({}<{})".format(bini, n_bins, int(fit['entries'][k]), min_n_events)
+            continue
+        if not fit['ok'][k]:
+            print 'Fit failed for slice number {} with {} entries, ommiting slice {}'.format(bini, int(fit['entries'][k]), bini)
+            continue
+        if fit['status'][k] == SliceFitter.MAX_ITER: print "Slice {}/{} fit stopped at the iteration limit, kept (finite chi2 and errors)".format(bini, n_bins)
+        else:                                        print "Slice {}/{} fit successfully".format(bini, n_bins)
+
+        lowedge  = h.GetXaxis().GetBinLowEdge(bini)
+        highedge = h.GetXaxis().GetBinLowEdge(bini+1)
+        center   = (lowedge + highedge) / 2.
+        results.append([bini, [lowedge, highedge, center], [fit['mean'][k], fit['mean_err'][k]], [fit['sigma'][k], fit['sigma_err'][k]]])
+    return results
 
 class AnalysisTools:
 
-    def __init__(self, args, savepath, filei, centers):
-        self.args   = args
-        self.energy = self.args.e
+    def __init__(self, context):
+        self.args   = context.args
+        self.energy = context.energy
         
-        self.file     = filei[0]
-        self.savepath = savepath
+        self.file     = context.file
+        self.savepath = context.savepath
 
-        self.ft  = FileTools.FileTools(args)
+        self.ft  = FileTools.FileTools(self.args)
 
-        rit = RunInfoTools.RunInfoTools(args, savepath, filei)
-        self.ampbias                 = rit.ampbias
-        self.xtal                    = rit.xtal
-        self.x_center, self.y_center = centers[0], centers[1] 
-        self.Aeff                    = rit.Aeff
-
-        # These lines annoyingly needed to make fitResult work :(
-        gSystem.Load("/afs/cern.ch/user/m/mplesser/H4Analysis/CfgManager/lib/libCFGMan.so")
-        gSystem.Load("/afs/cern.ch/user/m/mplesser/H4Analysis/lib/libH4Analysis.so")
-        gSystem.Load("/afs/cern.ch/user/m/mplesser/H4Analysis/DynamicTTree/lib/libDTT.so")
+        self.context                 = context                                      # Per-file RunContext, see RunContext.py
+        self.ampbias                 = context.ampbias
+        self.xtal                    = context.xtal
+        self.logfile                 = context.logfile
+        self.x_center, self.y_center = context.centers[0], context.centers[1] 
+        self.Aeff                    = context.Aeff
+        self.engine                  = context.cut_engine()
 
     ## When we assign a y-value (resolution) to a bin, by default it is assigned to the mid-point as an x-value (Aeff).
     ## Really we should assign it to be the mean of the Aeff distribution in that bin. This fn makes that adjustment.
-    def adjust_bin_centers(self, h):
-
-        t_file    = TFile(self.file)
-        t_tree    = t_file.Get("h4")
+    ## Graphs sharing the same bins (IE hh_1 and hh_2 from fit_y_slices) can be passed together, the bin means are only computed once
+    def adjust_bin_centers(self, *graphs):
 
+        h         = graphs[0]
         n_bins    = h.GetN()
-        xs        = []
-        ys        = h.GetY()
-        xerr_low  = []
-        xerr_high = []
-        yerr      = []
-        for i in range(n_bins):
-            lbound = h.GetX()[i] - h.GetEXlow()[i]                                                              # Lower bin edge of bini
-            ubound = h.GetX()[i] + h.GetEXhigh()[i]                                                             # Upper bin edge of bini
-            h_aeff = TH1F("h_aeff", "", 100, 0, 2000)
-            t_tree.Draw(self.Aeff+">>h_aeff", TCut("{0}>={1} && {0}<={2}".format(self.Aeff, lbound, ubound)) )  # Plot Aeff for just bini
-            xs.append(h_aeff.GetMean())
-            xerr_low.append(xs[-1]-lbound)                                                                      # Xerr reflects the binwidth with the center shifted
-            xerr_high.append(ubound-xs[-1])                                                                     # Xerr_low + xerr_high = original binwidth
-            yerr.append(h.GetErrorY(i))
-        xs        = array('d', xs       )
-        xerr_low  = array('d', xerr_low )
-        xerr_high = array('d', xerr_high)
-        yerr      = array('d', yerr     )
-        return TGraphAsymmErrors(len(xs), xs, ys, xerr_low, xerr_high, yerr, yerr)
+        lbounds   = [h.GetX()[i] - h.GetEXlow()[i]  for i in range(n_bins)]                                    # Lower bin edge of bini
+        ubounds   = [h.GetX()[i] + h.GetEXhigh()[i] for i in range(n_bins)]                                    # Upper bin edge of bini
+        means     = BinnedMeans(lbounds, ubounds)
+        for aeff in self.engine.iter_values(self.Aeff): means.add(aeff)                                         # One pass over the events (chunk by chunk with --stream)
+        xs        = means.means()                                                                               # Mean Aeff of every bin
+        xerr_low  = array('d', [x-l for x, l in zip(xs, lbounds)])                                             # Xerr reflects the binwidth with the center shifted
+        xerr_high = array('d', [u-x for x, u in zip(xs, ubounds)])                                             # Xerr_low + xerr_high = original binwidth
+        xs        = array('d', xs)
+
+        adjusted  = []
+        for gr in graphs:
+            ys    = gr.GetY()
+            yerr  = array('d', [gr.GetErrorY(i) for i in range(n_bins)])
+            adjusted.append(ROOT.TGraphAsymmErrors(n_bins, xs, ys, xerr_low, xerr_high, yerr, yerr))
+        if len(adjusted) == 1: return adjusted[0]
+        return adjusted
 
     ## Adjust dT using a linear fit, to correct "mean walking" location effects in the deposition
-    def dt_linear_correction(self, tree, cut):
+    @Profiler.profiled('linear correction')
+    def dt_linear_correction(self, cut):
 
         ## As in RunInfoTools.py, which axis we do the linear fit against and which center to use depends on run (up/down vs left/right)
         ## This tells you which to use
@@ -71,80 +323,45 @@ class AnalysisTools:
             elif (self.xtal[2] == 'C3left') or (self.xtal[2] == 'C3right'):
                 return self.x_center, 'fitResult[0].x()'
 
-        ## Checks to see if any points shouldn't be trusted based on a large residual, and returns TGraph without those points
-        ## Helps the linear correction remain accurate when one or more fits from fit_y_slices fails
-        def remove_outliers(gr):                                                   # gr input is a TGraphAsymmErrors TObject
-            x         = array('d', [])                                             # Initialize the arrays to create the filteres TGraph output
-            y         = array('d', [])
-            xerr_low  = array('d', [])
-            xerr_high = array('d', [])
-            yerr      = array('d', [])
-            n_points  = gr.GetN()
-            median    = np.median([gr.GetY()[i] for i in range(n_points)])
-            for i in range(n_points):
-                if abs(gr.GetY()[i] - median) < 0.5:                               # Only accept points who have a residual between resolution fit means and the median <500ps
-                    x.append(gr.GetX()[i])                                         # Add all the usual points needed for a TGraphAsymmError constructor, etcetc
-                    y.append(gr.GetY()[i])
-                    xerr_low.append(gr.GetEXlow()[i])
-                    xerr_high.append(gr.GetEXhigh()[i])
-                    yerr.append(gr.GetEYhigh()[i])
-                else:
-                    print "Outlier found at point {0}: fit_mean = {1:4.3f} \t median fit_mean = {2:4.3f} \t residual = {3:4.3f}".format(i, gr.GetY()[i], median, abs(gr.GetY()[i] - median))
-            return TGraphAsymmErrors(len(x), x, y, xerr_low, xerr_high, yerr, yerr) # Return a TGraph with any outliers removed
-        
-        ## See in RunInfoTools.py, but there is a known non-linear dip around the center. This fn creates a fit_line that ignores points around the center.
-        def pol1_ignore_center(x,par):
-            if (x[0] < (lin_fit_center + 1.5)) and (x[0] > (lin_fit_center - 1.5)):
-                TF1.RejectPoint()
-                return 0
-            return par[0] + par[1]*x[0]
-
         lin_fit_center, axis = lin_fit_run_info()                                                          # Initialize the info about which axis to use
         ## Draw the plot and fit y slices to fit linearly
         nbins = 30
         fit_lbound = lin_fit_center - 4.0
         fit_ubound = lin_fit_center + 4.0
-        hadjust    = TH2F('hadjust', '', nbins, fit_lbound, fit_ubound, 100, -2, 2)
+        hadjust    = ROOT.TH2F('hadjust', '', nbins, fit_lbound, fit_ubound, 100, -2, 2)
         dt         = "fit_time[{}]-fit_time[{}]".format(self.xtal[0],self.xtal[1])
-        tree.Draw("{0}:{1}>>hadjust".format(dt, axis), TCut(cut), "COLZ")
+        self.engine.draw(hadjust, "{0}:{1}".format(dt, axis), cut)
 
         print "Fitting y-slices..."
         hadjust_1  = self.fit_y_slices(hadjust, "gaus")[0]                                  # Mean of the dt distribution plotted against the position coordinate
-        hadjust_1  = remove_outliers(hadjust_1)
-        slope = 1                                                                   # Enter the coming while loop directly instead of fitting once, getting the slope, and then entering
-        if hadjust_1.GetN() < 4:                                                    # If outlier removal leaves < 4 points, that's not enough for a trustworthy fit
+        n_points   = hadjust_1.GetN()
+        x          = np.array([hadjust_1.GetX()[i]     for i in range(n_points)])
+        y          = np.array([hadjust_1.GetY()[i]     for i in range(n_points)])
+        xerr_low   = np.array([hadjust_1.GetEXlow()[i]  for i in range(n_points)])
+        xerr_high  = np.array([hadjust_1.GetEXhigh()[i] for i in range(n_points)])
+        yerr       = np.array([hadjust_1.GetEYhigh()[i] for i in range(n_points)])
+
+        ## Checks to see if any points shouldn't be trusted based on a large residual, and drops those points
+        ## Helps the linear correction remain accurate when one or more fits from fit_y_slices fails
+        keep       = outlier_mask(y, 0.5)                                                   # Only accept points who have a residual between fit means and the median <500ps
+        for i in np.where(~keep)[0]:
+            print "Outlier found at point {0}: fit_mean = {1:4.3f} \t median fit_mean = {2:4.3f} \t residual = {3:4.3f}".format(i, y[i], np.median(y), abs(y[i] - np.median(y)))
+        x, y, xerr_low, xerr_high, yerr = x[keep], y[keep], xerr_low[keep], xerr_high[keep], yerr[keep]
+        hadjust_1  = ROOT.TGraphAsymmErrors(len(x), array('d', x), array('d', y), array('d', xerr_low), array('d', xerr_high), array('d', yerr), array('d', yerr))
+
+        ## See in RunInfoTools.py, but there is a known non-linear dip around the center, so points within 1.5mm of it are masked out of the fit
+        dt0, slope, red_chi2 = 0, 0, 'N/A'
+        use        = np.abs(x - lin_fit_center) >= 1.5
+        if np.count_nonzero(use) < 4:                                               # If outlier removal leaves < 4 points, that's not enough for a trustworthy fit
             print "Not enough points remaining for accurate linear fit. Dt vs Dampl slope set to 0"
-            slope = 0
-
-        refit_counter = 1
-        max_n_refits  = 10
-        poly1 = TF1("poly1", pol1_ignore_center, fit_lbound, fit_ubound, 2)                      
-        while (abs(slope) > 0.1):                                                   # Helps tell if the fit failed
-            print "Attempting Dt linear fit {}/{}".format(refit_counter, max_n_refits)
-            ## Reset parameters randomly (within ranges) and attempt a fit
-            tr = TRandom()
-            tr.SetSeed(0)
-            poly1.SetParameter(0, tr.Uniform(-2,2)      )   
-            poly1.SetParameter(1, tr.Uniform(-0.1, 0.1) )
-            poly1.SetParLimits(0, -2  , 2)
-            poly1.SetParLimits(1, -0.5, 0.5)
-            hadjust_1.Fit("poly1", "QFWBRN")
- 
-            ## Get the fit parameters
-            dt0   = poly1.GetParameter(0)                             
-            slope = poly1.GetParameter(1)
-            if poly1.GetNDF() != 0:
-                red_chi2  = hadjust_1.Chisquare(poly1)/poly1.GetNDF()
-            else: 
-                red_chi2 = 'N/A'
-             
-            if (refit_counter == max_n_refits) and (abs(slope) > 0.1):
+        else:
+            dt0, slope, red_chi2 = weighted_line_fit(x[use], y[use], yerr[use])
+            if abs(slope) > 0.1:                                                    # Helps tell if the fit failed
                 print "Dt adjustment linear fit failed. Slope set to 0"
                 slope = 0
-            refit_counter += 1
 
         ## Draw ("Fit") the line, but draw it over the ignored center-region as well
-        p1 = TF1("p1", "pol1", fit_lbound, fit_ubound)
+        p1 = ROOT.TF1("p1", "pol1", fit_lbound, fit_ubound)
         p1.FixParameter(0, dt0)                                                                                         # Fix the parameters. You aren't even fitting, just 
         p1.FixParameter(1, slope)                                                                                       # a way to draw the fit and plot together so they save easilly
         hadjust_1.Draw()
@@ -153,40 +370,156 @@ class AnalysisTools:
         print 'Dt adjustment parameters: slope = {:.7f}, dt-intercept = {:.3f}, reduced chi2: {}'.format(slope, dt0, red_chi2)
         
         ## Some info for the log file       
-        with open(self.savepath+self.xtal[2]+'_log.txt', 'a') as f:
+        with open(self.logfile, 'a') as f:
             f.write("\nDt adjustment parameters:\n")
             f.write("\tSlope:       \t\t {}\n".format(slope))
             f.write("\tdt-intercept:\t\t {}\n".format(dt0))
             f.write("\tReduced chi2:\t\t {}\n".format(red_chi2))
+        self.context.record('lincorr', {'slope': slope, 'intercept': dt0, 'red_chi2': red_chi2})
+
+        ## Add a linear correction to dt: dt --> dt-(slope * dx), as a numpy column the cut engine can plot and cut on
+        ## Given as a function of the engine, so with --stream it's computed chunk by chunk
+        def dt_corrected(engine):
+            return engine.values(dt) - slope*(engine.values(axis) - lin_fit_center)
+        self.engine.define_column('dt_lincorr', dt_corrected)
+        adjusted_plot = "dt_lincorr:{}".format(self.Aeff)
+        return adjusted_plot
 
-        ## Add a linear correction to dt: dt --> dt-(slope * dx)
-        adjusted_plot = "( ({0}) - ( {1} * ({2}-{3}) ) ):{4}".format(dt,slope,axis,lin_fit_center,self.Aeff)
+    ## Adjust dT using a 2D map of the mean dt vs the hodoscope position (see CorrectionMap.py), in place of dt_linear_correction
+    ## The map of this freq/temp/position is reused if one was saved around this file's target center, otherwise (or with --mr)
+    ## it's built from this file, and saved if save is True. By default --jobs workers don't save, DtPlotter.main builds the maps before the pool
+    ## Built from the events passing the track, clock and chi2 cuts in a box around the target center, the gap included,
+    ## so the map doesn't depend on the other cut options. Needs the named cuts from PlotterTools.define_cuts()
+    @Profiler.profiled('map correction')
+    def dt_map_correction(self, save=None):
+
+        if save is None: save = getattr(self.args, 'jobs', 1) <= 1
+        dt      = "fit_time[{}]-fit_time[{}]".format(self.xtal[0],self.xtal[1])
+        mapfile = self.ft.correction_location(self.xtal[2])
+        cmap    = None if getattr(self.args, 'mr', False) == True else CorrectionMap.CorrectionMap.load(mapfile)
+        if (cmap is not None) and (cmap.matches([self.x_center, self.y_center]) == False):
+            print "The saved dt correction map was built around another target center ({}, this file's is {}), not using it".format(cmap.info.get('center', '?'), [self.x_center, self.y_center])
+            cmap = None
+        if cmap is not None:
+            print "Using the dt correction map from {} ({})".format(mapfile, os.path.basename(cmap.info.get('source', '?')))
+        else:
+            print "Building the dt correction map..."
+            def chunks():
+                for view in self.engine.chunks():
+                    mask = view.named_mask('tracks', 'clock', 'chi2')
+                    yield [view.values('fitResult[0].x()')[mask], view.values('fitResult[0].y()')[mask], view.values(dt)[mask]]
+            info = {'source': os.path.abspath(self.file), 'center': [self.x_center, self.y_center], 'created': time.time()}
+            cmap = CorrectionMap.CorrectionMap.build(chunks(), [self.x_center, self.y_center], info=info)
+            if cmap is None: sys.exit("\nNo position bin has enough events for a dt correction map, aborting...")
+            if save == True:
+                cmap.save(mapfile)
+                print "Saved to {}".format(mapfile)
+        summary = cmap.summary()
+        print 'Dt correction map: {} bins filled, {} events, spread = {:.3f} ns, reference dt = {:.3f}'.format(summary['bins_filled'], summary['events'], summary['spread'], summary['reference'])
+
+        ## Some info for the log file
+        with open(self.logfile, 'a') as f:
+            f.write("\nDt correction map ({}):\n".format(mapfile))
+            f.write("\tBuilt from:  \t\t {}\n".format(cmap.info.get('source', '?')))
+            f.write("\tBins filled: \t\t {} of {}\n".format(summary['bins_filled'], cmap.table.size))
+            f.write("\tEvents:      \t\t {}\n".format(summary['events']))
+            f.write("\tSpread (ns): \t\t {}\n".format(summary['spread']))
+        self.context.record('mapcorr', summary)
+
+        ## dt --> dt - (map(x, y) - reference), a lookup per event. Given as a function of the engine, so with --stream it's computed chunk by chunk
+        def dt_corrected(engine):
+            return cmap.correct(engine.values(dt), engine.values('fitResult[0].x()'), engine.values('fitResult[0].y()'))
+        self.engine.define_column('dt_mapcorr', dt_corrected)
+        adjusted_plot = "dt_mapcorr:{}".format(self.Aeff)
         return adjusted_plot
 
 
     ## Fit the resolution vs Aeff using a user-defined function
-    def fit_resolution(self, gr):
+    ## method: 'minuit'        -> Minuit with random restarts (the original method)
+    ##         'linear'        -> closed-form weighted least squares in sigma^2 (see linear_resolution_fit), deterministic
+    ##         'linear_minuit' -> the closed-form result, refined by a single Minuit fit started from it
+    ##         'unbinned'      -> maximum likelihood over the events of plot p under cut (see UnbinnedFit), gr is only drawn on
+    @Profiler.profiled('resolution fit')
+    def fit_resolution(self, gr, method=None, p=None, cut=''):
+
+        if method is None: method = getattr(self.args, 'rf', 'minuit')
     
         ## The function used to fit our distribution. N/Aeff (+) sqrt(2)*c, (+) -> sum in quadrature
         def userfit(x,par):
             if x[0]>0:
                 fit = pow(pow(par[0]/(x[0]),2) + 2*pow(par[1],2), 0.5)                                
                 return fit
-        userfit = TF1('userfit', userfit, 1, 2000, 2)  
+        userfit = ROOT.TF1('userfit', userfit, 1, 2000, 2)  
         userfit.SetParameters(100, 0.05)                     # Set a guess for the parameters (N, c)
     
         print
         fit_status = ''
         refit_counter = 0
         max_n_refits  = 100
-        while (not 'OK' in fit_status) and (not 'CONVERGED' in fit_status):                         # As long as the fit status is not a good one, keep trying
+        if method in ['linear', 'linear_minuit']:
+            n_points  = gr.GetN()
+            lin       = linear_resolution_fit([gr.GetX()[i] for i in range(n_points)], [gr.GetY()[i] for i in range(n_points)], [gr.GetErrorY(i) for i in range(n_points)])
+            if lin is not None: print 'Closed-form resolution fit: N = {:.4f} +- {:.4f}, c = {:.5f} +- {:.5f}'.format(lin[0], lin[2], lin[1], lin[3])
+            if lin is None:                                                                             # Reported as a failed fit, as for the other methods
+                print 'Closed-form resolution fit failed, fewer than 2 usable points or a singular system ({} points)'.format(n_points)
+                refit_counter = max_n_refits
+            elif (abs(lin[1]) < 0.01) or (abs(lin[1]) > 0.2):                                           # Same sanity check on the constant term as below
+                print 'Bad constant term value, fit discarded'
+                refit_counter = max_n_refits
+            elif method == 'linear':
+                userfit.FixParameter(0, lin[0])                                                         # Fix the parameters. Not fitting, just a way to draw
+                userfit.FixParameter(1, lin[1])                                                         # the fit and plot together so they save easilly
+                gr.Fit("userfit", "QRB")
+                fit_status = 'CLOSED-FORM'
+                print 'Fit successful!'
+            else:
+                userfit.SetParameters(lin[0], lin[1])                                                   # Start Minuit at the closed-form solution
+                gr.Fit("userfit", "QRM")
+                fit_status = ROOT.gMinuit.fCstatu
+                if (('OK' in fit_status) or ('CONVERGED' in fit_status)) and (abs(userfit.GetParameter(1)) >= 0.01) and (abs(userfit.GetParameter(1)) <= 0.2):
+                    print 'Fit successful!'
+                else:                                                                                   # Refinement failed, keep the closed-form result
+                    print 'Minuit refinement failed ({}), using the closed-form result'.format(fit_status.strip())
+                    userfit.FixParameter(0, lin[0])
+                    userfit.FixParameter(1, lin[1])
+                    gr.Fit("userfit", "QRB")
+                    fit_status = 'CLOSED-FORM'
+
+        elif method == 'unbinned':
+            ub = self.unbinned_resolution_fit(p, cut)
+            if ub is None:
+                print 'Too few events for the unbinned resolution fit'
+                refit_counter = max_n_refits
+            else:
+                print 'Unbinned resolution fit: N = {:.4f} +- {:.4f}, c = {:.5f} +- {:.5f} ({} events, {} likelihood evaluations)'.format(
+                      ub['N'], ub['N_err'], ub['c'], ub['c_err'], ub['events'], ub['calls'])
+                if (ub['converged'] == False) or (ub['c'] < 0.01) or (ub['c'] > 0.2):                  # Same sanity check on the constant term as below
+                    print 'Unbinned fit did not converge or has a bad constant term value, fit discarded'
+                    refit_counter = max_n_refits
+                else:
+                    n_points = gr.GetN()
+                    lin      = [ub['N'], ub['c'], ub['N_err'], ub['c_err'], resolution_red_chi2([gr.GetX()[i] for i in range(n_points)],
+                                [gr.GetY()[i] for i in range(n_points)], [gr.GetErrorY(i) for i in range(n_points)], ub['N'], ub['c'])]
+                    userfit.FixParameter(0, lin[0])                                                     # Drawn on the slice widths, as for 'linear'
+                    userfit.FixParameter(1, lin[1])
+                    gr.Fit("userfit", "QRB")
+                    fit_status = 'UNBINNED'
+                    print 'Fit successful!'
+                with open(self.logfile, 'a') as f:
+                    f.write("\nUnbinned resolution fit ({} mean{}):\n".format(getattr(self.args, 'um', 'walk'), ', flat tail' if getattr(self.args, 'ut', False) else ''))
+                    f.write("\tEvents:                \t{}\n".format(ub['events']))
+                    f.write("\tLikelihood evaluations:\t{}\n".format(ub['calls']))
+                    f.write("\tdt mean:               \t{} + {}/Aeff ns\n".format(ub['mu0'], ub.get('mu1', 0.)))
+                    if 'tail_fraction' in ub: f.write("\tTail fraction:         \t{}\n".format(ub['tail_fraction']))
+
+        while (method == 'minuit') and (not 'OK' in fit_status) and (not 'CONVERGED' in fit_status):   # As long as the fit status is not a good one, keep trying
             print 'Attempting resolution fit {}/{}'.format(refit_counter+1, max_n_refits)
-            tr = TRandom()
+            tr = ROOT.TRandom()
             tr.SetSeed(0)
             userfit.SetParameter(0, tr.Uniform(0, 10000  )) # Re-guess the parameters
             userfit.SetParameter(1, tr.Uniform(0.02, 0.05)) # Re-guess the parameters 
             fit = gr.Fit("userfit", "QRM")                  # Try the fit again
-            fit_status = gMinuit.fCstatu                    # Get the fit status
+            fit_status = ROOT.gMinuit.fCstatu               # Get the fit status
             refit_counter += 1
 
             if ('OK' in fit_status) or ('CONVERGED' in fit_status):
@@ -205,7 +538,12 @@ class AnalysisTools:
             Nterm     = 1000*abs(userfit.GetParameter(0))           # Get the noise    term's fit value (IN PICOSECONDS) (abs b/c of sum in quad.)
             cterm_err = 1000*userfit.GetParError(1)        
             Nterm_err = 1000*userfit.GetParError(0)        
-            if userfit.GetNDF() != 0:
+            if fit_status in ['CLOSED-FORM', 'UNBINNED']:           # Parameters were fixed for drawing, the errors come from the linear/unbinned fit
+                cterm_err = 1000*lin[3]
+                Nterm_err = 1000*lin[2]
+            if fit_status in ['CLOSED-FORM', 'UNBINNED']:
+                red_chi2  = lin[4]                                  # NDF of the drawn (fixed) function would not count the 2 fitted parameters
+            elif userfit.GetNDF() != 0:
                 red_chi2  = gr.Chisquare(userfit)/userfit.GetNDF()   # Get the reduced chi2 of the fit
             else:
                 red_chi2  = 'N/A'
@@ -221,141 +559,65 @@ class AnalysisTools:
             Nterm_err = 0
             red_chi2  = 'N/A'
 
-        gStyle.SetOptFit(1)                                 # Include fit parameters in the stats box
-        gPad.Modified()
-        gPad.Update()
+        ROOT.gStyle.SetOptFit(1)                            # Include fit parameters in the stats box
+        ROOT.gPad.Modified()
+        ROOT.gPad.Update()
 
         # Some info for the log file
-        with open(self.savepath+self.xtal[2]+'_log.txt', 'a') as f:
+        with open(self.logfile, 'a') as f:
             f.write("\nResolution fitting parameters:  \n")
             f.write("\tConstant term:       \t{:.2f} ps\n".format(cterm)    )
             f.write("\tConstant term error: \t{:.2f} ps\n".format(cterm_err))
             f.write("\tNoise    term:       \t{:.2f} ps\n".format(Nterm)    )
             f.write("\tNoise    term error: \t{:.2f} ps\n".format(Nterm_err))
             f.write("\tReduced  fit chi2:   \t{}       \n".format(red_chi2))
+        self.context.record('resolution', {'cterm': cterm, 'cterm_err': cterm_err, 'nterm': Nterm, 'nterm_err': Nterm_err, 'red_chi2': red_chi2})
+
+        return cterm, cterm_err, Nterm, Nterm_err, red_chi2
+
+    ## Unbinned fit of the -r plot p (dt:Aeff) under cut, over the events inside the plot's bounds. None if there are too few
+    ## With --stream the selected events are gathered a chunk at a time, only the two columns after the cut are held
+    def unbinned_resolution_fit(self, p, cut):
+        if p is None: return None
+        if self.engine.chunk_size is None:
+            dt, aeff = self.engine.draw_columns(p[0], cut)
+        else:
+            chunks   = list(self.engine.iter_columns(p[0], cut))
+            dt, aeff = [np.concatenate([columns[i] for columns in chunks]) for i in range(2)]
+        keep = (aeff >= p[3]) & (aeff < p[4])
+        return UnbinnedFit.fit(dt[keep], aeff[keep], getattr(self.args, 'um', 'walk'), getattr(self.args, 'ut', False), dt_range=[p[6], p[7]])
 
     ## Advanced version of FitSlicesY(). Uses a double sided crystal ball fit
-    def fit_y_slices(self, h, fit_type="gaus", adjust_bins=False):
+    ## Slices are independent, so with n_workers > 1 (or --fw) they are fit in a process pool. Results come back in bin order either way
+    ## fit_type 'gaus_batch' or 'dcb_batch' fits all slices at once with the vectorized SliceFitter instead of Minuit
+    @Profiler.profiled('slice fitting')
+    def fit_y_slices(self, h, fit_type="gaus", adjust_bins=False, n_workers=None):
         
-        bins     = []
-        hh_1_tmp = []
-        hh_2_tmp = []
+        if n_workers is None: n_workers = getattr(self.args, 'fw', 1)
+        if n_workers == 0:    n_workers = multiprocessing.cpu_count()             # 0 means use every core
+
         n_bins   = h.GetXaxis().GetNbins()
-        for bini in range(1, n_bins+1):
-
-            h_p = h.ProjectionY('h_p',bini,bini)                                # Get the distribution in y as  TH1 for bin# 'bini'
-            refit_counter = 0
-
-            ## Two fit methods, Double crystal ball or gausian
-            if fit_type == "dcb":
-
-                ## Use a c version of the double crystal ball function. Faster...
-                gROOT.ProcessLine(".x /afs/cern.ch/user/m/mplesser/my_git/CERN_Co-op/DtPlotter/utilities/Double_Crystal_Ball_Fit.C")
-                dcb = TF1("dcb", double_xtal_ball, -2, 2, 5)                # -2 to 2 is my fit range
-                dcb.SetParNames("c","mu","sig","A","n")              
-                
-                ## Set par. limits to help the minimizer converge
-                dcb.SetParLimits(0 , 0 ,99999)                              # c >= 0
-                dcb.SetParLimits(1 ,-2   ,2  )                              # mu between -1 and 1
-                dcb.SetParLimits(2 , 0.01,0.2)                              # sigma between 10 and 200ps
-                dcb.SetParLimits(3 , 0   ,9  )                              # A1 >= 0
-                dcb.SetParLimits(4 , 0   ,9 )                               # n  >= 0
-                dcb.SetParameters(100, 0.3, 0.05, 1, 1)                     # Some guesses to help things along 
-
-                max_n_refits   = 5
-                min_n_events   = 100
-                n_entries      = int(h_p.GetEntries())
-                if (n_entries >= min_n_events): 
-                    h_p.Fit("gaus","QRM")                                       # Use a gaussian to quickly get a good init value for peak, mean, and sigma
-                    p_gaus = gaus.GetParameters()
-                    dcb.SetParameters(p_gaus[0], p_gaus[1], p_gaus[2], 1, 1)    # Use the gaussian parameters to help the dcb
-                    fit    = h_p.Fit("dcb", "QBRM")                             # Try the fit again
-
-                    status = gMinuit.fCstatu                                    # Get the fit status, IE 'OK', 'CONVERGED', 'FAILED'
-                    while (not 'OK' in status) and (not 'CONVERGED' in status) and (not 'LIMIT_REACHED' in status):
-
-                        print 'Fit failed for slice number {} with {} entries. Attempting refit {}/{}'.format(bini, n_entries, refit_counter+1, max_n_refits)
-                        tr = TRandom()
-                        tr.SetSeed(0)
-                        dcb.SetParameter(0, tr.Uniform(  0, 9999))              # Reset the parameters 
-                        dcb.SetParameter(1, tr.Uniform( -1, 1   ))
-                        dcb.SetParameter(2, tr.Uniform(  0, 0.2 ))
-                        dcb.SetParameter(3, tr.Uniform(  0, 5   ))
-
-                        fit = h_p.Fit("dcb", "QBRMWE")                          # Try the fit again
-                        status = gMinuit.fCstatu                                # Get the fit status
-                        refit_counter += 1
-
-                        if ('OK' in status) or ('CONVERGED' in status):
-                            print 'Refit successful!'
-                        if refit_counter == max_n_refits:
-                            print 'Refit limit reached, ommiting slice {}'.format(bini)
-                            status = 'LIMIT_REACHED'
-
-                    if refit_counter != max_n_refits:
-
-                        print "Slice {}/{} fit successfully".format(bini, n_bins)
-
-                        chi2 = dcb.GetChisquare()/dcb.GetNDF()
-
-                        mean = dcb.GetParameter(1)
-                        res  = dcb.GetParameter(2)
-                        mean_err = chi2*dcb.GetParError(1)
-                        res_err  = chi2*dcb.GetParError(2)
-
-                        lowedge  = h.GetXaxis().GetBinLowEdge(bini)
-                        highedge = h.GetXaxis().GetBinLowEdge(bini+1)
-                        center   = (lowedge + highedge) / 2.
-
-                        bins.append( [lowedge, highedge, center] )
-                        hh_1_tmp.append([mean, mean_err])
-                        hh_2_tmp.append([res, res_err])
-                elif (n_entries < min_n_events): 
-                    print "Slice {}/{} skipped, too few events ({}<{})".format(bini, n_bins, n_entries, min_n_events)
-                   
-            if fit_type == "gaus":
-
-                max_n_refits  = 50
-                min_n_events  = 50
-                n_entries = int(h_p.GetEntries())
-                if (n_entries >= min_n_events): 
-
-                    fit = h_p.Fit("gaus", "QM")
-
-                    status = gMinuit.fCstatu                                    # Get the fit status, IE 'OK', 'CONVERGED', 'FAILED'
-                    while (not 'OK' in status) and (not 'CONVERGED' in status) and (not 'LIMIT_REACHED' in status):
-
-                        print 'Fit failed for slice number {} with {} entries. Attempting refit {}/{}'.format(bini, n_entries, refit_counter+1, max_n_refits)
-                        fit = h_p.Fit("gaus", "QM")                              # Try the fit again
-
-                        status = gMinuit.fCstatu                                # Get the fit status
-                        refit_counter += 1
-
-                        if ('OK' in status) or ('CONVERGED' in status):
-                            print 'Refit successful!'
-                        if refit_counter == max_n_refits:
-                            print 'Refit limit reached, ommiting slice {}'.format(bini)
-                            status = 'LIMIT_REACHED'
-
-                    if refit_counter != max_n_refits:
-
-                        print "Slice {}/{} fit successfully".format(bini, n_bins)
-
-                        chi2 = gaus.GetChisquare()/gaus.GetNDF()
-                        mean = gaus.GetParameter(1)
-                        res  = gaus.GetParameter(2)
-                        mean_err = chi2*gaus.GetParError(1)
-                        res_err  = chi2*gaus.GetParError(2)
-
-                        lowedge  = h.GetXaxis().GetBinLowEdge(bini)
-                        highedge = h.GetXaxis().GetBinLowEdge(bini+1)
-                        center   = (lowedge + highedge) / 2.
-
-                        bins.append( [lowedge, highedge, center] )
-                        hh_1_tmp.append([mean, mean_err])
-                        hh_2_tmp.append([res, res_err])
-                if (n_entries < min_n_events): 
-                    print "Slice {}/{} skipped, too few events ({}<{})".format(bini, n_bins, n_entries, min_n_events)
+        if fit_type.endswith('_batch'):
+            results = fit_slices_batched(h, fit_type.split('_')[0])
+        else:
+            builddir = self.ft.cache_location()
+            if fit_type == 'dcb': RootLoader.load_dcb(builddir)                 # Before the --fw pool, so its workers inherit it. --jobs compiles it in DtPlotter.main
+            tasks   = []
+            for bini in range(1, n_bins+1):
+                h_p = h.ProjectionY('h_p',bini,bini)                            # Get the distribution in y as  TH1 for bin# 'bini'
+                tasks.append(slice_task(h, h_p, bini, fit_type, builddir))
+            if n_workers > 1:
+                pool    = multiprocessing.Pool(min(n_workers, n_bins))
+                results = pool.map(fit_slice, tasks)                            # map() keeps the bin order, so the output is the same as the serial loop
+                pool.close()
+                pool.join()
+            else:
+                results = [fit_slice(task) for task in tasks]
+        results  = [r for r in results if r is not None]
+
+        bins     = [r[1] for r in results]
+        hh_1_tmp = [r[2] for r in results]
+        hh_2_tmp = [r[3] for r in results]
 
         bins, hh_1_tmp, hh_2_tmp = zip(*filter(lambda x: abs(x[2][0])>0.01, zip(bins, hh_1_tmp, hh_2_tmp)))    # Remove points where the resolution is <10 ps because this means the fit failed
         bins, hh_1_tmp, hh_2_tmp = zip(*filter(lambda x: x[2][1]<0.10, zip(bins, hh_1_tmp, hh_2_tmp)))         # Remove points where the res. err.  is >100ps because this means the fit failed
@@ -366,14 +628,13 @@ class AnalysisTools:
         means_err       = array('d', [ x[1] for x in hh_1_tmp])
         resolutions     = array('d', [ x[0] for x in hh_2_tmp])
         resolutions_err = array('d', [ x[1] for x in hh_2_tmp])
-        hh_1 = TGraphAsymmErrors(len(bins), xs, means       , xerr, xerr, means_err      , means_err      ) 
-        hh_2 = TGraphAsymmErrors(len(bins), xs, resolutions , xerr, xerr, resolutions_err, resolutions_err) 
+        hh_1 = ROOT.TGraphAsymmErrors(len(bins), xs, means       , xerr, xerr, means_err      , means_err      ) 
+        hh_2 = ROOT.TGraphAsymmErrors(len(bins), xs, resolutions , xerr, xerr, resolutions_err, resolutions_err) 
         
         if adjust_bins == True:
             # The last minor adjustment, this moves the x_center of each bin to the mean of the Aeff distribution in that bin
             # Should only be used by things plotted against Aeff, IE resolution vs Aeff, but NOT dt vs dx
-            hh_1 = self.adjust_bin_centers(hh_1)
-            hh_2 = self.adjust_bin_centers(hh_2)
+            hh_1, hh_2 = self.adjust_bin_centers(hh_1, hh_2)
 
         return hh_1, hh_2
 
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import numpy as np
+from array import array
+
+'''
+    Variable-width binning of a column (IE Aeff for the dt vs Aeff color map) from its quantiles, in one pass over the events.
+    The quantiles are exact (from the sorted values) when the whole column is at hand, or read from a fine histogram sketch
+    (SKETCH_BINS bins between the bounds, edges good to (ub-lb)/SKETCH_BINS) when the events come in chunks (--stream).
+    Strategies, all returning nbins+1 (or fewer, see below) increasing edges from lb to ub:
+        equal    : every bin has the same number of events
+        hybrid   : equal-statistics bins up to split, fixed-width bins above it (the original -q binning)
+        mincount : fixed-width bins, with neighbours merged until every bin has at least min_count events
+    Equal-statistics edges that coincide (IE many identical values) are merged, so fewer bins may come back.
+'''
+
+SKETCH_BINS = 65536
+STRATEGIES  = ['equal', 'hybrid', 'mincount']
+
+## Distribution of a column between lb and ub: rank(x) is the number of values below x, value(k) the value below which k of them lie
+class Quantiles:
+
+    def __init__(self, lb, ub, exact=True):
+        self.lb, self.ub = float(lb), float(ub)
+        self.exact       = exact
+        self.parts       = []                                                       # exact: the in-range values of each chunk
+        self.counts      = np.zeros(SKETCH_BINS, dtype=np.int64)                    # sketch: counts in SKETCH_BINS bins from lb to ub
+        self.sorted      = None
+        self.cum         = None                                                     # sketch: cumulative counts, built on first use
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[(values >= self.lb) & (values < self.ub)]
+        if self.exact:
+            self.parts.append(values)
+            self.sorted = None
+        else:
+            bins = ((values - self.lb) * (SKETCH_BINS / (self.ub - self.lb))).astype(np.int64)
+            self.counts += np.bincount(np.minimum(bins, SKETCH_BINS-1), minlength=SKETCH_BINS)
+            self.cum     = None
+        return self
+
+    def total(self):
+        return self.rank(self.ub)
+
+    def rank(self, x):
+        if self.exact: return float(np.searchsorted(self.values(), x, side='left'))
+        return float(np.interp(x, self.sketch_edges(), self.cumulative()))
+
+    ## Edge splitting the values into k below and the rest above. Exact: halfway between the k-th and (k+1)-th smallest values
+    def value(self, k):
+        if self.exact:
+            v = self.values()
+            k = int(round(k))
+            if k <= 0:      return self.lb
+            if k >= len(v): return self.ub
+            return 0.5*(v[k-1] + v[k])
+        return float(np.interp(k, self.cumulative(), self.sketch_edges()))
+
+    def values(self):
+        if self.sorted is None:
+            self.sorted = np.sort(np.concatenate(self.parts)) if len(self.parts) > 0 else np.zeros(0)
+            self.parts  = [self.sorted]
+        return self.sorted
+
+    def sketch_edges(self):
+        return np.linspace(self.lb, self.ub, SKETCH_BINS+1)
+
+    def cumulative(self):
+        if self.cum is None: self.cum = np.concatenate([[0], np.cumsum(self.counts)]).astype(np.float64)
+        return self.cum
+
+## Drop edges that don't increase (IE from tied values), keeping lb and ub
+def increasing(edges):
+    kept = [edges[0]]
+    for e in edges[1:-1]:
+        if e > kept[-1]: kept.append(e)
+    if edges[-1] > kept[-1]: kept.append(edges[-1])
+    else:                    kept[-1] = edges[-1]
+    return kept
+
+## nbins bins with equal numbers of events between lo and hi
+def equal_edges(q, nbins, lo, hi):
+    k_lo, k_hi = q.rank(lo), q.rank(hi)
+    inner      = [q.value(k_lo + (k_hi - k_lo)*i/float(nbins)) for i in range(1, nbins)]
+    return increasing([lo] + [min(max(e, lo), hi) for e in inner] + [hi])
+
+def hybrid_edges(q, nbins, lb, ub, split):
+    split   = min(max(split, lb), ub)
+    n_lower = nbins//2                                                              # As the original -q binning: half the bins are quantiles
+    n_fixed = nbins - n_lower
+    if n_fixed < 1 or split >= ub: return equal_edges(q, nbins, lb, ub)
+    return equal_edges(q, n_lower, lb, split) + list(np.linspace(split, ub, n_fixed+1)[1:])
+
+def mincount_edges(q, nbins, lb, ub, min_count):
+    fixed  = list(np.linspace(lb, ub, nbins+1))
+    edges  = [fixed[0]]
+    for e in fixed[1:-1]:                                                           # Close a bin once it has min_count events
+        if q.rank(e) - q.rank(edges[-1]) >= min_count: edges.append(e)
+    edges.append(fixed[-1])
+    if (len(edges) > 2) and (q.rank(edges[-1]) - q.rank(edges[-2]) < min_count):    # The last bin is short: merge it into the one before
+        del edges[-2]
+    return edges
+
+## Edges of a column's values between lb and ub. values is an array, or a function returning an iterator of arrays (chunks)
+## Chunks are summarized in a sketch, an array gives exact quantiles
+def bin_edges(values, strategy, nbins, lb, ub, split=400, min_count=200):
+    if strategy not in STRATEGIES: raise ValueError("Unknown binning strategy '{}', use one of {}".format(strategy, STRATEGIES))
+    if callable(values):
+        q = Quantiles(lb, ub, exact=False)
+        for chunk in values(): q.add(chunk)
+    else:
+        q = Quantiles(lb, ub).add(values)
+    if   strategy == 'equal' : edges = equal_edges(q, nbins, lb, ub)
+    elif strategy == 'hybrid': edges = hybrid_edges(q, nbins, lb, ub, split)
+    else:                      edges = mincount_edges(q, nbins, lb, ub, min_count)
+    return [float(e) for e in edges]
+
+## Bin arguments for a ROOT histogram constructor, IE ROOT.TH2F(name, title, *(th_bins(edges) + [ny, ylb, yub]))
+def th_bins(edges):
+    return [len(edges)-1, array('d', edges)]
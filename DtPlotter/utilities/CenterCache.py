@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import json
+import hashlib
+import Readers
+
+'''
+    On-disk memo of RunInfoTools.find_target_center results, so repeat runs and batch configurations skip center finding.
+    Entries are keyed by the input's content (see Readers.content_identity: a ROOT file's size and a hash of its head and tail,
+    a .columns export's meta.json and column sizes), the crystal pair, the amplitude bias and the center-finding parameters,
+    so changing any of them finds the centers again, while a copied, moved or touched input still finds its memoized centers.
+    Each entry is its own file, <cache>/centers/<key>.json, so --jobs workers never overwrite each other's entries.
+    The memo holds at most max_entries results, the least recently used (oldest file mtime, a hit touches it) are dropped first.
+'''
+
+## Modification time of an entry file, 0 if another worker already dropped it
+def last_used(path):
+    try:    return os.path.getmtime(path)
+    except OSError: return 0.
+
+class CenterCache:
+
+    def __init__(self, cachepath, max_entries=500):
+        self.memodir     = cachepath + 'centers/'
+        self.max_entries = max_entries
+        try:    os.makedirs(self.memodir)
+        except OSError: pass                                                            # Already made, possibly by another worker
+
+    def entry_file(self, key):
+        return self.memodir + key + '.json'
+
+    def entry_files(self):
+        return [self.memodir + f for f in os.listdir(self.memodir) if f.endswith('.json')]
+
+    ## An entry, or None if there is none (or it can't be read, IE dropped by another worker meanwhile)
+    def read(self, path):
+        try:
+            with open(path, 'r') as f: return json.load(f)
+        except (IOError, ValueError): return None                                       # Unreadable entry, find the centers again rather than fail the run
+
+    def write(self, path, entry):
+        tmpfile = '{}.{}.tmp'.format(path, os.getpid())                                 # Per-process name, --jobs workers may write at the same time
+        with open(tmpfile, 'w') as f: json.dump(entry, f, indent=1, sort_keys=True)
+        os.rename(tmpfile, path)                                                        # Atomic, an entry is never half-written
+
+    @staticmethod
+    def key(reader, xtal, ampbias, params):
+        identity = [Readers.content_identity(reader), list(xtal), str(ampbias), params]
+        return hashlib.sha1(json.dumps(identity, sort_keys=True).encode('utf-8')).hexdigest()
+
+    ## The memoized result (a dict) or None. A hit counts as a use for the LRU order, only the file's mtime is touched
+    def get(self, key):
+        entry = self.read(self.entry_file(key))
+        if entry is None: return None
+        try:    os.utime(self.entry_file(key), None)
+        except OSError: pass
+        return entry['result']
+
+    def put(self, key, filename, result):
+        self.write(self.entry_file(key), {'source': os.path.abspath(filename), 'result': result})
+        files = self.entry_files()
+        if len(files) > self.max_entries:                                               # Drop the least recently used
+            for old in sorted(files, key=last_used)[:len(files) - self.max_entries]:
+                try:    os.remove(old)
+                except OSError: pass                                                    # Already dropped by another worker
+
+    ## Forget the centers of the given file (every crystal pair/parameter set), or of every file if filename is None
+    ## Returns the number of entries removed
+    def invalidate(self, filename=None):
+        removed = 0
+        for path in self.entry_files():
+            entry = self.read(path)
+            if (entry is not None) and (filename is not None) and (entry['source'] != os.path.abspath(filename)): continue
+            try:    os.remove(path)                                                     # Unreadable entries go too
+            except OSError: continue
+            if entry is not None: removed += 1
+        return removed
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import json
+import time
+import numpy as np
+
+'''
+    Position-dependent dt correction, in place of dt_linear_correction's line against one hodoscope axis.
+    The mean dt is binned against the hodoscope position (fitResult[0].x(), fitResult[0].y()) in one pass over the events
+    (bincounts, chunk by chunk with --stream), smoothed with a gaussian weighted by the bin counts, and empty bins are filled
+    from their neighbours. Each event is then corrected by a bilinear interpolation of the map at its position:
+        dt --> dt - (map(x, y) - reference)
+    where the reference is the mean of the map over the events it was built from, so the mean dt is kept.
+    Unlike the line it follows the gap between the crystals (the dip dt_linear_correction has to mask out).
+    Maps only depend on the beam and crystal geometry, so one is kept per freq/temp/position (see FileTools.correction_location)
+    and reused by every later run whose target center is within CENTER_TOLERANCE of the map's, the correction is then just a table lookup.
+'''
+
+HALF_WIDTH = 6.0                                                                        # mm, the map covers the target center +- this in x and y
+BIN_WIDTH  = 0.5                                                                        # mm
+SMOOTHING  = 0.5                                                                        # Gaussian sigma of the smoothing, in bins. 0 = none
+MIN_COUNT  = 20                                                                         # Bins with fewer events are filled from their neighbours
+DT_RANGE   = [-2., 2.]                                                                  # ns, dt values outside are left out of the means (as in dt_linear_correction)
+CENTER_TOLERANCE = BIN_WIDTH                                                            # mm, a saved map is only reused by a file whose center is this close to the map's
+
+## Sums for the mean dt in each (x, y) bin. Chunks can be added one at a time, IE from CutEngine.chunks()
+class MapAccumulator:
+
+    def __init__(self, x_edges, y_edges):
+        self.x_edges = np.asarray(x_edges, dtype=np.float64)
+        self.y_edges = np.asarray(y_edges, dtype=np.float64)
+        self.shape   = (len(self.x_edges)-1, len(self.y_edges)-1)
+        self.counts  = np.zeros(self.shape[0]*self.shape[1])
+        self.sums    = np.zeros(self.shape[0]*self.shape[1])
+
+    def add(self, x, y, dt):
+        ix   = np.searchsorted(self.x_edges, x, side='right') - 1
+        iy   = np.searchsorted(self.y_edges, y, side='right') - 1
+        keep = (ix >= 0) & (ix < self.shape[0]) & (iy >= 0) & (iy < self.shape[1]) & (dt >= DT_RANGE[0]) & (dt < DT_RANGE[1])
+        flat = ix[keep]*self.shape[1] + iy[keep]
+        self.counts += np.bincount(flat,                 minlength=len(self.counts))
+        self.sums   += np.bincount(flat, weights=dt[keep], minlength=len(self.sums))
+
+    ## Mean dt (NaN where empty) and counts, [x bin, y bin]
+    def means(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = self.sums / self.counts
+        return means.reshape(self.shape), self.counts.reshape(self.shape)
+
+## Gaussian smoothing of the means, each bin weighted by its count (normalized convolution), so sparse bins lean on their neighbours
+## Bins under min_count don't contribute. Bins left with no weight are NaN
+def smooth(means, counts, sigma=SMOOTHING, min_count=MIN_COUNT):
+    weights = np.where(counts >= min_count, counts, 0.)
+    values  = np.where(weights > 0, means, 0.) * weights
+    if sigma > 0:
+        radius = max(int(np.ceil(3*sigma)), 1)
+        kernel = np.exp(-0.5*(np.arange(-radius, radius+1)/float(sigma))**2)
+        convolve = lambda v: np.convolve(v, kernel, 'full')[radius:radius+len(v)]       # Centered, same length as v ('same' isn't if the kernel is longer)
+        for axis in [0, 1]:                                                             # Separable, x then y
+            values  = np.apply_along_axis(convolve, axis, values)
+            weights = np.apply_along_axis(convolve, axis, weights)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(weights > 0, values / np.where(weights > 0, weights, 1.), np.nan)
+
+## Fill NaN bins with the mean of their filled neighbours, growing inwards from the filled region until none are left
+def fill_empty(table):
+    table = table.copy()
+    if np.all(np.isnan(table)): return table
+    while np.any(np.isnan(table)):
+        padded = np.pad(table, 1, mode='constant', constant_values=np.nan)
+        around = np.array([padded[:-2,1:-1], padded[2:,1:-1], padded[1:-1,:-2], padded[1:-1,2:]])
+        n      = np.sum(np.isfinite(around), axis=0)
+        with np.errstate(invalid='ignore'):
+            mean = np.where(n > 0, np.nansum(around, axis=0) / np.maximum(n, 1), np.nan)
+        table  = np.where(np.isnan(table), mean, table)
+    return table
+
+## Bilinear interpolation of table (values at the nodes x_nodes x y_nodes, evenly spaced) at each (x, y). Positions outside are clamped to the edge
+def bilinear(x_nodes, y_nodes, table, x, y):
+    def locate(nodes, v):
+        f = np.clip((v - nodes[0]) / (nodes[1] - nodes[0]), 0, len(nodes)-1)
+        i = np.minimum(f.astype(int), len(nodes)-2)
+        return i, f - i
+    ix, tx = locate(x_nodes, x)
+    iy, ty = locate(y_nodes, y)
+    return (1-tx)*(1-ty)*table[ix, iy]   + tx*(1-ty)*table[ix+1, iy] + \
+           (1-tx)*ty    *table[ix, iy+1] + tx*ty    *table[ix+1, iy+1]
+
+class CorrectionMap:
+
+    def __init__(self, x_nodes, y_nodes, table, counts, reference, info=None):
+        self.x_nodes   = np.asarray(x_nodes, dtype=np.float64)                          # Bin centers, mm
+        self.y_nodes   = np.asarray(y_nodes, dtype=np.float64)
+        self.table     = np.asarray(table,   dtype=np.float64)                          # Smoothed mean dt, [x, y]
+        self.counts    = np.asarray(counts,  dtype=np.float64)                          # Events per bin it was built from
+        self.reference = float(reference)
+        self.info      = info if info is not None else {}                              # Where it came from: source file, center, date
+
+    ## Build from (x, y, dt) chunks, IE [[x, y, dt]] for the whole file, or one per CutEngine chunk. center is [x, y] of the target center
+    @classmethod
+    def build(cls, chunks, center, half_width=HALF_WIDTH, bin_width=BIN_WIDTH, sigma=SMOOTHING, min_count=MIN_COUNT, info=None):
+        n_bins  = int(round(2*half_width/bin_width))
+        x_edges = center[0] - half_width + bin_width*np.arange(n_bins+1)
+        y_edges = center[1] - half_width + bin_width*np.arange(n_bins+1)
+        acc     = MapAccumulator(x_edges, y_edges)
+        for x, y, dt in chunks: acc.add(np.asarray(x), np.asarray(y), np.asarray(dt))
+        means, counts = acc.means()
+        if np.count_nonzero(counts >= min_count) == 0: return None
+        table     = fill_empty(smooth(means, counts, sigma, min_count))
+        reference = np.sum(table*counts) / np.sum(counts)
+        return cls(0.5*(x_edges[1:] + x_edges[:-1]), 0.5*(y_edges[1:] + y_edges[:-1]), table, counts, reference, info)
+
+    ## Map value minus the reference at each position, 0 for events without a position (IE no track)
+    def offset(self, x, y):
+        x, y   = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        finite = np.isfinite(x) & np.isfinite(y)
+        values = bilinear(self.x_nodes, self.y_nodes, self.table, np.where(finite, x, 0.), np.where(finite, y, 0.))
+        return np.where(finite, values - self.reference, 0.)
+
+    def correct(self, dt, x, y):
+        return np.asarray(dt, dtype=np.float64) - self.offset(x, y)
+
+    ## Whether the map was built around this target center [x, y] (within tolerance, in x and y). Maps without a recorded center never match
+    def matches(self, center, tolerance=CENTER_TOLERANCE):
+        if 'center' not in self.info: return False
+        return bool(np.all(np.abs(np.asarray(self.info['center'], dtype=np.float64) - np.asarray(center, dtype=np.float64)) <= tolerance))
+
+    ## Bins with at least min_count events, and the range of the map over them (ns), for the log
+    def summary(self, min_count=MIN_COUNT):
+        filled = self.counts >= min_count
+        return {'events': int(np.sum(self.counts)), 'bins_filled': int(np.count_nonzero(filled)),
+                'spread': float(np.ptp(self.table[filled])) if np.any(filled) else 0., 'reference': self.reference}
+
+    def save(self, filename):
+        data    = {'x_nodes': self.x_nodes.tolist(), 'y_nodes': self.y_nodes.tolist(), 'table': self.table.tolist(),
+                   'counts': self.counts.tolist(), 'reference': self.reference, 'info': self.info, 'saved': time.time()}
+        tmpfile = '{}.{}.tmp'.format(filename, os.getpid())                             # Per-process name, --jobs workers may write at the same time
+        with open(tmpfile, 'w') as f: json.dump(data, f)
+        os.rename(tmpfile, filename)                                                    # Atomic, a map is never half-written
+
+    ## The saved map, or None if there is none (or it can't be read)
+    @classmethod
+    def load(cls, filename):
+        if os.path.exists(filename) == False: return None
+        try:
+            with open(filename, 'r') as f: data = json.load(f)
+        except ValueError: return None
+        return cls(data['x_nodes'], data['y_nodes'], data['table'], data['counts'], data['reference'], data.get('info'))
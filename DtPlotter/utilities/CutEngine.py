@@ -0,0 +1,310 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import re
+import numpy as np
+import Profiler
+import EventCache
+
+'''
+    Evaluates TTreeFormula-style cut and plot strings (IE "fabs(fit_ampl[C3]-0.94*fit_ampl[C4])<500 && n_tracks==1")
+    as vectorized numpy expressions on the columns of an EventCache.
+    Each string is parsed once. Cuts are split into their top-level '&&' terms, and each term's boolean mask is cached,
+    so combined cuts that share terms (IE all the DtPlotter cuts) only cost a few mask ANDs.
+    With a chunk_size (DtPlotter --stream) draws, counts and column iterations go through the events one chunk at a time,
+    so memory is bounded by the chunk size instead of the file size. Results are the same either way (see chunks()).
+'''
+
+## Streaming chunks are a whole number of blocks, so block-wise sums (IE AnalysisTools.BinnedMeans) add up in the same order in both modes
+BLOCK_SIZE = 65536
+
+## Supported functions, by their TTreeFormula name
+FUNCTIONS = { 'fabs'        : np.abs,
+              'abs'         : np.abs,
+              'TMath::Abs'  : np.abs,
+              'sqrt'        : np.sqrt,
+              'TMath::Sqrt' : np.sqrt,
+              'exp'         : np.exp,
+              'log'         : np.log,
+              'pow'         : np.power,
+              'TMath::Power': np.power }
+
+## Binary operators from lowest to highest precedence, as in C
+PRECEDENCE = [ ['||'], ['&&'], ['==', '!='], ['<=', '>=', '<', '>'], ['+', '-'], ['*', '/'] ]
+
+TOKEN_RE = re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|([A-Za-z_][A-Za-z0-9_]*(?:::[A-Za-z_][A-Za-z0-9_]*)?)|(&&|\|\||==|!=|<=|>=|[-+*/<>!()\[\],.]))')
+
+def tokenize(expr):
+    tokens = []
+    pos    = 0
+    expr   = expr.strip()
+    while pos < len(expr):
+        m = TOKEN_RE.match(expr, pos)
+        if m is None: raise ValueError("Can't parse '{}' at position {}".format(expr, pos))
+        if   m.group(1) is not None: tokens.append(('num', m.group(1)))
+        elif m.group(2) is not None: tokens.append(('name', m.group(2)))
+        else:                        tokens.append(('op', m.group(3)))
+        pos = m.end()
+    return tokens
+
+## Recursive descent parser. Nodes are tuples: ('num', value), ('col', expression), ('call', fn, [args]), ('unary', op, a), ('binary', op, a, b)
+class Parser:
+
+    def __init__(self, expr):
+        self.expr   = expr
+        self.tokens = tokenize(expr)
+        self.pos    = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens): return self.tokens[self.pos]
+        return (None, None)
+
+    def take(self, value=None):
+        token = self.peek()
+        if (token[0] is None) or ((value is not None) and (token[1] != value)):
+            raise ValueError("Expected '{}' in '{}', found '{}'".format(value, self.expr, token[1]))
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self.binary(0)
+        if self.pos != len(self.tokens): raise ValueError("Unexpected '{}' in '{}'".format(self.peek()[1], self.expr))
+        return node
+
+    def binary(self, level):
+        if level == len(PRECEDENCE): return self.unary()
+        node = self.binary(level+1)
+        while (self.peek()[0] == 'op') and (self.peek()[1] in PRECEDENCE[level]):
+            op   = self.take()[1]
+            node = ('binary', op, node, self.binary(level+1))
+        return node
+
+    def unary(self):
+        if self.peek() in [('op', '!'), ('op', '-'), ('op', '+')]:
+            return ('unary', self.take()[1], self.unary())
+        return self.primary()
+
+    def primary(self):
+        kind, value = self.take()
+        if kind == 'num': return ('num', float(value))
+        if (kind, value) == ('op', '('):
+            node = self.binary(0)
+            self.take(')')
+            return node
+        if kind != 'name': raise ValueError("Unexpected '{}' in '{}'".format(value, self.expr))
+
+        ## Function call, IE fabs(...) or pow(..., ...)
+        if self.peek() == ('op', '('):
+            if value not in FUNCTIONS: raise ValueError("Unsupported function '{}' in '{}'".format(value, self.expr))
+            self.take('(')
+            fn_args = [self.binary(0)]
+            while self.peek() == ('op', ','):
+                self.take(',')
+                fn_args.append(self.binary(0))
+            self.take(')')
+            return ('call', value, fn_args)
+
+        ## Branch leaf, IE n_tracks, fit_ampl[C3] or fitResult[0].x()
+        column = value
+        if self.peek() == ('op', '['):
+            self.take('[')
+            column += '[' + self.take()[1] + ']'
+            self.take(']')
+        if self.peek() == ('op', '.'):
+            self.take('.')
+            column += '.' + self.take()[1] + '()'
+            self.take('(')
+            self.take(')')
+        return ('col', column)
+
+## Canonical text of a node, used as the cache key so formatting differences don't matter
+def unparse(node):
+    if node[0] == 'num':    return repr(node[1])
+    if node[0] == 'col':    return node[1]
+    if node[0] == 'call':   return node[1] + '(' + ','.join(unparse(a) for a in node[2]) + ')'
+    if node[0] == 'unary':  return node[1] + '(' + unparse(node[2]) + ')'
+    return '(' + unparse(node[2]) + node[1] + unparse(node[3]) + ')'
+
+## Split a node into its top-level && terms
+def and_terms(node):
+    if node[0] == 'binary' and node[1] == '&&': return and_terms(node[2]) + and_terms(node[3])
+    return [node]
+
+## Split a Draw() varexp like "y:x" on its top-level ':' (but not '::')
+def split_varexp(varexp):
+    parts = []
+    depth = 0
+    last  = 0
+    for i, c in enumerate(varexp):
+        if   c in '([': depth += 1
+        elif c in ')]': depth -= 1
+        elif (c == ':') and (depth == 0) and (varexp[i-1:i] != ':') and (varexp[i+1:i+2] != ':'):
+            parts.append(varexp[last:i])
+            last = i+1
+    parts.append(varexp[last:])
+    return parts
+
+## Window [start, stop) of an EventCache, one chunk of events
+class CacheSlice:
+
+    def __init__(self, cache, start, stop):
+        self.cache = cache
+        self.start = start
+        self.stop  = stop
+
+    def __getitem__(self, expr):
+        return self.cache[expr][self.start:self.stop]
+
+    def entries(self):
+        return self.stop - self.start
+
+class CutEngine:
+
+    def __init__(self, cache, chunk_size=None):
+        self.cache  = cache
+        self.chunk_size = None                                                              # None: evaluate the whole file at once
+        if chunk_size: self.chunk_size = BLOCK_SIZE*int(np.ceil(float(chunk_size)/BLOCK_SIZE))
+        self.named  = {}                                                                    # name -> cut string, IE 'tracks' -> 'n_tracks == 1'
+        self.masks  = {}                                                                    # canonical term/cut -> boolean mask
+        self.values_cache = {}                                                              # canonical expression -> float array
+        self.parsed = {}                                                                    # string -> parsed node
+        self.derived = {}                                                                   # name -> computed column, or a function of an engine returning it
+        self.derived_values = {}                                                            # name -> evaluated column, for the functions in self.derived
+
+    def parse(self, expr):
+        if expr not in self.parsed: self.parsed[expr] = Parser(expr).parse()
+        return self.parsed[expr]
+
+    ## Evaluate a node on the cached columns
+    def evaluate(self, node):
+        kind = node[0]
+        if kind == 'num':   return node[1]
+        if kind == 'col':
+            if node[1] in self.derived: return self.derived_column(node[1])
+            return np.asarray(self.cache[node[1]], dtype=np.float64)
+        if kind == 'call':  return FUNCTIONS[node[1]](*[self.evaluate(a) for a in node[2]])
+        if kind == 'unary':
+            a = self.evaluate(node[2])
+            if node[1] == '!': return np.logical_not(a)
+            if node[1] == '-': return -1.*a
+            return a
+        op   = node[1]
+        if op == '&&': return np.logical_and(self.evaluate(node[2]), self.evaluate(node[3]))
+        if op == '||': return np.logical_or( self.evaluate(node[2]), self.evaluate(node[3]))
+        a, b = self.evaluate(node[2]), self.evaluate(node[3])
+        if op == '+':  return np.add(a, b)
+        if op == '-':  return np.subtract(a, b)
+        if op == '*':  return np.multiply(a, b)
+        if op == '/':                                                                       # Like TTreeFormula, x/0 evaluates to 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.where(np.equal(b, 0), 0., np.true_divide(a, np.where(np.equal(b, 0), 1., b)))
+        if op == '==': return np.equal(a, b)
+        if op == '!=': return np.not_equal(a, b)
+        if op == '<':  return np.less(a, b)
+        if op == '>':  return np.greater(a, b)
+        if op == '<=': return np.less_equal(a, b)
+        if op == '>=': return np.greater_equal(a, b)
+
+    ## Register a named sub-cut, IE define('tracks', 'n_tracks == 1')
+    def define(self, name, cut):
+        self.named[name] = cut
+        return cut
+
+    ## Register a computed numpy column, usable by name in cuts and plots, IE define_column('dt_lincorr', dt - slope*dx)
+    ## values is either the column, or a function of an engine returning it. A function is evaluated on each chunk when streaming
+    ## Anything cached that used an older column of the same name is dropped
+    def define_column(self, name, values):
+        if callable(values): self.derived[name] = values
+        else:                self.derived[name] = np.broadcast_to(np.asarray(values, dtype=np.float64), (self.cache.entries(),))
+        self.derived_values.pop(name, None)
+        for cached in [self.masks, self.values_cache]:
+            for key in [k for k in cached if re.search(r'\b{}\b'.format(re.escape(name)), k)]: del cached[key]
+
+    def derived_column(self, name):
+        if callable(self.derived[name]) == False: return self.derived[name]
+        if name not in self.derived_values:
+            self.derived_values[name] = np.broadcast_to(np.asarray(self.derived[name](self), dtype=np.float64), (self.cache.entries(),))
+        return self.derived_values[name]
+
+    ## Engines over consecutive chunks of events, in order. Without a chunk_size, just this engine
+    ## Cuts and expressions are element-wise, so each chunk gives exactly the corresponding slice of the whole-file result
+    def chunks(self):
+        if self.chunk_size is None:
+            yield self
+            return
+        for start in range(0, self.cache.entries(), self.chunk_size):
+            stop         = min(start + self.chunk_size, self.cache.entries())
+            view         = CutEngine(CacheSlice(self.cache, start, stop))
+            view.named   = self.named
+            view.parsed  = self.parsed
+            view.derived = dict((k, v if callable(v) else v[start:stop]) for k, v in self.derived.items())
+            yield view
+
+    ## Boolean mask for a cut string. '' (no cut) selects everything
+    def mask(self, cut=''):
+        if cut.strip() == '': return np.ones(self.cache.entries(), dtype=bool)
+        key = unparse(self.parse(cut))
+        if key not in self.masks:
+            mask = np.ones(self.cache.entries(), dtype=bool)
+            for term in and_terms(self.parse(cut)):
+                mask &= self.term_mask(term)
+            self.masks[key] = mask
+        return self.masks[key]
+
+    def term_mask(self, term):
+        key = unparse(term)
+        if key not in self.masks:
+            with np.errstate(invalid='ignore'):
+                values = self.evaluate(term)
+            self.masks[key] = np.broadcast_to(np.asarray(values, dtype=bool), (self.cache.entries(),)).copy()  # Scalars like "1==1" cover every event
+        return self.masks[key]
+
+    ## AND of named sub-cuts, IE named_mask('tracks', 'position', 'chi2')
+    def named_mask(self, *names):
+        mask = np.ones(self.cache.entries(), dtype=bool)
+        for name in names: mask &= self.mask(self.named[name])
+        return mask
+
+    def count(self, cut=''):
+        if self.chunk_size is not None: return sum(view.count(cut) for view in self.chunks())
+        Profiler.count('events scanned', self.cache.entries())
+        return int(np.count_nonzero(self.mask(cut)))
+
+    ## Float column for an expression, IE the Aeff string or "fit_time[C3]-fit_time[C4]"
+    def values(self, expr):
+        key = unparse(self.parse(expr))
+        if key not in self.values_cache:
+            with np.errstate(invalid='ignore', over='ignore'):
+                values = np.asarray(self.evaluate(self.parse(expr)), dtype=np.float64)
+            self.values_cache[key] = np.broadcast_to(values, (self.cache.entries(),))
+        return self.values_cache[key]
+
+    ## Columns of a "y:x" varexp for the events passing cut, in varexp order
+    def draw_columns(self, varexp, cut=''):
+        Profiler.count('events scanned', self.cache.entries())
+        mask = self.mask(cut)
+        return [self.values(v)[mask] for v in split_varexp(varexp)]
+
+    ## draw_columns one chunk at a time, IE for accumulating results without holding whole columns
+    def iter_columns(self, varexp, cut=''):
+        for view in self.chunks(): yield view.draw_columns(varexp, cut)
+
+    def iter_values(self, expr):
+        for view in self.chunks():
+            Profiler.count('events scanned', view.cache.entries())
+            yield view.values(expr)
+
+    ## Stand-in for tree.Draw(varexp+">>h", cut): fills h (TH1 or TH2) and returns the number of selected events
+    ## Chunks are filled in event order, so the histogram (contents and stats) is the same as from one FillN
+    @Profiler.profiled('draw')
+    def draw(self, h, varexp, cut=''):
+        if len(split_varexp(varexp)) not in [1, 2]: raise ValueError("Only 1D and 2D draws are supported: '{}'".format(varexp))
+        Profiler.count('draws')
+        h.Reset()
+        n_selected = 0
+        for columns in self.iter_columns(varexp, cut):
+            if len(columns) == 1: EventCache.fill_histogram(h, columns[0], reset=False)
+            else:                 EventCache.fill_histogram(h, columns[1], columns[0], reset=False)     # "y:x" -> FillN(x, y)
+            n_selected += len(columns[0])
+        return n_selected
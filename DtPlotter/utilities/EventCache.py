@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import re
+import json
+import hashlib
+import numpy as np
+import Readers
+
+'''
+    Columnar cache of the h4 tree.
+    Every branch expression DtPlotter needs (IE 'fit_time[C3]' or 'fitResult[0].x()') is read from the input ONCE,
+    saved as a .npy file, and memory-mapped from then on. Caches are keyed by the input file's path and mtime,
+    so re-running on the same file skips reading the tree entirely, and a recompiled file gets a fresh cache.
+    Inputs that already are columns (a Readers.ColumnarReader) aren't copied, their own memory maps are used directly.
+'''
+
+## The branches used by the DtPlotter stages for a given crystal pair
+def default_columns(xtal):
+    columns = ['n_tracks', 'fitResult[0].x()', 'fitResult[0].y()']
+    for branch in ['fit_time', 'fit_ampl', 'b_rms', 'fit_chi2', 'amp_max', 'time_maximum']:
+        columns += ['{}[{}]'.format(branch, xtal[0]), '{}[{}]'.format(branch, xtal[1])]
+    return columns
+
+## Fill a TH1 (x only) or TH2 (x and y) from numpy columns. Like tree.Draw("...>>h") it starts from an empty histogram, unless reset=False
+def fill_histogram(h, x, y=None, reset=True):
+    if reset: h.Reset()
+    if len(x) == 0: return h
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    w = np.ones(len(x))
+    if y is None: h.FillN(len(x), x, w)
+    else:         h.FillN(len(x), x, np.ascontiguousarray(y, dtype=np.float64), w)
+    return h
+
+class EventCache:
+
+    def __init__(self, filename, cachepath, columns=[], reader=None, chunk_size=None):
+        self.file     = filename
+        self.chunk    = chunk_size                                                              # Entries per read when caching, None for all at once
+        self.reader   = reader if reader is not None else Readers.open_reader(filename, cachepath)   # An already open reader (IE from the RunContext)
+        self.cachedir = cachepath + self.cache_key() + '/'
+        self.columns  = {}                                                                      # expression -> memory-mapped array
+        self.meta     = self.read_meta()
+        if len(columns) > 0: self.require(columns)
+
+    ## Input identity (see Readers.identity): absolute path and modification time
+    def cache_key(self):
+        identity = Readers.identity(self.reader)
+        return hashlib.sha1('{}:{}'.format(identity['source'], identity['mtime']).encode('utf-8')).hexdigest()[:16]
+
+    ## meta.json holds the number of entries and which columns have been cached so far
+    def read_meta(self):
+        metafile = self.cachedir + 'meta.json'
+        if os.path.exists(metafile):
+            with open(metafile, 'r') as f: return json.load(f)
+        return {'source': os.path.abspath(self.file), 'mtime': self.reader.mtime(), 'entries': None, 'columns': {}}
+
+    def write_meta(self):
+        with open(self.cachedir + 'meta.json.tmp', 'w') as f: json.dump(self.meta, f, indent=1, sort_keys=True)
+        os.rename(self.cachedir + 'meta.json.tmp', self.cachedir + 'meta.json')                # Atomic, a crashed run never leaves a half-written index
+
+    ## IE 'fitResult[0].x()' -> 'fitResult_0_x.npy'
+    @staticmethod
+    def column_filename(expr):
+        return re.sub('[^A-Za-z0-9]+', '_', expr).strip('_') + '.npy'
+
+    def entries(self):
+        if self.meta['entries'] is None: self.meta['entries'] = self.reader.entries()
+        return self.meta['entries']
+
+    ## Make sure all the given expressions are cached and memory-mapped
+    def require(self, exprs):
+        for e in exprs:
+            if (e not in self.columns) and (self.reader.column(e) is not None): self.columns[e] = self.reader.column(e)
+        missing = [e for e in exprs if (e not in self.columns) and (e not in self.meta['columns'])]
+        if len(missing) > 0: self.read_columns(missing)
+        for e in exprs:
+            if e not in self.columns: self.columns[e] = np.load(self.cachedir + self.meta['columns'][e], mmap_mode='r')
+
+    def __getitem__(self, expr):
+        if expr not in self.columns: self.require([expr])
+        return self.columns[expr]
+
+    ## Read columns from the input, a few at a time, and save them as .npy files
+    ## With a chunk size, each column is written chunk by chunk into its (memory-mapped) .npy file, so memory stays bounded by the chunk
+    def read_columns(self, exprs):
+        if os.path.exists(self.cachedir) == False: os.makedirs(self.cachedir)
+        nentries = self.entries()
+        chunk    = min(self.chunk or nentries, nentries)
+
+        print "Caching {} column(s) from {}".format(len(exprs), self.file)
+        for i in range(0, len(exprs), 4):                                                       # As many as one TTree::Draw pass can read
+            group   = exprs[i:i+4]
+            outputs = [np.lib.format.open_memmap(self.cachedir + self.column_filename(e) + '.tmp.npy', mode='w+', dtype=np.float64, shape=(nentries,)) for e in group]
+            for start in range(0, nentries, max(chunk, 1)):
+                n = min(chunk, nentries - start)
+                for output, values in zip(outputs, self.reader.read(group, start, n)):
+                    output[start:start+n] = values
+            for expr, output in zip(group, outputs):
+                output.flush()
+                self.save_column(expr)
+        self.write_meta()
+
+    ## Move a fully written <column>.tmp.npy into place
+    def save_column(self, expr):
+        filename = self.column_filename(expr)
+        os.rename(self.cachedir + filename + '.tmp.npy', self.cachedir + filename)
+        self.meta['columns'][expr] = filename
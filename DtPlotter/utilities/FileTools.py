@@ -3,7 +3,10 @@
 ## By Michael Plesser
 
 import os       
-from ROOT import TFile
+import Profiler
+import OutputWriter
+import Readers
+from RootLoader import ROOT
 
 class FileTools:
 
@@ -16,10 +19,20 @@ class FileTools:
         self.defaultanalysispath = "/eos/user/m/mplesser/timing_resolution/batch_ntuples/"+self.name+"_"+self.freq+"_"+self.temp+"_EScan_edges/compiled_roots/"
         
     ## Save a .root of the given TObject
+    ## While an output writer is open for path (see open_output) it only goes into that writer's container, see OutputWriter.py
+    @Profiler.profiled('saving')
     def save_files(self, h, path, file_title, name_tag):
-        root_savefile = TFile(path + file_title + name_tag + ".root", "recreate")
-        root_savefile.cd()              
-        h.Write()
+        writer = OutputWriter.active(path)
+        if writer is not None:
+            writer.add(h, file_title + name_tag)
+            return
+        root_savefile = ROOT.TFile(path + file_title + name_tag + ".root", "recreate")
+        root_savefile.WriteTObject(h)
+        root_savefile.Close()
+
+    ## Collect everything saved under savepath in one container until the writer's finish(), IE for one file's analysis
+    def open_output(self, savepath, title):
+        return OutputWriter.OutputWriter(savepath, title, self.staging_location(), getattr(self.args, 'output', 'files'))
 
     ## Output location for plots
     def output_location(self):
@@ -30,6 +43,69 @@ class FileTools:
             os.mkdir(savepath)
         return savepath
 
+    ## Location of the columnar event cache (see EventCache.py). Override with --cache
+    def cache_location(self):
+        cachepath = getattr(self.args, 'cache', None)
+        if cachepath is None:
+            cachepath = os.path.join(os.path.expanduser('~'), '.dtplotter_cache')                     # One cache shared by all analyses
+        if not cachepath.endswith('/'): cachepath += '/'
+        if os.path.exists(cachepath) == False:
+            os.makedirs(cachepath)
+        return cachepath
+
+    ## Default output directory of synthetic_h4.py, in the cache. Analyze its files with -d <this directory>
+    def synthetic_location(self):
+        return self.cache_location() + 'synthetic/'
+
+    ## Local staging area of the output writers (see OutputWriter.py), before their files are copied to the output location
+    def staging_location(self):
+        stagepath = self.cache_location() + 'staging/'
+        try: os.makedirs(stagepath)
+        except OSError: pass                                                                            # Already made, possibly by another worker
+        return stagepath
+
+    ## Saved results of benchmarks/hotpaths.py, one file per commit
+    def benchmark_location(self):
+        return self.cache_location() + 'benchmarks/'
+
+    ## Results store (see ResultsStore.py), kept with the cache so every analysis and CutBatchAnalysis.py share it
+    def results_location(self):
+        return self.cache_location() + 'results.db'
+
+    ## dt correction maps (see CorrectionMap.py), one per freq/temp/position, IE <cache>corrections/ECAL_H4_Oct2018_160MHz_18deg_C3up.json
+    def correction_location(self, position):
+        mappath = self.cache_location() + 'corrections/'
+        try: os.makedirs(mappath)
+        except OSError: pass                                                                            # Already made, possibly by another worker
+        return mappath + '{}_{}_{}_{}.json'.format(self.name, self.freq, self.temp, position)
+
+    ## Log file for a file's position, IE <savepath>C3down_log.txt
+    ## With --jobs each file writes its own log, <savepath>logs/<energy>_<position>_log.txt, so parallel files never share one. See merge_logs()
+    def log_location(self, savepath, filei, position):
+        if getattr(self.args, 'jobs', 1) > 1:
+            logpath = savepath + 'logs/'
+            try: os.makedirs(logpath)
+            except OSError: pass                                                                        # Already made, possibly by another worker
+            return logpath + filei[1] + '_log.txt'
+        return savepath + position + '_log.txt'
+
+    ## Concatenate the per-file logs of a --jobs run into the usual <savepath><position>_log.txt, energies in order
+    def merge_logs(self, savepath, Files):
+        def energy_order(filei):                                                                        # Numeric energy, IE 25GeV before 100GeV. 'compiled' (no GeV) goes last
+            energy = filei[1].split('_')[0]
+            try:    return (0, float(energy.split('GeV')[0]))
+            except ValueError: return (1, energy)
+
+        positions = {}
+        for filei in sorted(Files, key=energy_order):
+            positions.setdefault(filei[1].split('_')[-1], []).append(self.log_location(savepath, filei, None))
+        for position, logs in sorted(positions.items()):
+            with open(savepath + position + '_log.txt', 'w') as merged:
+                for log in logs:
+                    if os.path.exists(log) == False: continue                                           # That file's analysis failed before starting its log
+                    with open(log, 'r') as f: merged.write(f.read())
+                    merged.write('\n')
+
     ## Define location of files to be analyzed
     def analysis_path(self):
         def e_and_p(filei):                                                                             # Returns the energy and position of a file from it's name
@@ -45,7 +121,7 @@ class FileTools:
 
         if self.args.d is None:  self.args.d = self.defaultanalysispath                                 # Use default directory if no -d flag raised
         for file in os.listdir(self.args.d):
-            if file.endswith('.root'):
+            if file.endswith('.root') or file.endswith(Readers.COLUMNAR_SUFFIX):                       # ROOT files, or columnar exports (see Readers.py)
 
                 if self.args.e is not None:                                                             # Energy specified, only adds files with that energy
                     if str(self.args.e) in file:
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from RootLoader import ROOT
+
+'''
+    Buffered output for FileTools.save_files. While a file is analyzed, every object it saves goes into one local container,
+    <title>_outputs.root in the staging directory (see FileTools.staging_location), keyed by the name its own .root file would
+    have had (IE 25GeV_C3up_resolution_vs_aeff) and indexed by a TNamed 'index' (json: key -> object name and class).
+    finish() closes the container, splits it into the usual one-object files if asked, and hands the files to a background
+    thread that copies them to the output folder (IE the EOS web folder) while the next file is analyzed.
+    Each copy is written as <name>.tmp and renamed into place, so readers only ever see a whole file.
+    --output: files     -> the per-plot files only, as the web page expects (default)
+              container -> only <title>_outputs.root
+              both      -> both
+    ROOT is only used from the main thread, the background thread only copies files.
+'''
+
+MODES   = ['files', 'container', 'both']
+writers = {}                                                                                    # savepath -> the OutputWriter collecting its objects
+pending = []                                                                                    # Uploads started and not yet waited for
+
+## The writer collecting the objects saved under savepath, or None
+def active(savepath):
+    return writers.get(savepath)
+
+## Finish the writer left open under savepath by an analysis that failed, so what it staged so far is still uploaded
+def finish_active(savepath):
+    if active(savepath) is not None: active(savepath).finish()
+
+## Copy staged files to their destinations, each through a .tmp and a rename. The staged copies are removed if all went through
+class Upload(threading.Thread):
+
+    def __init__(self, staged, stagedir):
+        threading.Thread.__init__(self)
+        self.staged   = staged                                                                  # [ [local file, destination], ... ]
+        self.stagedir = stagedir
+        self.error    = None
+
+    def run(self):
+        try:
+            for local, dest in self.staged:
+                shutil.copyfile(local, dest + '.tmp')
+                os.rename(dest + '.tmp', dest)
+            shutil.rmtree(self.stagedir, ignore_errors=True)
+        except (IOError, OSError) as e:
+            self.error = e
+
+## Wait for every upload started so far. Returns the number that failed (their staged files are kept, and listed)
+def flush():
+    n_failed = 0
+    while len(pending) > 0:
+        upload = pending.pop(0)
+        upload.join()
+        if upload.error is not None:
+            print "Output upload failed ({}), staged files kept in {}".format(upload.error, upload.stagedir)
+            n_failed += 1
+    return n_failed
+
+class OutputWriter:
+
+    def __init__(self, savepath, title, stagepath, mode='files'):
+        if mode not in MODES: raise ValueError("Unknown output mode '{}', use one of {}".format(mode, MODES))
+        finish_active(savepath)                                                                 # Left open by an analysis that failed, keep what it saved
+        self.savepath  = savepath
+        self.title     = title
+        self.mode      = mode
+        self.stagedir  = tempfile.mkdtemp(prefix=title+'_', dir=stagepath)                     # Unique, so --jobs workers never share one
+        self.container = ROOT.TFile(os.path.join(self.stagedir, title+'_outputs.root'), 'recreate')
+        self.index     = OrderedDict()
+        writers[savepath] = self
+
+    ## Add (or replace) an object. key is the name of the file it would have been saved to, without '.root'
+    def add(self, h, key):
+        self.container.WriteTObject(h, key, 'Overwrite')
+        self.index[key] = {'name': h.GetName(), 'class': h.ClassName()}
+
+    ## Close the container and start the upload. The writer is done after this, later saves under savepath are written directly
+    def finish(self):
+        del writers[self.savepath]
+        staged = []
+        if self.mode in ['files', 'both']:
+            for key, info in self.index.items():
+                h     = self.container.Get(key)
+                h.SetName(str(info['name']))                                                    # Saved under its own name, as h.Write() did
+                local = os.path.join(self.stagedir, key+'.root')
+                f     = ROOT.TFile(local, 'recreate')
+                f.WriteTObject(h)
+                f.Close()
+                staged.append([local, self.savepath + key + '.root'])
+        self.container.WriteTObject(ROOT.TNamed('index', json.dumps(self.index)), 'index', 'Overwrite')
+        self.container.Close()
+        if self.mode in ['container', 'both']:
+            staged.append([self.container.GetName(), self.savepath + self.title + '_outputs.root'])
+        upload = Upload(staged, self.stagedir)
+        upload.start()
+        pending.append(upload)
+        return upload
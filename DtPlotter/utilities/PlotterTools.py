@@ -4,9 +4,10 @@
 
 import sys
 import signal
-import RunInfoTools
-from ROOT import TFile, TH1F, TH2F, TF1, TCut, gSystem
-from array import array
+import numpy as np
+import Binning
+import Profiler
+from RootLoader import ROOT
 
 ## Makes for clean exits out of while loops
 def signal_handler(signal, frame):
@@ -14,81 +15,128 @@ def signal_handler(signal, frame):
     sys.exit(0)
 signal.signal(signal.SIGINT, signal_handler)
 
+## Exact chi2 window: the smallest v for which the cut 1/v < chi2 < v keeps 'acceptance' of the events
+## For chi2>0, 1/v < chi2 < v  <==>  max(chi2, 1/chi2) < v, so v comes straight from the sorted max(chi2, 1/chi2) values
+def chi2_window(chi2, acceptance=0.95):
+    chi2      = np.asarray(chi2, dtype=np.float64)
+    n_tot     = len(chi2)
+    n_needed  = int(np.ceil(acceptance*n_tot - 1e-9))                                  # Events that must pass (-1e-9 guards against float noise in acceptance*n_tot)
+    positive  = chi2[chi2>0]                                                            # chi2<=0 can never pass the cut
+    t         = np.sort(np.maximum(positive, 1./positive))
+    if (n_needed == 0) or (len(t) == 0): return 1., 0.
+    n_needed  = min(n_needed, len(t))
+    t_k       = t[n_needed-1]
+    above     = np.searchsorted(t, t_k, side='right')                                   # First value strictly above t_k, so ties at t_k pass too
+    if above < len(t): chi_val = 0.5*(t_k + t[above])                                   # Halfway to the next value, robust to rounding when printed into the cut string
+    else:              chi_val = 2.*t_k
+    percent_accept = 1.*np.count_nonzero((chi2>1./chi_val) & (chi2<chi_val))/n_tot
+    return chi_val, percent_accept
+
+## Bin of t = max(chi2, 1/chi2) >= 1 on a log scale, 128 bins per factor of 2. Exact (frexp), so bins are strictly ordered in t
+CHI2_BINS_PER_OCTAVE = 128
+def chi2_window_bin(t):
+    mantissa, exponent = np.frexp(t)                                                    # t = mantissa * 2^exponent, mantissa in [0.5, 1)
+    with np.errstate(invalid='ignore'):                                                 # inf is binned separately below
+        bins = exponent.astype(np.int64)*CHI2_BINS_PER_OCTAVE + np.floor((mantissa - 0.5)*2*CHI2_BINS_PER_OCTAVE).astype(np.int64)
+    return np.where(np.isinf(t), 1025*CHI2_BINS_PER_OCTAVE, bins)
+
+## chi2_window for chi2 values that come in chunks (DtPlotter --stream), with the same result as chi2_window on all of them at once
+## chunks() must return a fresh iterator over the chi2 arrays on every call. Three passes, memory bounded by the chunk size:
+##      1) a histogram of t to find which bin holds the n_needed-th smallest t
+##      2) the t values in that bin and the next non-empty one, sorted, give t_k and the next value above it exactly
+##      3) the acceptance of the final window, counted as in chi2_window
+def chi2_window_streamed(chunks, acceptance=0.95):
+    n_tot  = 0
+    counts = np.zeros(1026*CHI2_BINS_PER_OCTAVE, dtype=np.int64)
+    for chi2 in chunks():
+        chi2      = np.asarray(chi2, dtype=np.float64)
+        positive  = chi2[chi2>0]
+        n_tot    += len(chi2)
+        counts   += np.bincount(chi2_window_bin(np.maximum(positive, 1./positive)), minlength=len(counts))
+    n_needed  = int(np.ceil(acceptance*n_tot - 1e-9))
+    if (n_needed == 0) or (counts.sum() == 0): return 1., 0.
+    n_needed  = min(n_needed, counts.sum())
+    cumulative = np.cumsum(counts)
+    bin_k     = np.searchsorted(cumulative, n_needed)                                   # First bin reaching n_needed values
+    later     = np.nonzero(counts[bin_k+1:])[0]
+    bin_next  = bin_k + 1 + later[0] if len(later) > 0 else -1
+
+    in_k, in_next = [], []
+    for chi2 in chunks():
+        chi2      = np.asarray(chi2, dtype=np.float64)
+        positive  = chi2[chi2>0]
+        t         = np.maximum(positive, 1./positive)
+        bins      = chi2_window_bin(t)
+        in_k.append(t[bins == bin_k])
+        in_next.append(t[bins == bin_next])
+    in_k      = np.sort(np.concatenate(in_k))
+    t_k       = in_k[n_needed - (cumulative[bin_k] - counts[bin_k]) - 1]
+    above     = np.searchsorted(in_k, t_k, side='right')
+    if   above < len(in_k): chi_val = 0.5*(t_k + in_k[above])
+    elif bin_next >= 0:     chi_val = 0.5*(t_k + np.min(np.concatenate(in_next)))
+    else:                   chi_val = 2.*t_k
+
+    n_accept = 0
+    for chi2 in chunks():
+        chi2      = np.asarray(chi2, dtype=np.float64)
+        n_accept += np.count_nonzero((chi2>1./chi_val) & (chi2<chi_val))
+    return chi_val, 1.*n_accept/n_tot
+
 class PlotterTools:
 
-    def __init__(self, args, savepath, filei, centers):
+    def __init__(self, context):
+
+        self.context     = context                       # Per-file RunContext, see RunContext.py
 
         ## savepath (only used for logfiles)
-        self.savepath    = savepath
+        self.savepath    = context.savepath
         
         ## Analysis file
-        self.file        = filei[0]                      # Full file with path
-        self.file_title  = filei[1]                      # '<energy>_<position>', IE '25GeV_C3up'
+        self.file        = context.file                  # Full file with path
+        self.file_title  = context.file_title            # '<energy>_<position>', IE '25GeV_C3up'
 
-        self.args        = args
+        self.args        = context.args
 
         self.min_amp_max = self.args.am
         self.dampcut     = self.args.da
         self.x_pos_cut   = float(self.args.pc.split(',')[0])
         self.y_pos_cut   = float(self.args.pc.split(',')[1])
 
-        rit = RunInfoTools.RunInfoTools(args, savepath, filei)
-        self.ampbias                 = rit.ampbias
-        self.xtal                    = rit.xtal
-        self.x_center, self.y_center = centers[0], centers[1] 
-        self.Aeff                    = rit.Aeff
-
-        # These lines annoyingly needed to make fitResult work :(
-        gSystem.Load("/afs/cern.ch/user/m/mplesser/H4Analysis/CfgManager/lib/libCFGMan.so")
-        gSystem.Load("/afs/cern.ch/user/m/mplesser/H4Analysis/lib/libH4Analysis.so")
-        gSystem.Load("/afs/cern.ch/user/m/mplesser/H4Analysis/DynamicTTree/lib/libDTT.so")
+        self.ampbias                 = context.ampbias
+        self.xtal                    = context.xtal
+        self.logfile                 = context.logfile
+        self.x_center, self.y_center = context.centers[0], context.centers[1] 
+        self.Aeff                    = context.Aeff
+        self.engine                  = context.cut_engine()
 
     ## Cuts to selection
+    @Profiler.profiled('cut building')
     def define_cuts(self):
 
-        tfile  = TFile(self.file)
-        tree   = tfile.Get("h4")
-
-        ## Sweep to find the chi2 range [1/val,val] that gives 95% acceptance when used as a cut
+        ## Find the chi2 range [1/val,val] that gives 95% acceptance when used as a cut
+        @Profiler.profiled('chi2 sweep')
         def chi2_range_sweep():
 
-            ## Checks if the chi2 sweep is complete, or if it needs to change directions because it overshot
-            def check_range(window, percentage):
-                if (percentage <= 0.95+window) and (percentage >= 0.95-window): direction =  0  # Sweep completed
-                elif percentage>0.95+window:                                    direction = -1  # Decrease chi_val
-                elif percentage<0.95+window:                                    direction =  1  # Increase chi_val
-                return direction 
-
             chi_vals   = [0,0]                              # One range for xtal[0], and one for xtal[1]
             print "Beginning chi2 sweep..."
+            basic_cut  = "n_tracks==1 && "
+            basic_cut += "fabs(fitResult[0].y())<10 && fabs(fitResult[0].x())<10 && "
+            basic_cut += "fit_time[{0}]>0 && fit_time[{1}]>0".format(self.xtal[0], self.xtal[1])
             for i in range(len(chi_vals)):
-                h_chi  = TH1F("h_chi","",1000,0,1000)                                           
-                basic_cut  = "n_tracks==1 && "
-                basic_cut += "fabs(fitResult[0].y())<10 && fabs(fitResult[0].x())<10 && ".format(self.xtal[i])
-                basic_cut += "fit_time[{0}]>0 && fit_time[{1}]>0".format(self.xtal[0], self.xtal[1])
-                tree.Draw("fit_chi2[{}]>>h_chi".format(self.xtal[i]), TCut(basic_cut))         
-                tot_events = h_chi.GetEntries()
-                stepsize           = 64                                                         # By how much chi_val is changed each time
-                chi_val            = 0                                                          # A guess to start
-                percent_plus_minus = 0.005                                                      # What is the acceptable range of percent's around 0.95, IE 0.01->0.94-0.96
-                direction          = 1                                                          # Start by increasing chi_val
-                lastdirection      = direction                                                  # Memory for checking if the direction has changed
-                while direction != 0:                                                           # Keep searching until 'direction'==0
-                    chi_val += (direction * stepsize)                                           # Adjust the chi_val in the right direction, by the current stepsize
-                    chi_cut  = "fit_chi2[{0}]>1./{1} && fit_chi2[{0}]<{1} && {2}".format(self.xtal[i],chi_val, basic_cut)
-                    tree.Draw("fit_chi2[{}]>>h_chi".format(self.xtal[i]), TCut(chi_cut))
-                    percent_accept  = 1.*h_chi.GetEntries()/tot_events
-                    lastdirection   = direction
-                    direction       = check_range(percent_plus_minus, percent_accept)           # Update direction. +1, -1, or 0 if complete
-                    if direction   != lastdirection:  stepsize /= 2.                            # Reduce step size if we overshoot it and changed direction
-
+                chi2_expr  = "fit_chi2[{}]".format(self.xtal[i])
+                if self.engine.chunk_size is None:
+                    chi2       = self.engine.draw_columns(chi2_expr, basic_cut)[0]                     # Only the chi2 column under the basic cut is needed
+                    chi_val, percent_accept = chi2_window(chi2, 0.95)                               # One sort, no iterative Draw() search
+                else:
+                    chunks     = lambda: (columns[0] for columns in self.engine.iter_columns(chi2_expr, basic_cut))
+                    chi_val, percent_accept = chi2_window_streamed(chunks, 0.95)                    # Same window, without holding the whole column
                 chi_vals[i] = chi_val
                 print "Range found for {}:\n\t{:.4f} - {} with {:.2f}% acceptance".format(self.xtal[i], 1./chi_val, chi_val, percent_accept*100.)
             return [ [1./chi_vals[0], chi_vals[0]], [1./chi_vals[1], chi_vals[1]] ]
 
         ## Misc cuts that may be applied
         
-        tracks_cut = "n_tracks == 1"
+        tracks_cut = self.engine.define('tracks', "n_tracks == 1")
 
         ## Loose cut, fabs(X) and fabs(Y)<20, but also cut out 1mm around the center in the interesting direction
         ## Not ideal, but eliminates the knee in the res. plot from gap electrons
@@ -101,18 +149,22 @@ class PlotterTools:
             position_cut += " && (fitResult[0].x() > ({0}+1) || fitResult[0].x() < ({0}-1))".format(self.x_center)
             position_cut += " && fabs( fitResult[0].x() ) < 15"
 
+        self.engine.define('position', position_cut)
+
         ## Back-pocket position cut, maybe to be used later. More basic, just cuts around the center
         #position_cut = "(fabs( fitResult[0].x()-{0} )<{1}) && (fabs( fitResult[0].y()-{2} )<{3})".format(self.x_center, self.x_pos_cut, self.y_center, self.y_pos_cut)
         #position_cut = "fabs( fitResult[0].x())<10 && fabs(fitResult[0].y())<10"
 
-        clock_cut    = "time_maximum[{}]==time_maximum[{}]".format(self.xtal[0],self.xtal[1])
+        clock_cut    = self.engine.define('clock', "time_maximum[{}]==time_maximum[{}]".format(self.xtal[0],self.xtal[1]))
         ## amp_cut is due for improvement! TBD
-        amp_cut      = "fit_ampl[{}]>{} && {}*fit_ampl[{}]>{}".format(self.xtal[0],self.min_amp_max,self.ampbias,self.xtal[1],self.min_amp_max)
-        dampl_cut    = "fabs(fit_ampl[{}]-{}*fit_ampl[{}] )<{}".format(self.xtal[0], self.ampbias, self.xtal[1], self.dampcut)
+        amp_cut      = self.engine.define('amp',   "fit_ampl[{}]>{} && {}*fit_ampl[{}]>{}".format(self.xtal[0],self.min_amp_max,self.ampbias,self.xtal[1],self.min_amp_max))
+        dampl_cut    = self.engine.define('dampl', "fabs(fit_ampl[{}]-{}*fit_ampl[{}] )<{}".format(self.xtal[0], self.ampbias, self.xtal[1], self.dampcut))
 
-        chi2_bounds  = chi2_range_sweep()
+        if self.context.chi2_bounds is None: self.context.chi2_bounds = chi2_range_sweep()    # Depends only on the file, so found once per context
+        chi2_bounds  = self.context.chi2_bounds
         chi2_cut     = "fit_chi2[{}]<{} && fit_chi2[{}]>{} && ".format(self.xtal[0],chi2_bounds[0][1],self.xtal[0],chi2_bounds[0][0])
         chi2_cut    += "fit_chi2[{}]<{} && fit_chi2[{}]>{}    ".format(self.xtal[1],chi2_bounds[1][1],self.xtal[1],chi2_bounds[1][0])
+        self.engine.define('chi2', chi2_cut)
 
         Cts = []
         ## Chi2 cuts
@@ -129,7 +181,7 @@ class PlotterTools:
             Cts.append( tracks_cut + " && " + position_cut + " && " + clock_cut + " && " + amp_cut + " && " + dampl_cut + " && " + chi2_cut )
 
         # Write some info to the logfile
-        with open(self.savepath+self.xtal[2]+'_log.txt', 'a') as f:
+        with open(self.logfile, 'a') as f:
             f.write("Args: \n\t"+str(self.args)+'\n\n')
             f.write("Plots specified (in order): \n")
             if self.args.x is not False: f.write("\tChi2 for {}\n\tChi2 for {}\n".format(self.xtal[0], self.xtal[1]))
@@ -165,30 +217,21 @@ class PlotterTools:
 
 
     ## Make the dt vs aeff color map, and use quantiles if so directed
-    def make_color_map(self, p, cut, tree):
-
-        def quants_in_range(nbins_quant, lb, ub):
-            aeff_tmp       = TH1F('aeff',"", 100, lb, ub)                                                       # Creates a temporary histogram to find the quantiles
-            tree.Draw(self.Aeff+'>>aeff', TCut(cut))
-            probs     = array('d', [x/(nbins_quant-1.) for x in range(0, nbins_quant)])                         # Quantile proportions array
-            quantiles = array('d', [0 for x in range(0, nbins_quant)])                                          # Bin edges, initialized as all 0's
-            aeff_tmp.GetQuantiles(nbins_quant, quantiles, probs)                                                # Overwrites 'quantiles' with bin edges positions
-            return quantiles
+    ## With -q the Aeff edges come from Binning (--qs strategy), over the events passing cut with dt inside the plot range
+    def make_color_map(self, p, cut):
 
-        def fixed_bins_in_range(nbins, lb, ub):
-            fixed_bin_size  = (ub - lb)/(nbins+1)              
-            return array('d', [lb+fixed_bin_size*n for n in range(1, nbins+1)])
+        def in_range(columns):                                                                                  # columns = [dt, aeff]
+            return columns[1][(columns[0] >= p[6]) & (columns[0] < p[7])]
 
         if self.args.q == True:                                                                                 # Use quantile binning
-            ## Hybrid quantile method. Uses quantiles in low and high Aeff regions, and fixed bins between.
-            n_lower_quants  = int(p[2]/2)+1                                                                     # Number of quantiles in low Aeff region
-            lower_quants_ub = 400                                                                               # Upper bound of lower quantile region (lb taken from p[3])
-            lower_quants    = quants_in_range(n_lower_quants,p[3],lower_quants_ub )
-            nfixed_bins     = p[2] - n_lower_quants + 1                                                         # n_fixed_bins = whatever is left (done this way to avoid rounding issues)
-            fixed_bins      = fixed_bins_in_range(nfixed_bins, lower_quants_ub, p[4])              
-            bins = lower_quants + fixed_bins                                                                    # Mix of quantiles and fixed width bins.
-            hh   = TH2F('hh', self.file_title+'_dt_vs_aeff_heatmap', p[2], bins, p[5], p[6], p[7])              # Return a TH2F with mixed quantile/fixed binning
+            if self.engine.chunk_size is None:
+                aeff = in_range(self.engine.draw_columns(p[0], cut))                                            # Exact quantiles, one pass over the cached columns
+            else:
+                aeff = lambda: (in_range(columns) for columns in self.engine.iter_columns(p[0], cut))           # Quantile sketch, one chunk at a time
+            edges = Binning.bin_edges(aeff, self.args.qs, p[2], p[3], p[4], min_count=self.args.ms)
+            bins  = Binning.th_bins(edges)
+            hh    = ROOT.TH2F('hh', self.file_title+'_dt_vs_aeff_heatmap', bins[0], bins[1], p[5], p[6], p[7])  # Return a TH2F with the variable binning
         else:                                                                                                   # Use fixed width bins
-            hh   = TH2F('hh', self.file_title+'_dt_vs_aeff_heatmap', p[2], p[3], p[4], p[5], p[6], p[7])        # Return a TH2F with fixed-width binning    
+            hh    = ROOT.TH2F('hh', self.file_title+'_dt_vs_aeff_heatmap', p[2], p[3], p[4], p[5], p[6], p[7])  # Return a TH2F with fixed-width binning    
 
         return hh
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import json
+import time
+import resource
+import functools
+from collections import OrderedDict
+from contextlib import contextmanager
+
+'''
+    Stage-level timing and memory counters for DtPlotter, turned on with --profile.
+    Each stage (file open, center finding, chi2 sweep, each draw, slice fitting, ...) records its number of calls, wall time,
+    CPU time (this process and any finished children, IE --fw pools) and the peak RSS of the process when it ended.
+    Counters (tree.Draw calls, events read or scanned, ...) are added to every stage open at the time, so a stage's
+    counts include the ones of the stages nested in it, like its times do.
+    When disabled (the default) stage() and profiled() cost one flag check.
+'''
+
+enabled = False
+stages  = OrderedDict()                                                                 # Stage name -> totals, in the order the stages first ran
+active  = []                                                                            # Names of the stages open right now, outermost first
+
+def enable():
+    global enabled
+    enabled = True
+
+def reset():
+    stages.clear()
+    del active[:]
+
+## CPU seconds used so far: user + system, of this process and its waited-for children
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+## Peak resident set size of this process so far, in MB
+def peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': return peak / (1024.*1024.)                            # Bytes on macOS, kB on Linux
+    return peak / 1024.
+
+def new_stage():
+    return {'calls': 0, 'wall': 0., 'cpu': 0., 'peak_rss_mb': 0., 'counters': OrderedDict()}
+
+## Time the enclosed block as stage <name>, IE: with Profiler.stage('file open'): ...
+## A stage that is already open (IE a recursive call) is only timed at its outermost level
+@contextmanager
+def stage(name):
+    if (enabled == False) or (name in active):
+        yield
+        return
+    totals = stages.setdefault(name, new_stage())
+    active.append(name)
+    wall0, cpu0 = time.time(), cpu_time()
+    try:
+        yield
+    finally:
+        active.remove(name)
+        totals['calls']      += 1
+        totals['wall']       += time.time() - wall0
+        totals['cpu']        += cpu_time() - cpu0
+        totals['peak_rss_mb'] = max(totals['peak_rss_mb'], peak_rss())
+
+## Decorator version of stage(), for functions and methods that are a stage as a whole
+def profiled(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*fn_args, **fn_kwargs):
+            if enabled == False: return fn(*fn_args, **fn_kwargs)
+            with stage(name): return fn(*fn_args, **fn_kwargs)
+        return wrapper
+    return decorator
+
+## Add n to a counter of every open stage, IE count('tree.Draw calls') or count('events scanned', n)
+def count(counter, n=1):
+    if enabled == False: return
+    for name in active:
+        counters          = stages[name]['counters']
+        counters[counter] = counters.get(counter, 0) + n
+
+## Everything recorded so far, as plain dicts (for json, or to send back from a --jobs worker)
+def snapshot():
+    return json.loads(json.dumps(stages), object_pairs_hook=OrderedDict)
+
+## Add a snapshot from another process (IE a --jobs worker) to the totals here. Peak RSS is the max over processes
+def merge(other):
+    for name, theirs in other.items():
+        totals = stages.setdefault(name, new_stage())
+        for key in ['calls', 'wall', 'cpu']: totals[key] += theirs[key]
+        totals['peak_rss_mb'] = max(totals['peak_rss_mb'], theirs['peak_rss_mb'])
+        for counter, n in theirs['counters'].items(): totals['counters'][counter] = totals['counters'].get(counter, 0) + n
+
+## Write the report as json
+def write_report(filename, info={}):
+    report = {'info': info, 'peak_rss_mb': peak_rss(), 'stages': stages}
+    with open(filename, 'w') as f: json.dump(report, f, indent=1)
+    print "Profile written to {}".format(filename)
+
+## Print the report as a table, one line per stage
+def print_report():
+    counters = []
+    for totals in stages.values():
+        counters += [c for c in totals['counters'] if c not in counters]
+    print "Profile (stage times include nested stages):"
+    print "\t{:<24}{:>7}{:>11}{:>11}{:>14}".format('Stage', 'Calls', 'Wall (s)', 'CPU (s)', 'Peak RSS (MB)') + ''.join('{:>18}'.format(c) for c in counters)
+    for name, totals in stages.items():
+        print "\t{:<24}{:>7}{:>11.3f}{:>11.3f}{:>14.1f}".format(name, totals['calls'], totals['wall'], totals['cpu'], totals['peak_rss_mb']) + \
+              ''.join('{:>18}'.format(totals['counters'].get(c, '-')) for c in counters)
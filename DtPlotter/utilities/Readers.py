@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+import Profiler
+import RootLoader
+from RootLoader import ROOT
+
+'''
+    Input backends. Everything DtPlotter reads from an input file goes through a reader:
+        position()            : the run's crystal position, from its info
+        entries()             : number of events
+        read(exprs, start, n) : float64 arrays of branch expressions (IE 'fit_time[C3]') for events [start, start+n)
+        column(expr)          : the whole column as a read-only array if the backend stores it as one (no copy), else None
+        mtime()               : modification time. With the path it is the input's identity (see identity()), that the column cache is keyed by
+        fingerprint()         : identity of the input's content, the same for a copied, moved or touched input (see content_identity())
+    RootReader     : a ROOT file with the h4 and info trees. H4Analysis (or SyntheticH4.C) is only loaded to read fitResult
+    ColumnarReader : a <name>.columns/ directory with one .npy per column and a meta.json, memory-mapped, no ROOT needed.
+                     Written by ColumnarConverter.py from any ntuple, or by synthetic_h4.py --format columnar.
+                     Compressed exports (ColumnarConverter.py --compress, a columns.npz) are read into memory instead
+    The columnar layout is plain .npy so numpy can map it directly, no Parquet/Arrow library is needed on the analysis nodes.
+'''
+
+COLUMNAR_SUFFIX = '.columns'
+
+## Bytes hashed from each end of a ROOT file for its fingerprint. Enough to tell recompiled files apart without reading GBs from EOS
+IDENTITY_BYTES  = 1024*1024
+
+## The reader for an input: a .columns directory or a ROOT file. builddir is where SyntheticH4.C gets compiled if it's needed
+def open_reader(filename, builddir=None):
+    if os.path.isdir(filename): return ColumnarReader(filename)
+    return RootReader(filename, builddir)
+
+## What makes an input the "same input" for the column cache (EventCache.cache_key): its absolute path and its reader's mtime
+## Nothing is opened, so it works the same for a ROOT file and a .columns directory
+def identity(reader):
+    return {'source': os.path.abspath(reader.file), 'mtime': reader.mtime()}
+
+## What makes an input the "same data" for the center memo (CenterCache.key): its content, whatever its path or mtime
+def content_identity(reader):
+    return reader.fingerprint()
+
+class RootReader:
+
+    def __init__(self, filename, builddir=None):
+        self.file     = filename
+        self.builddir = builddir
+        self.open()
+
+    def open(self):
+        self.tfile    = ROOT.TFile(self.file)
+        self.tree     = self.tfile.Get("h4")
+        self.infotree = self.tfile.Get("info")
+        ROOT.gROOT.cd()                                                                         # Keep new histograms in memory, not owned by the input file
+
+    def mtime(self):
+        return os.path.getmtime(self.file)
+
+    ## Size and a hash of the file's first and last IDENTITY_BYTES
+    def fingerprint(self):
+        size = os.path.getsize(self.file)
+        h    = hashlib.sha1()
+        with open(self.file, 'rb') as f:
+            h.update(f.read(IDENTITY_BYTES))
+            if size > IDENTITY_BYTES:
+                f.seek(max(size - IDENTITY_BYTES, IDENTITY_BYTES))
+                h.update(f.read(IDENTITY_BYTES))
+        return {'size': size, 'sha1': h.hexdigest()}
+
+    def entries(self):
+        return int(self.tree.GetEntries())
+
+    def position(self):
+        self.infotree.GetEntry(1)
+        return self.infotree.Positions
+
+    def column(self, expr):
+        return None
+
+    ## Energies of the runs in the file, one info entry per run
+    def energies(self):
+        values = []
+        for i in range(int(self.infotree.GetEntries())):
+            self.infotree.GetEntry(i)
+            if float(self.infotree.Energy) not in values: values.append(float(self.infotree.Energy))
+        return values
+
+    ## A synthetic_h4.py file, whose fitResult is SyntheticH4.C's track class
+    def synthetic(self):
+        branch = self.tree.GetBranch('fitResult')
+        return bool(branch) and ('SyntheticTrack' in branch.GetClassName())
+
+    ## Only reading fitResult needs the H4Analysis libraries (or SyntheticH4.C's track class, for synthetic_h4.py files)
+    ## A tree opened before they were loaded can't call fitResult's methods, so reopen it
+    def load_libraries(self):
+        if self.synthetic():
+            if RootLoader.synthetic_loaded == False:
+                RootLoader.load_synthetic_h4(self.builddir)
+                self.open()
+        elif RootLoader.h4_libraries_loaded() == False:
+            RootLoader.load_h4_libraries()
+            self.open()
+
+    ## TTree::Draw fills at most 4 value buffers per pass
+    def read(self, exprs, start, n):
+        if any('fitResult' in e for e in exprs): self.load_libraries()
+        self.tree.SetEstimate(n + 1)                                                            # Keep every row in the Draw buffers, not just the default 1e6
+        values = []
+        for i in range(0, len(exprs), 4):
+            group = exprs[i:i+4]
+            nrows = self.tree.Draw(':'.join(group), '', 'goff', n, start)
+            Profiler.count('tree.Draw calls')
+            Profiler.count('events read', n)
+            if nrows != n: sys.exit("\nColumns {} are not one value per event, aborting...".format(group))
+            values += [read_buffer(self.tree.GetVal(j), nrows) for j in range(len(group))]
+        return values
+
+## Copy a TTree::GetVal(i) buffer into a numpy array
+def read_buffer(buf, n):
+    if hasattr(buf, 'SetSize'): buf.SetSize(n)                                                  # Older PyROOT buffers need their length set before being read
+    return np.frombuffer(buf, dtype=np.float64, count=n).copy()
+
+class ColumnarReader:
+
+    def __init__(self, dirname):
+        self.path    = dirname.rstrip('/') + '/'
+        self.file    = self.path
+        if os.path.exists(self.path + 'meta.json') == False: sys.exit("\n{} has no meta.json, not a columnar export, aborting...".format(self.path))
+        with open(self.path + 'meta.json', 'r') as f: self.meta = json.load(f)
+        self.columns = {}                                                                       # expression -> memory-mapped array
+        self.archive = None                                                                     # columns.npz of a compressed export, opened on first use
+
+    ## meta.json is written last, so its time is the export's
+    def mtime(self):
+        return os.path.getmtime(self.path + 'meta.json')
+
+    ## A hash of meta.json (entries, info, column list) and the size of every column file (or of columns.npz)
+    def fingerprint(self):
+        with open(self.path + 'meta.json', 'rb') as f: h = hashlib.sha1(f.read())
+        if self.meta.get('compressed', False): files = ['columns.npz']
+        else:                                  files = sorted(self.meta['columns'].values())
+        return {'sha1': h.hexdigest(), 'sizes': [[name, os.path.getsize(self.path + name)] for name in files]}
+
+    def entries(self):
+        return int(self.meta['entries'])
+
+    ## As stored: a name (IE 'C3up') or a number (IE 2.5), like the info tree's
+    def position(self):
+        position = self.meta['info']['Positions']
+        return str(position) if isinstance(position, basestring) else position
+
+    def column(self, expr):
+        if expr not in self.columns:
+            if expr not in self.meta['columns']: sys.exit("\nColumn '{}' is not in {}, re-export it with that column, aborting...".format(expr, self.path))
+            if self.meta.get('compressed', False):
+                if self.archive is None: self.archive = np.load(self.path + 'columns.npz')
+                self.columns[expr] = self.archive[self.meta['columns'][expr]]
+            else:
+                self.columns[expr] = np.load(self.path + self.meta['columns'][expr], mmap_mode='r')
+                Profiler.count('columns mapped')
+        return self.columns[expr]
+
+    def read(self, exprs, start, n):
+        Profiler.count('events read', n)
+        return [np.asarray(self.column(e)[start:start+n], dtype=np.float64) for e in exprs]
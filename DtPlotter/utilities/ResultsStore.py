@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import time
+import sqlite3
+from contextlib import closing
+
+'''
+    Indexed store (SQLite) of the numbers DtPlotter produces, so summaries never have to parse log files.
+    Every result is keyed by dataset name (--name), freq, temp, energy, position and configuration (IE 'baseline', 'damp_cut', see --config).
+    Writing a result again for the same key replaces it. Several processes (--jobs) can write at once, SQLite locks the file.
+        centers      : target centers from RunInfoTools.find_target_center()
+        lincorr      : dt linear correction from AnalysisTools.dt_linear_correction()
+        mapcorr      : dt correction map used by AnalysisTools.dt_map_correction()
+        resolution   : constant and noise terms from AnalysisTools.fit_resolution()
+'''
+
+KEY_COLUMNS = ['name', 'freq', 'temp', 'energy', 'position', 'config']
+
+TABLES = { 'centers'   : ['x_center', 'y_center', 'hodo_x_center', 'hodo_y_center'],
+           'lincorr'   : ['slope', 'intercept', 'red_chi2'],
+           'mapcorr'   : ['events', 'bins_filled', 'spread', 'reference'],
+           'resolution': ['cterm', 'cterm_err', 'nterm', 'nterm_err', 'red_chi2'] }
+
+## Name of a configuration when --config isn't given, built from the options that change the results, IE 'am1_da1e9_pc5,5_ftgaus_rfminuit'
+## Options a script doesn't have (IE CutEfficiencyChecker.py) are left out
+def configuration_name(args):
+    options = [[option, getattr(args, option, None)] for option in ['am', 'da', 'pc', 'ft', 'rf']]
+    name    = '_'.join('{}{}'.format(option, value) for option, value in options if value is not None)
+    if getattr(args, 'mc', False) == True: name += '_mc'
+    elif getattr(args, 'lc', False) == True: name += '_lc'
+    if getattr(args, 'rf', None) == 'unbinned':
+        name += '_um{}'.format(getattr(args, 'um', 'walk')) + ('_ut' if getattr(args, 'ut', False) else '')
+    return name if name != '' else 'default'
+
+## 'N/A' (a failed fit) and other non-numbers are stored as NULL
+def number(value):
+    try:    return float(value)
+    except (TypeError, ValueError): return None
+
+class ResultsStore:
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        with closing(self.connect()) as conn:
+            for table, columns in TABLES.items():
+                existing = [row[1] for row in conn.execute("PRAGMA table_info({})".format(table))]
+                if (len(existing) > 0) and any(c not in existing for c in KEY_COLUMNS):    # Written before the key had its current columns, its rows can't be told apart
+                    print "Results store {}: dropping the old '{}' table, rerun those analyses to fill it again".format(dbfile, table)
+                    conn.execute("DROP TABLE {}".format(table))
+                conn.execute("CREATE TABLE IF NOT EXISTS {} ({}, {}, updated REAL, PRIMARY KEY ({}))".format(
+                             table, ', '.join(c+' TEXT' for c in KEY_COLUMNS), ', '.join(c+' REAL' for c in columns), ', '.join(KEY_COLUMNS)))
+                conn.execute("CREATE INDEX IF NOT EXISTS {0}_config ON {0} (name, freq, temp, energy, config)".format(table))   # For summaries over configurations
+            conn.commit()
+
+    def connect(self):
+        return sqlite3.connect(self.dbfile, timeout=60)                                 # Wait for other writers (--jobs) rather than fail
+
+    ## Store (or replace) one result. key is a dict of KEY_COLUMNS, values a dict of the table's columns
+    def record(self, table, key, values):
+        columns = KEY_COLUMNS + TABLES[table] + ['updated']
+        row     = [str(key[c]) for c in KEY_COLUMNS] + [number(values[c]) for c in TABLES[table]] + [time.time()]
+        with closing(self.connect()) as conn:
+            conn.execute("INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(table, ', '.join(columns), ', '.join('?'*len(columns))), row)
+            conn.commit()
+
+    ## WHERE clause and its parameters for one dataset and freq/temp/energy, optionally only some configurations
+    @staticmethod
+    def selection(name, freq, temp, energy, configs=None):
+        where  = "name = ? AND freq = ? AND temp = ? AND energy = ?"
+        params = [name, freq, temp, energy]
+        if configs is not None:
+            where  += " AND config IN ({})".format(', '.join('?'*len(configs)))
+            params += list(configs)
+        return where, params
+
+    ## Rows of a table as dicts, optionally only some configurations. Ordered by configuration then position
+    def query(self, table, name, freq, temp, energy, configs=None):
+        where, params = self.selection(name, freq, temp, energy, configs)
+        columns = KEY_COLUMNS + TABLES[table] + ['updated']
+        with closing(self.connect()) as conn:
+            rows = conn.execute("SELECT {} FROM {} WHERE {} ORDER BY config, position".format(', '.join(columns), table, where), params).fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def resolutions(self, name, freq, temp, energy, configs=None):
+        return self.query('resolution', name, freq, temp, energy, configs)
+
+    ## Forget every result of the given configurations (all of them if configs is None). Returns the number of rows removed
+    def clear(self, name, freq, temp, energy, configs=None):
+        where, params = self.selection(name, freq, temp, energy, configs)
+        removed = 0
+        with closing(self.connect()) as conn:
+            for table in TABLES: removed += conn.execute("DELETE FROM {} WHERE {}".format(table, where), params).rowcount
+            conn.commit()
+        return removed
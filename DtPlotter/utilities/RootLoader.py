@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import os
+import sys
+import time
+
+'''
+    Lazy access to ROOT and the H4Analysis libraries.
+    Modules use "from RootLoader import ROOT" and ROOT.TH1F(...) etc. ROOT itself is only imported the first time
+    one of its attributes is used, so importing DtPlotter's modules (and --help, the wizard, CutBatchAnalysis --summary) is fast.
+    The H4Analysis libraries are only needed to read fitResult, and are loaded once per process by load_h4_libraries().
+    Files made by synthetic_h4.py use SyntheticH4.C's track class for fitResult instead, see load_synthetic_h4().
+    The dcb slice fit model (Double_Crystal_Ball_Fit.C) is compiled and loaded once per process by load_dcb().
+    Set H4ANALYSIS_PATH to use an H4Analysis build other than the default one.
+'''
+
+H4ANALYSIS_PATH = os.environ.get('H4ANALYSIS_PATH', '/afs/cern.ch/user/m/mplesser/H4Analysis/')
+H4_LIBRARIES    = ['CfgManager/lib/libCFGMan.so', 'lib/libH4Analysis.so', 'DynamicTTree/lib/libDTT.so']
+SYNTHETIC_H4    = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SyntheticH4.C')
+DCB_MODEL       = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Double_Crystal_Ball_Fit.C')
+
+timings          = {}                                                               # Step -> seconds, see report()
+root_module      = None
+loaded_libraries = []
+synthetic_loaded = False
+dcb_loaded       = False
+
+## The ROOT module, imported on first use
+def root():
+    global root_module
+    if root_module is None:
+        start       = time.time()
+        import ROOT as root_module_import
+        root_module = root_module_import
+        timings['import ROOT'] = time.time() - start
+    return root_module
+
+## Stand-in for the ROOT module that only imports it when an attribute is first used
+class LazyROOT:
+    def __getattr__(self, name):
+        return getattr(root(), name)
+
+ROOT = LazyROOT()
+
+def is_loaded():
+    return root_module is not None
+
+def h4_libraries_loaded():
+    return len(loaded_libraries) == len(H4_LIBRARIES)
+
+## Load libCFGMan, libH4Analysis and libDTT, once. Needed to read fitResult from the h4 tree
+## Only libraries that loaded are counted. If any is missing fitResult can't be read, so stop here rather than on a TTreeFormula error later
+def load_h4_libraries():
+    if h4_libraries_loaded(): return
+    start = time.time()
+    for lib in H4_LIBRARIES:
+        if lib in loaded_libraries: continue
+        if root().gSystem.Load(H4ANALYSIS_PATH + lib) >= 0: loaded_libraries.append(lib)       # 0 loaded, 1 already loaded, < 0 failed
+    timings['H4Analysis libraries'] = time.time() - start
+    if h4_libraries_loaded() == False:
+        missing = [H4ANALYSIS_PATH + lib for lib in H4_LIBRARIES if lib not in loaded_libraries]
+        sys.exit("\nCould not load {}, needed to read fitResult. Set H4ANALYSIS_PATH to your H4Analysis build, aborting...".format(', '.join(missing)))
+
+## Compile SyntheticH4.C (only when it changed, ACLiC keeps the library in builddir) and load it
+## Needed to write synthetic files (synthetic_h4.py) and to read their fitResult
+## Processes compiling it into the same builddir at once race, so with --jobs it is compiled before the pool (DtPlotter.prepare_libraries)
+def load_synthetic_h4(builddir):
+    global synthetic_loaded
+    if synthetic_loaded: return
+    start = time.time()
+    if root().gSystem.CompileMacro(SYNTHETIC_H4, 'kO', '', builddir) != 1:
+        sys.exit("\nCould not compile {}, aborting...".format(SYNTHETIC_H4))
+    synthetic_loaded = True
+    timings['SyntheticH4 library'] = time.time() - start
+
+## Compile Double_Crystal_Ball_Fit.C (only when it changed, the library is kept in builddir) and load it. Provides ROOT.double_xtal_ball
+## Compiled before a pool is started (fit_y_slices for --fw, DtPlotter.prepare_libraries for --jobs): workers then inherit it,
+## instead of compiling it into the same builddir at once. builddir None builds next to the macro
+def load_dcb(builddir=None):
+    global dcb_loaded
+    if dcb_loaded: return
+    start = time.time()
+    if root().gSystem.CompileMacro(DCB_MODEL, 'kO', '', builddir or '') != 1:
+        sys.exit("\nCould not compile {}, aborting...".format(DCB_MODEL))
+    dcb_loaded = True
+    timings['DCB model'] = time.time() - start
+
+## Print how long importing ROOT and loading the libraries took (only the steps that actually happened)
+def report():
+    print "Startup timings:"
+    if len(timings) == 0: print "\tROOT not loaded"
+    for step in ['import ROOT', 'H4Analysis libraries', 'SyntheticH4 library', 'DCB model']:
+        if step in timings: print "\t{:<24}{:>8.3f} s".format(step, timings[step])
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import sys
+import FileTools
+import CutEngine
+import EventCache
+import Profiler
+import Readers
+import ResultsStore
+
+'''
+    Everything known about one analysis file, built once and handed to RunInfoTools, AnalysisTools and PlotterTools.
+    Holds the open input (see Readers.py), crystal pair, amplitude bias, Aeff expression, log file, the cut engine,
+    and (once found) the target centers and chi2 bounds. None of these depend on the plot/cut options,
+    so one context can also be reused between runs on the same file with different options (see configure()).
+'''
+
+## Amplitude calibration coefficients, temperature -> position -> coefficient
+## Values not up-to-date, need to be recalculated
+AMP_CALIBRATION = { '18deg': {'C3up': 0.944866, 'C3down': 0.866062, 'C3left': 0.905111, 'C3right': 0.995219},
+                    '9deg' : {'C3up': 0.926351, 'C3down': 0.849426, 'C3left': 0.905111, 'C3right': 0.995219} }
+
+## Crystal pair of each position, [<crystal>, <neighbour>]
+XTAL_PAIRS      = { 'C3down': ['C3', 'C2'], 'C3up': ['C3', 'C4'], 'C3left': ['C3', 'B3'], 'C3right': ['C3', 'D3'] }
+
+class RunContext:
+
+    def __init__(self, args, savepath, filei):
+        self.filei       = filei
+        self.file        = filei[0]                                                 # Full file with path
+        self.file_title  = filei[1]                                                 # '<energy>_<position>', IE '25GeV_C3up'
+
+        ## Open the file once, every stage reads it through this (a ROOT file or a columnar export, see Readers.py)
+        self.reader      = Readers.open_reader(self.file, FileTools.FileTools(args).cache_location())
+
+        self.args        = args
+        self.xtal        = self.get_xtals()
+        self.ampbias     = self.amp_calibration_coeff()
+
+        ## Define Aeff since it is used in many places
+        self.Aeff        = "pow( 2 / ( (1/pow(fit_ampl[{0}]/b_rms[{0}], 2)) + (1/pow({1}*fit_ampl[{2}]/b_rms[{2}],2)) ) , 0.5)".format(self.xtal[0],self.ampbias,self.xtal[1])
+
+        self.engine      = None                                                     # Created on first use, see cut_engine()
+        self.centers     = None                                                     # [x_center, y_center], from RunInfoTools.find_target_center()
+        self.center_info = None                                                     # Centers and hodoscope centers, as stored in the results store
+        self.chi2_bounds = None                                                     # From PlotterTools.define_cuts()
+        self.results     = None                                                     # Created on first use, see results_store()
+        self.configure(args, savepath)
+
+    ## Set the run options and output location. Everything else in the context stays as is
+    def configure(self, args, savepath):
+        self.args     = args
+        self.energy   = args.e
+        self.savepath = savepath
+        self.logfile  = FileTools.FileTools(args).log_location(savepath, self.filei, self.xtal[2])
+        self.config   = getattr(args, 'config', None) or ResultsStore.configuration_name(args)
+        return self
+
+    ## Results store shared by every stage, created on first use
+    def results_store(self):
+        if self.results is None: self.results = ResultsStore.ResultsStore(FileTools.FileTools(self.args).results_location())
+        return self.results
+
+    ## Store one stage's results, keyed by this file and the current configuration. See ResultsStore.py
+    def record(self, table, values):
+        key = { 'name'    : self.args.name,
+                'freq'    : self.args.freq,
+                'temp'    : self.args.temp,
+                'energy'  : self.file_title.split('_')[0],                          # From the file, -e may select several energies
+                'position': self.xtal[2],
+                'config'  : self.config }
+        self.results_store().record(table, key, values)
+
+    ## Get crystal pair from Position
+    def get_xtals(self):
+        position = self.reader.position()
+        if   position == 2.5: position = 'C3down'                                   # Numbered in some runs, named in others
+        elif position == 3.5: position = 'C3up'
+        if position not in XTAL_PAIRS: sys.exit("\nUnrecognized crystal position, aborting...")
+        return XTAL_PAIRS[position] + [position]
+
+    ## Get the amplitude calibration coefficient
+    def amp_calibration_coeff(self):
+        return str(AMP_CALIBRATION[self.args.temp][self.xtal[2]])
+
+    ## Cut engine on the columnar cache of the h4 tree for this file, created on first use
+    def cut_engine(self):
+        if self.engine is None:
+            with Profiler.stage('column cache'):
+                chunk_size  = getattr(self.args, 'stream', 0) or None                 # --stream: events per chunk, 0 for the whole file at once
+                cache       = EventCache.EventCache(self.file, FileTools.FileTools(self.args).cache_location(), reader=self.reader, chunk_size=chunk_size)
+                cache.require(EventCache.default_columns(self.xtal))
+                self.engine = CutEngine.CutEngine(cache, chunk_size)
+        return self.engine
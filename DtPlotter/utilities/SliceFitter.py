@@ -0,0 +1,208 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import numpy as np
+
+'''
+    Batched slice fitter, an alternative to fitting each y-slice of a TH2 with Minuit.
+    Takes the whole 2D histogram as a numpy array (one row per x-slice) and fits every slice at once:
+        - seeds come from the vectorized moments of each slice
+        - Gaussian and double crystal ball models are evaluated for all slices together
+        - a batched Levenberg-Marquardt chi2 minimization (empty bins ignored, like ROOT's default chi2 fit)
+    Pure numpy, no ROOT needed.
+'''
+
+## Parameter limits, [lower, upper] per parameter. DCB limits are the ones used by AnalysisTools.fit_slice
+GAUS_LIMITS = [[0., np.inf], [-np.inf, np.inf], [1e-6, np.inf]]                           # constant, mean, sigma
+DCB_LIMITS  = [[0., 99999.], [-2., 2.], [0.01, 0.2], [0.01, 9.], [0.01, 9.]]              # c, mu, sig, A (alpha), n
+
+## Tail seeds [A, n] for the DCB, each slice keeps the lowest chi2. The tail parameters have several minima close together,
+## from A = n = 1 alone (fit_slice's seed) the fit can end up to ~1 in chi2 above the best one
+DCB_SEEDS   = [[1., 1.], [1.5, 3.], [3., 5.]]
+
+## Gaussian, params[:,0] * exp(-0.5*((y-mean)/sigma)^2), for every slice at once. y is (n_ybins,), params is (n_slices, 3)
+def gaus(y, params):
+    t = (y[None,:] - params[:,1,None]) / params[:,2,None]
+    return params[:,0,None] * np.exp(-0.5*t*t)
+
+def gaus_jacobian(y, params):
+    c, mu, sig = params[:,0,None], params[:,1,None], params[:,2,None]
+    t = (y[None,:] - mu) / sig
+    g = np.exp(-0.5*t*t)
+    return np.stack([g, c*g*t/sig, c*g*t*t/sig], axis=-1)
+
+## One-sided crystal ball shape (ROOT's "crystalball" without the constant), tail on the low side
+def crystal_ball(t, alpha, n):
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        a      = np.abs(alpha)
+        log_A  = n*np.log(n/a) - 0.5*a*a
+        B      = n/a - a
+        tail   = np.exp(log_A - n*np.log(np.maximum(B - t, 1e-300)))
+    return np.where(t >= -a, np.exp(-0.5*t*t), tail)
+
+## Double crystal ball as in Double_Crystal_Ball_Fit.C: c/2 * (CB(x; alpha) + CB(x; -alpha)), params (n_slices, 5): c, mu, sig, A, n
+def dcb(y, params):
+    c, mu, sig, alpha, n = [params[:,i,None] for i in range(5)]
+    t = (y[None,:] - mu) / sig
+    return 0.5*c*(crystal_ball(t, alpha, n) + crystal_ball(-t, alpha, n))
+
+## Crystal ball shape and its derivatives with respect to t, alpha and n (alpha > 0, as DCB_LIMITS keep it)
+## Core (t >= -alpha): exp(-t^2/2). Tail: exp(log_A - n*log(B - t)), log_A = n*log(n/alpha) - alpha^2/2, B = n/alpha - alpha
+def crystal_ball_derivatives(t, alpha, n):
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        f     = crystal_ball(t, alpha, n)
+        a     = np.abs(alpha)
+        core  = t >= -a
+        u     = np.maximum(n/a - a - t, 1e-300)                                             # B - t, > 0 in the tail
+        d_t   = np.where(core, -t*f, f*n/u)
+        d_a   = np.where(core, 0., f*(-n/a - a + n*(n/(a*a) + 1.)/u))
+        d_n   = np.where(core, 0., f*(np.log(n/a) + 1. - np.log(u) - n/(a*u)))
+    return f, d_t, d_a, d_n
+
+## Analytic jacobian of dcb, (n_slices, n_ybins, 5). The CB(-t) half enters with dt/dmu and dt/dsig flipped
+def dcb_jacobian(y, params):
+    c, mu, sig, alpha, n = [params[:,i,None] for i in range(5)]
+    t = (y[None,:] - mu) / sig
+    f1, d1_t, d1_a, d1_n = crystal_ball_derivatives( t, alpha, n)
+    f2, d2_t, d2_a, d2_n = crystal_ball_derivatives(-t, alpha, n)
+    return np.stack([ 0.5*(f1 + f2),
+                      0.5*c*(-d1_t + d2_t)/sig,                                             # dt/dmu = -1/sig
+                      0.5*c*(-d1_t + d2_t)*t/sig,                                           # dt/dsig = -t/sig
+                      0.5*c*(d1_a + d2_a),
+                      0.5*c*(d1_n + d2_n) ], axis=-1)
+
+MODELS = { 'gaus': [gaus, gaus_jacobian, GAUS_LIMITS],
+           'dcb' : [dcb,  dcb_jacobian,  DCB_LIMITS ] }
+
+## Vectorized moments of each slice: integral-normalized constant, mean and standard deviation
+def moments(counts, y):
+    n     = counts.sum(axis=1)
+    safe  = np.where(n > 0, n, 1.)
+    mean  = (counts*y[None,:]).sum(axis=1) / safe
+    var   = (counts*(y[None,:]-mean[:,None])**2).sum(axis=1) / safe
+    sigma = np.sqrt(np.maximum(var, (y[1]-y[0])**2/12.))                                    # At least the width of one bin
+    const = counts.max(axis=1)
+    return np.stack([const, mean, sigma], axis=-1)
+
+def clip(params, limits):
+    for i, (lo, hi) in enumerate(limits): params[:,i] = np.clip(params[:,i], lo, hi)
+    return params
+
+## Fit status per slice. MAX_ITER fits stopped at max_iter, but with a finite chi2 and errors, they are kept
+FAILED, CONVERGED, MAX_ITER = 0, 1, 2
+
+## Parameters sitting on a limit with the gradient pushing into it, (n_slices, n_par). These are held fixed, like Minuit does at a limit
+## grad is J^T r, chi2 goes down along +grad
+def at_limit(params, grad, limits):
+    lo = np.array([l[0] for l in limits])
+    hi = np.array([l[1] for l in limits])
+    return ((params <= lo) & (grad < 0)) | ((params >= hi) & (grad > 0))
+
+## Batched Levenberg-Marquardt. counts is (n_slices, n_ybins), errors the same shape (0 where a bin is ignored)
+## A slice has converged when the chi2 a full Gauss-Newton step would still gain (over the parameters not held at a limit) is below gtol,
+## or when the chi2 stops changing. Returns params, cov, chi2 and the status (FAILED, CONVERGED or MAX_ITER) of each slice
+def minimize_chi2(model, jacobian, limits, y, counts, errors, seeds, active, max_iter=200, tol=1e-10, gtol=1e-6):
+    weights = np.where(errors > 0, 1./np.where(errors > 0, errors, 1.), 0.)
+    params  = clip(seeds.copy(), limits)
+    n_par   = params.shape[1]
+    eye     = np.eye(n_par)[None,:,:]
+    lam     = np.full(len(params), 1e-3)
+    chi2    = (((counts - model(y, params))*weights)**2).sum(axis=1)
+    done    = ~active
+    for it in range(max_iter):
+        J       = jacobian(y, params) * weights[:,:,None]
+        r       = (counts - model(y, params)) * weights
+        JTJ     = np.einsum('sbi,sbj->sij', J, J)
+        grad    = np.einsum('sbi,sb->si', J, r)
+        ## Parameters held at a limit are taken out of the step: their rows/columns of JTJ become the identity, their gradient 0
+        free    = ~at_limit(params, grad, limits)
+        pair    = free[:,:,None] & free[:,None,:]
+        JTJ     = np.where(pair, JTJ, eye)
+        grad    = np.where(free, grad, 0.)
+        with np.errstate(invalid='ignore'):
+            gain = np.einsum('si,sij,sj->s', grad, np.linalg.pinv(JTJ, rcond=1e-12), grad)      # chi2 decrease of a full step, projected gradient in the JTJ metric
+        done   |= active & np.isfinite(chi2) & (gain <= gtol)
+        if done.all(): break
+        damping = lam[:,None,None] * (JTJ*eye + 1e-12*eye)
+        try:    step = np.linalg.solve(JTJ + damping, grad[:,:,None])[:,:,0]
+        except np.linalg.LinAlgError: step = np.zeros_like(params)
+        step[done] = 0.
+        trial      = clip(params + step, limits)
+        with np.errstate(over='ignore', invalid='ignore'):
+            chi2_trial = (((counts - model(y, trial))*weights)**2).sum(axis=1)
+        better     = np.isfinite(chi2_trial) & (chi2_trial <= chi2) & ~done
+        params     = np.where(better[:,None], trial, params)
+        stalled    = better & (chi2 - chi2_trial <= tol*np.maximum(chi2, 1.))
+        chi2       = np.where(better, chi2_trial, chi2)
+        lam        = np.where(better, lam*0.3, lam*10.)
+        done      |= stalled | (lam > 1e12)                                                 # No step lowers chi2 any more, also a minimum
+    ## Covariance from the final jacobian, over the parameters that are free (not at a limit, and constrained by the data)
+    ## A parameter at a limit gets its error from the free block plus itself, not 0: sigma can end at its limit, and its error still
+    ## weights the point in the resolution fit. Parameters the data don't constrain (IE n with the tails outside the histogram) get NaN
+    J       = jacobian(y, params) * weights[:,:,None]
+    JTJ     = np.einsum('sbi,sbj->sij', J, J)
+    diag    = np.diagonal(JTJ, axis1=1, axis2=2)
+    unknown = diag <= 1e-12*diag.max(axis=1)[:,None]
+    fixed   = at_limit(params, np.einsum('sbi,sb->si', J, (counts - model(y, params)) * weights), limits) & ~unknown
+    cov     = np.full(JTJ.shape, np.nan)
+    for s in np.where(active)[0]:
+        free = ~fixed[s] & ~unknown[s]
+        try:    sub = np.linalg.inv(JTJ[s][np.ix_(free, free)])
+        except np.linalg.LinAlgError: continue
+        cov[s]                      = 0.
+        for i in np.where(fixed[s])[0]:
+            with_i = free.copy()
+            with_i[i] = True
+            try:    cov[s][i,i] = np.linalg.inv(JTJ[s][np.ix_(with_i, with_i)])[np.sum(with_i[:i]), np.sum(with_i[:i])]
+            except np.linalg.LinAlgError: cov[s][i,i] = 1./diag[s][i]
+        cov[s][unknown[s], :]       = np.nan
+        cov[s][:, unknown[s]]       = np.nan
+        cov[s][np.ix_(free, free)]  = sub
+    finite  = np.isfinite(chi2) & np.isfinite(np.diagonal(cov, axis1=1, axis2=2)[:,1:3]).all(axis=1)
+    status  = np.where(active & done & np.isfinite(chi2), CONVERGED, np.where(active & ~done & finite, MAX_ITER, FAILED))
+    return params, cov, chi2, status
+
+## Fit every slice (row) of counts with 'gaus' or 'dcb'. y_edges has n_ybins+1 entries
+## Returns a dict of arrays (one value per slice): mean, mean_err, sigma, sigma_err, chi2ndf, entries, status, ok (converged or stopped at max_iter with finite errors)
+## As in AnalysisTools.fit_slice, the errors are scaled by the reduced chi2
+def fit_slices(counts, y_edges, fit_type='gaus', min_entries=50):
+    counts   = np.asarray(counts, dtype=np.float64)
+    y_edges  = np.asarray(y_edges, dtype=np.float64)
+    y        = 0.5*(y_edges[1:] + y_edges[:-1])
+    errors   = np.sqrt(counts)                                                              # Empty bins get error 0, and are ignored
+    entries  = counts.sum(axis=1)
+    active   = entries >= min_entries
+    n_bins   = np.count_nonzero(counts > 0, axis=1)
+
+    ## Gaussian first. For the DCB it only provides the seeds, like the gaus pre-fit in fit_slice
+    seeds    = moments(counts, y)
+    params, cov, chi2, status = minimize_chi2(gaus, gaus_jacobian, GAUS_LIMITS, y, counts, errors, seeds, active)
+    if fit_type == 'dcb':
+        gaus_params = params
+        for k, (A, n) in enumerate(DCB_SEEDS):
+            seeds = np.column_stack([gaus_params, np.full(len(params), A), np.full(len(params), n)])   # c, mu, sig from the gaussian
+            fit   = minimize_chi2(dcb, dcb_jacobian, DCB_LIMITS, y, counts, errors, seeds, active)
+            if k == 0:
+                params, cov, chi2, status = fit
+                continue
+            better = (fit[3] != FAILED) & ((status == FAILED) | (fit[2] < chi2))
+            params = np.where(better[:,None],      fit[0], params)
+            cov    = np.where(better[:,None,None], fit[1], cov)
+            chi2   = np.where(better,              fit[2], chi2)
+            status = np.where(better,              fit[3], status)
+
+    ndf      = np.maximum(n_bins - params.shape[1], 1)
+    chi2ndf  = chi2 / ndf
+    with np.errstate(invalid='ignore'):
+        par_err = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    ok       = (status != FAILED) & np.isfinite(par_err[:,1]) & np.isfinite(par_err[:,2]) & (n_bins > params.shape[1])
+    return { 'mean'     : params[:,1],
+             'mean_err' : chi2ndf*par_err[:,1],
+             'sigma'    : np.abs(params[:,2]),
+             'sigma_err': chi2ndf*par_err[:,2],
+             'chi2ndf'  : chi2ndf,
+             'entries'  : entries,
+             'params'   : params,
+             'status'   : status,
+             'ok'       : ok }
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+## By Michael Plesser
+
+import numpy as np
+
+'''
+    Unbinned maximum-likelihood fit of the time resolution, an alternative to fitting the slices of the dt vs Aeff map.
+    Every selected event (dt, Aeff) is a draw from a gaussian of width
+        sigma(Aeff) = sqrt( (N/Aeff)^2 + 2c^2 )
+    centered on a mean model:
+        const : mu0
+        walk  : mu0 + mu1/Aeff                       (the "walking mean", dt drifting with the amplitude)
+    and with tail=True a flat component (fraction f, over the dt range) takes the events no gaussian explains.
+    The gaussian is normalized inside the dt range, so events cut away in the wide low-Aeff slices don't bias N.
+    The negative log-likelihood and its gradient are evaluated for all events at once, and minimized with BFGS:
+    one minimization over all the events, in place of one fit per slice plus a fit of the slice widths.
+    Parameters are in the units of the columns (ns, Aeff), IE c = 0.030 is 30 ps. Pure numpy, no ROOT needed.
+'''
+
+MEAN_MODELS = ['const', 'walk']
+
+## Standard normal density and distribution function (Abramowitz & Stegun 7.1.26 for erf, good to 1.5e-7), vectorized
+def norm_pdf(z):
+    return np.exp(-0.5*z*z)/np.sqrt(2.*np.pi)
+
+def norm_cdf(z):
+    x   = np.abs(z)/np.sqrt(2.)
+    t   = 1./(1. + 0.3275911*x)
+    erf = 1. - t*(0.254829592 + t*(-0.284496736 + t*(1.421413741 + t*(-1.453152027 + t*1.061405429))))*np.exp(-x*x)
+    return 0.5*(1. + np.sign(z)*erf)
+
+## Resolution model for a set of events. Parameters theta: N, c, mu0, [mu1 (walk)], [logit(f) (tail)]
+class ResolutionModel:
+
+    def __init__(self, dt, aeff, mean_model='walk', tail=False, dt_range=None):
+        if mean_model not in MEAN_MODELS: raise ValueError("Unknown mean model '{}', use one of {}".format(mean_model, MEAN_MODELS))
+        self.dt         = np.asarray(dt,   dtype=np.float64)
+        self.inv_aeff   = 1./np.asarray(aeff, dtype=np.float64)
+        self.inv_aeff2  = self.inv_aeff**2
+        self.mean_model = mean_model
+        self.tail       = tail
+        self.dt_range   = dt_range                                                      # None: no truncation
+        if dt_range is None: dt_range = [self.dt.min(), self.dt.max()]
+        self.log_u      = -np.log(dt_range[1] - dt_range[0])                           # Flat tail density over the dt range
+
+    def names(self):
+        names = ['N', 'c', 'mu0']
+        if self.mean_model == 'walk': names.append('mu1')
+        if self.tail:                 names.append('tail_logit')
+        return names
+
+    def mean(self, theta):
+        if self.mean_model == 'walk': return theta[2] + theta[3]*self.inv_aeff
+        return theta[2]*np.ones(len(self.dt))
+
+    ## Negative log-likelihood and its gradient with respect to theta
+    def nll(self, theta):
+        N, c      = theta[0], theta[1]
+        s2        = N*N*self.inv_aeff2 + 2.*c*c
+        mu        = self.mean(theta)
+        r         = self.dt - mu
+        log_g     = -0.5*np.log(2.*np.pi*s2) - 0.5*r*r/s2
+        d_s2      = 0.5*(r*r/s2 - 1.)/s2                                                # d(log g)/d(s2)
+        d_mu      = r/s2                                                                # d(log g)/d(mu)
+        if self.dt_range is not None:                                                   # g /= Z, the gaussian's probability inside the range
+            s         = np.sqrt(s2)
+            z_lo      = (self.dt_range[0] - mu)/s
+            z_hi      = (self.dt_range[1] - mu)/s
+            Z         = np.maximum(norm_cdf(z_hi) - norm_cdf(z_lo), 1e-300)
+            log_g    -= np.log(Z)
+            d_s2     += (z_hi*norm_pdf(z_hi) - z_lo*norm_pdf(z_lo))/(2.*s2*Z)
+            d_mu     += (norm_pdf(z_hi) - norm_pdf(z_lo))/(s*Z)
+        if self.tail:
+            f       = 1./(1. + np.exp(-theta[-1]))
+            log_L   = np.logaddexp(np.log1p(-f) + log_g, np.log(f) + self.log_u)
+            w       = np.exp(np.log1p(-f) + log_g - log_L)                              # Probability each event is in the gaussian
+            d_phi   = f*(1.-f)*(np.exp(self.log_u - log_L) - np.exp(log_g - log_L))
+        else:
+            log_L   = log_g
+            w       = 1.
+        grad      = [np.sum(w*d_s2*2.*N*self.inv_aeff2), np.sum(w*d_s2*4.*c), np.sum(w*d_mu)]
+        if self.mean_model == 'walk': grad.append(np.sum(w*d_mu*self.inv_aeff))
+        if self.tail:                 grad.append(np.sum(d_phi))
+        return -np.sum(log_L), -np.array(grad)
+
+    ## Starting point: robust widths and centers in Aeff quantile groups, sigma^2 = N^2/Aeff^2 + 2c^2 solved by least squares
+    def seeds(self, n_groups=10):
+        order   = np.argsort(self.inv_aeff)
+        groups  = [g for g in np.array_split(order, n_groups) if len(g) > 10]
+        x       = np.array([np.mean(self.inv_aeff[g]) for g in groups])
+        center  = np.array([np.median(self.dt[g]) for g in groups])
+        width   = np.array([1.4826*np.median(np.abs(self.dt[g] - np.median(self.dt[g]))) for g in groups])     # MAD -> sigma
+        N2, c2  = np.linalg.lstsq(np.column_stack([x**2, 2.*np.ones(len(x))]), width**2, rcond=-1)[0]
+        theta   = [np.sqrt(max(N2, 1e-12)), np.sqrt(max(c2, 1e-4*np.min(width)**2))]
+        if self.mean_model == 'walk': theta += list(np.polyfit(x, center, 1)[::-1]) if len(x) > 1 else [np.median(self.dt), 0.]
+        else:                         theta += [np.median(self.dt)]
+        if self.tail:                 theta += [np.log(0.01/0.99)]                     # 1% tail to start with
+        return np.array(theta, dtype=np.float64)
+
+## BFGS with a backtracking line search, for fcn(x) -> (value, gradient). Returns x, value, number of fcn calls, converged
+def minimize(fcn, x0, max_iter=500, tol=1e-10):
+    x           = np.array(x0, dtype=np.float64)
+    f, g        = fcn(x)
+    n_calls     = 1
+    H           = np.eye(len(x)) * 0.1/max(np.max(np.abs(g)), 1e-12)                    # First step moves a parameter by at most 10% of its scale
+    for it in range(max_iter):
+        p = -np.dot(H, g)
+        if np.dot(g, p) >= 0:                                                           # Not a descent direction, restart from steepest descent
+            H = np.eye(len(x)) * 0.1/max(np.max(np.abs(g)), 1e-12)
+            p = -np.dot(H, g)
+        t = 1.
+        while True:
+            with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+                f_new, g_new = fcn(x + t*p)
+            n_calls += 1
+            if np.isfinite(f_new) and (f_new <= f + 1e-4*t*np.dot(g, p)): break
+            t *= 0.5
+            if t < 1e-12: return x, f, n_calls, False
+        s, y     = t*p, g_new - g
+        x        = x + s
+        improved = f - f_new
+        f, g     = f_new, g_new
+        if improved <= tol*max(abs(f), 1.): return x, f, n_calls, True
+        sy = np.dot(s, y)
+        if sy > 0:
+            if it == 0: H = np.eye(len(x)) * sy/np.dot(y, y)                            # Rescale the first guess of the inverse hessian
+            rho = 1./sy
+            V   = np.eye(len(x)) - rho*np.outer(s, y)
+            H   = np.dot(V, np.dot(H, V.T)) + rho*np.outer(s, s)
+    return x, f, n_calls, False
+
+## Hessian by central differences of the analytic gradient, for the parameter errors
+def hessian(fcn, x):
+    H = np.zeros((len(x), len(x)))
+    for i in range(len(x)):
+        step         = 1e-5*max(abs(x[i]), 1e-3)
+        up, down     = x.copy(), x.copy()
+        up[i]       += step
+        down[i]     -= step
+        H[:,i]       = (fcn(up)[1] - fcn(down)[1]) / (2.*step)
+    return 0.5*(H + H.T)
+
+## Parameter errors at theta from the inverse hessian of fcn, and whether theta is a minimum. A singular hessian gives infinite errors.
+## One that isn't positive definite (a variance <= 0, theta is a saddle point or a maximum) gives NaN errors and False
+def hessian_errors(fcn, theta):
+    try:    variances = np.diagonal(np.linalg.inv(hessian(fcn, theta)))
+    except np.linalg.LinAlgError: return np.full(len(theta), np.inf), True
+    if np.any(np.isnan(variances) | (variances <= 0)): return np.full(len(theta), np.nan), False
+    return np.sqrt(variances), True
+
+## Fit the events (dt, Aeff columns). Returns a dict with the fitted values and errors by parameter name (N, c, mu0, ...),
+## nll, events, calls (likelihood evaluations), converged, and the tail fraction if fitted. None if there are too few events
+def fit(dt, aeff, mean_model='walk', tail=False, dt_range=None, min_events=100):
+    dt, aeff = np.asarray(dt, dtype=np.float64), np.asarray(aeff, dtype=np.float64)
+    keep     = np.isfinite(dt) & np.isfinite(aeff) & (aeff > 0)
+    if dt_range is not None: keep &= (dt >= dt_range[0]) & (dt < dt_range[1])
+    if np.count_nonzero(keep) < min_events: return None
+    model    = ResolutionModel(dt[keep], aeff[keep], mean_model, tail, dt_range)
+
+    ## Minimize in parameters scaled by their seeds, so they are all of order 1
+    seed     = model.seeds()
+    scale    = np.maximum(np.abs(seed), 1e-3)
+    def scaled(x):
+        value, grad = model.nll(x*scale)
+        return value, grad*scale
+    x, nll, n_calls, converged = minimize(scaled, seed/scale)
+    theta    = x*scale
+
+    errors, minimum = hessian_errors(model.nll, theta)
+    converged      &= minimum
+    n_calls        += 2*len(theta)
+
+    result   = {'nll': nll, 'events': len(model.dt), 'calls': n_calls, 'converged': converged}
+    for name, value, error in zip(model.names(), theta, errors):
+        result[name], result[name+'_err'] = value, error
+    result['N'], result['c'] = abs(result['N']), abs(result['c'])                      # Only the squares enter the model
+    if tail: result['tail_fraction'] = 1./(1. + np.exp(-result['tail_logit']))
+    return result
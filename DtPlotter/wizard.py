@@ -104,11 +104,12 @@ def cuts_method(cmd):
     print "\tTo use a cut on the minimum amp_max of an event enter:         \t 1 or --am"
     print "\tTo use a square position cut enter:                            \t 2 or --pc"
     print "\tTo use a linear correction to adjust for walking mean enter:   \t 3 or --lc"
+    print "\tTo use a 2D position correction map instead enter:            \t 4 or --mc"
     print "\tTo select multiple, enter the numbers/letters separated by commas, IE '1,2,3'"
     cuts = raw_input("Choose now: ").split(',')
     print
     for c in cuts:
-        elif c == '1' or c == '--am': 
+        if   c == '1' or c == '--am': 
             cmd.append('--am')
             print "Enter the minimum value for max_ampl of an event to be allowed: "
             print "Leave blank for default"
@@ -122,6 +123,8 @@ def cuts_method(cmd):
             if poscut != '': cmd.append(poscut)
         elif c == '3' or c == '--lc': 
             cmd.append('--lc')
+        elif c == '4' or c == '--mc':
+            cmd.append('--mc')
     return cmd
 
 def main():